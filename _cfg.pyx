@@ -1,4 +1,5 @@
 from libc.math cimport exp, log
+from libc.stdlib cimport malloc, free
 import numpy as np
 cimport numpy as np
 cimport cython
@@ -10,32 +11,85 @@ ctypedef np.float64_t dtype_t
 ctypedef np.int32_t itype_t
 ctypedef np.uint8_t atype_t
 
+# packed traceback entries (see MultitrackCfg.getTracebackDtype())
+ctypedef fused tbtype_t:
+    np.int32_t
+    np.int64_t
+
 cdef dtype_t _NINF = -np.inf
+
+cdef inline itype_t _pairMatch(np.uint16_t[:, :] alignmentTrack,
+                               itype_t baseMatch, itype_t defAlignmentSymbol,
+                               itype_t i, itype_t j) nogil:
+    """ 1 if columns i and j are aligned to eachother, otherwise 0 """
+    if baseMatch != 0 and alignmentTrack[i, 0] != defAlignmentSymbol and\
+       alignmentTrack[i, 0] == alignmentTrack[j, 0]:
+        return 1
+    return 0
         
 @cython.boundscheck(False)
 def fastCykTable(cfg, np.ndarray[atype_t, ndim=2] obs,
                  np.ndarray[np.uint16_t, ndim=2] alignmentTrack,
-                 np.int_t numThreads):
+                 np.ndarray[tbtype_t, ndim=3] tb,
+                 np.ndarray[tbtype_t, ndim=2] chainTb,
+                 np.int_t numThreads, np.int_t tileSize):
     """ Do the CYK dynamic programming algorithm (like viterbi) to
-    compute the maximum likelihood CFG derivation of the observations."""
+    compute the maximum likelihood CFG derivation of the observations.
+    The table is stored by diagonal: dp[d, i] is the cell for the
+    subsequence [i, i + d].  Only the first W = len(dp) diagonals are
+    filled (see MultitrackCfg.maxSpan).  If that doesn't cover the whole
+    sequence, the prefixes [0, j] are filled into chainDp by chaining
+    band cells onto shorter prefixes (ie X -> Y Z where Y is a prefix
+    and Z is in the band).  The traceback tables (cfg.tb and cfg.chainTb,
+    passed in so their type is known) get the production used for each
+    cell packed into a single integer (see MultitrackCfg.__traceBack()).
+
+    The (i, j) triangle is cut into tileSize x tileSize tiles.  A tile
+    only depends on the tiles to its left and below it, so all the tiles
+    on a diagonal of tiles (a wavefront) can be done at the same time,
+    each by one thread.  Within a tile, cells are done by increasing size.
+    """
     cdef itype_t nObs = len(obs)
     cdef itype_t M = cfg.M
     cdef itype_t baseMatch = len(alignmentTrack) > 0
     assert len(alignmentTrack) > 0 or baseMatch == 0
+    assert tileSize > 0
     cdef np.ndarray[np.int_t, ndim=1] emittingStates = cfg.emittingStates
     cdef np.ndarray[itype_t, ndim=1] helperDim1 = cfg.helperDim1
     cdef np.ndarray[itype_t, ndim=1] helperDim2 = cfg.helperDim2
     cdef np.ndarray[np.int32_t, ndim=3] helper1 = cfg.helper1
     cdef np.ndarray[np.int32_t, ndim=2] helper2 = cfg.helper2
-    cdef np.ndarray[np.int64_t, ndim=4] tb = cfg.tb
     cdef np.ndarray[np.float_t, ndim=3] dp = cfg.dp
     cdef np.ndarray[np.float_t, ndim=3] logProbs1 = cfg.logProbs1
     cdef np.ndarray[np.float_t, ndim=2] logProbs2 = cfg.logProbs2
     cdef np.ndarray[np.float_t, ndim=2] emLogProbs = cfg.emLogProbs
+    cdef itype_t W = len(dp)
+    cdef itype_t chain = cfg.chainDp is not None
+    cdef np.ndarray[np.float_t, ndim=2] chainDp
+    if chain != 0:
+        chainDp = cfg.chainDp
+    else:
+        chainDp = np.zeros((0, 0), dtype=np.float)
+    # packed traceback is offset * tbStride + production, where production
+    # is the index in helper1, or pairBase + the index in helper2
+    cdef tbtype_t tbStride = cfg.tbStride
+    cdef tbtype_t pairBase = cfg.helper1.shape[1]
+    cdef tbtype_t bestTb
+    cdef itype_t B = tileSize
+    cdef itype_t numTiles = (nObs + B - 1) / B
+    # the smallest cell in the tiles on wavefront t has size (t - 1) * B + 2
+    cdef itype_t numWaves = min(numTiles, (W - 2) / B + 2)
+    cdef itype_t wave
+    cdef itype_t tile
+    cdef itype_t iStart
+    cdef itype_t iEnd
+    cdef itype_t jStart
+    cdef itype_t jEnd
     cdef itype_t size
     cdef itype_t match = 0
     cdef itype_t i
     cdef itype_t j
+    cdef itype_t end
     cdef itype_t k
     cdef itype_t q
     cdef itype_t x
@@ -44,46 +98,721 @@ def fastCykTable(cfg, np.ndarray[atype_t, ndim=2] obs,
     cdef itype_t r1State
     cdef itype_t r2State
     cdef dtype_t lp
-    cdef itype_t PAIRFLAG = cfg.PAIRFLAG
+    cdef dtype_t prodLp
+    cdef dtype_t best
     cdef itype_t defAlignmentSymbol = cfg.defAlignmentSymbol
     cdef np.ndarray[np.float_t, ndim=2] logPriors = \
          cfg.pairEmissionModel.logPriors
     with nogil, parallel(num_threads=numThreads):
-        for size in xrange(2, nObs + 1):
-            for i in prange(nObs + 1 - size):
-                j = i + size - 1
-                match = 0
-                if baseMatch != 0 and\
-                   alignmentTrack[i,0] != defAlignmentSymbol and\
-                   alignmentTrack[i,0] == alignmentTrack[j,0]:
-                    match = 1
-                for x in xrange(M):
+        for wave in xrange(numWaves):
+            # tile covers i in [iStart, iEnd) and j in [jStart, jEnd)
+            for tile in prange(numTiles - wave, schedule='dynamic'):
+                iStart = tile * B
+                iEnd = min(iStart + B, nObs)
+                jStart = (tile + wave) * B
+                jEnd = min(jStart + B, nObs)
+                for size in xrange(max(2, jStart - iEnd + 2),
+                                   min(W, jEnd - iStart) + 1):
+                    for i in xrange(max(iStart, jStart - size + 1),
+                                    min(iEnd, jEnd - size + 1)):
+                        j = i + size - 1
+                        match = 0
+                        if baseMatch != 0 and\
+                           alignmentTrack[i,0] != defAlignmentSymbol and\
+                           alignmentTrack[i,0] == alignmentTrack[j,0]:
+                            match = 1
+                        for x in xrange(M):
+                            lState = emittingStates[x]
+                            best = dp[size - 1, i, lState]
+                            bestTb = tb[size - 1, i, lState]
+                            for q in xrange(helperDim1[lState]):
+                                r1State = helper1[lState, q, 0]
+                                r2State = helper1[lState, q, 1]
+                                prodLp = logProbs1[lState, r1State, r2State]
+                                for k in xrange(i, j):
+                                    lp = prodLp + dp[k - i, i, r1State] +\
+                                         dp[j - k - 1, k + 1, r2State]
+                                    if lp > best:
+                                        best = lp
+                                        bestTb = (k - i) * tbStride + q
+                            if size > 2:
+                                for q in xrange(helperDim2[lState]):
+                                    rState = helper2[lState, q]
+                                    lp = logProbs2[lState, rState] +\
+                                         dp[size - 3, i + 1, rState] +\
+                                         emLogProbs[i, lState] +\
+                                         emLogProbs[j, lState] +\
+                                         logPriors[lState, match]
+                                    if lp > best:
+                                        best = lp
+                                        bestTb = pairBase + q
+                            dp[size - 1, i, lState] = best
+                            tb[size - 1, i, lState] = bestTb
+
+        # prefixes longer than the band: chain band cells (which are at most
+        # W long) onto the end of shorter prefixes
+        if chain != 0:
+            for end in xrange(W, nObs):
+                for x in prange(M):
                     lState = emittingStates[x]
                     for q in xrange(helperDim1[lState]):
                         r1State = helper1[lState, q, 0]
                         r2State = helper1[lState, q, 1]
-                        for k in xrange(i, i + size - 1):
-                            lp = logProbs1[lState, r1State, r2State] + \
-                                 dp[i, k, r1State] +\
-                                 dp[k+1, j, r2State]
-                            if lp > dp[i, j, lState]:
-                                dp[i, j, lState] = lp
-                                #tb[i, j, lState] = [k, r1State, r2State]
-                                tb[i, j, lState, 0] = k
-                                tb[i, j, lState, 1] = r1State
-                                tb[i, j, lState, 2] = r2State
+                        for k in xrange(end - W, end):
+                            if k < W:
+                                lp = dp[k, 0, r1State]
+                            else:
+                                lp = chainDp[k, r1State]
+                            lp = lp + logProbs1[lState, r1State, r2State] + \
+                                 dp[end - k - 1, k + 1, r2State]
+                            if lp > chainDp[end, lState]:
+                                chainDp[end, lState] = lp
+                                chainTb[end, lState] = \
+                                    (end - k - 1) * tbStride + q
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _sparseChain(itype_t start, itype_t end,
+                       dtype_t[:, :] chainDp, np.int64_t[:, :] chainTb,
+                       dtype_t[:, :] emLogProbs, np.uint8_t[:] isNest,
+                       dtype_t[:, :, :] logProbs1, np.int32_t[:, :, :] helper1,
+                       itype_t[:] helperDim1, np.int_t[:] emittingStates,
+                       itype_t[:] anchorI, itype_t[:] jPtr, itype_t[:] jIdx,
+                       dtype_t[:, :] unitDp, np.int64_t tbStride) nogil:
+    """ Fill chainDp[b - start, X] with the best derivation of [start, b]
+    from X (for b up to end) that is a left to right chain of units (see
+    fastSparseCykTable()).  The traceback is packed as
+    unit * tbStride + production, where unit is 0 for a single column and
+    the anchor number + 1 for an anchored pair, and production is the index
+    in helper1 (or tbStride - 1 if the whole subsequence is the unit) """
+    cdef itype_t M = len(emittingStates)
+    cdef np.int64_t selfTb = tbStride - 1
+    cdef itype_t b
+    cdef itype_t x
+    cdef itype_t p
+    cdef itype_t q
+    cdef itype_t i
+    cdef itype_t anchor
+    cdef itype_t lState
+    cdef itype_t r1State
+    cdef itype_t r2State
+    cdef dtype_t prodLp
+    cdef dtype_t lp
+    cdef dtype_t best
+    cdef np.int64_t bestTb
+    for b in xrange(start, end + 1):
+        for x in xrange(M):
+            lState = emittingStates[x]
+            best = _NINF
+            bestTb = -1
+            if b == start and isNest[lState] == 0:
+                best = emLogProbs[b, lState]
+                bestTb = selfTb
+            # anchors ending at b are sorted by decreasing start
+            for p in xrange(jPtr[b], jPtr[b + 1]):
+                anchor = jIdx[p]
+                if anchorI[anchor] < start:
+                    break
+                if anchorI[anchor] == start and unitDp[anchor, lState] > best:
+                    best = unitDp[anchor, lState]
+                    bestTb = (anchor + 1) * tbStride + selfTb
+            if b > start:
+                for q in xrange(helperDim1[lState]):
+                    r1State = helper1[lState, q, 0]
+                    r2State = helper1[lState, q, 1]
+                    prodLp = logProbs1[lState, r1State, r2State]
+                    if isNest[r2State] == 0:
+                        lp = prodLp + chainDp[b - 1 - start, r1State] + \
+                             emLogProbs[b, r2State]
+                        if lp > best:
+                            best = lp
+                            bestTb = q
+                    else:
+                        for p in xrange(jPtr[b], jPtr[b + 1]):
+                            anchor = jIdx[p]
+                            i = anchorI[anchor]
+                            if i <= start:
+                                break
+                            lp = prodLp + chainDp[i - 1 - start, r1State] + \
+                                 unitDp[anchor, r2State]
+                            if lp > best:
+                                best = lp
+                                bestTb = (anchor + 1) * tbStride + q
+            chainDp[b - start, lState] = best
+            chainTb[b - start, lState] = bestTb
+
+def fastSparseChain(cfg, np.int_t start, np.int_t end,
+                    np.ndarray[np.float_t, ndim=2] chainDp,
+                    np.ndarray[np.int64_t, ndim=2] chainTb):
+    """ Fill in the chain from start to end (inclusive) into the given
+    tables, once the anchored pairs have been scored by
+    fastSparseCykTable().  Used to trace back into a nested pair """
+    assert len(chainDp) > end - start and len(chainTb) > end - start
+    _sparseChain(start, end, chainDp, chainTb, cfg.emLogProbs,
+                 cfg.nestMask, cfg.logProbs1, cfg.helper1,
+                 cfg.helperDim1, cfg.emittingStates, cfg.anchorI,
+                 cfg.anchorJPtr, cfg.anchorJIdx, cfg.unitDp, cfg.sparseStride)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def fastSparseCykTable(cfg, dtype_t[:, :] chainDp,
+                       np.int64_t[:, :] chainTb):
+    """ Sparse CYK (see MultitrackCfg.sparse).  A nested pair X -> a Y a
+    can only be emitted at an anchor: a pair of columns (i, j) that share
+    a self-alignment (see MultitrackCfg.getAnchors()).  Everything else is
+    chained left to right, as in the banded CYK beyond the band: a
+    derivation of [a, b] is either a unit (a single column from an HMM
+    state, or an anchored pair from a nest state) or X -> Y Z where Y
+    derives [a, k] and Z is a unit [k + 1, b].  The anchors are scored
+    (into cfg.unitDp) from the innermost out: the inside of anchor (i, j)
+    is the chain starting at i + 1, which only uses anchors nested in it.
+    Finally the whole sequence is chained into chainDp.  So the work is
+    linear in the length of the sequence plus the length of the insides
+    of the anchors, rather than cubic. """
+    cdef itype_t nObs = len(cfg.emLogProbs)
+    cdef itype_t M = cfg.M
+    cdef dtype_t[:, :] emLogProbs = cfg.emLogProbs
+    cdef np.uint8_t[:] isNest = cfg.nestMask
+    cdef dtype_t[:, :, :] logProbs1 = cfg.logProbs1
+    cdef np.int32_t[:, :, :] helper1 = cfg.helper1
+    cdef itype_t[:] helperDim1 = cfg.helperDim1
+    cdef dtype_t[:, :] logProbs2 = cfg.logProbs2
+    cdef np.int32_t[:, :] helper2 = cfg.helper2
+    cdef itype_t[:] helperDim2 = cfg.helperDim2
+    cdef np.int_t[:] emittingStates = cfg.emittingStates
+    cdef itype_t[:] anchorI = cfg.anchorI
+    cdef itype_t[:] anchorJ = cfg.anchorJ
+    cdef itype_t[:] iPtr = cfg.anchorIPtr
+    cdef itype_t[:] jPtr = cfg.anchorJPtr
+    cdef itype_t[:] jIdx = cfg.anchorJIdx
+    cdef dtype_t[:, :] unitDp = cfg.unitDp
+    cdef np.int64_t[:, :] unitTb = cfg.unitTb
+    cdef dtype_t[:, :] logPriors = cfg.pairEmissionModel.logPriors
+    cdef np.int64_t tbStride = cfg.sparseStride
+    cdef np.int64_t adjacentTb = cfg.helper2.shape[1]
+    # inside chains are done one anchor start at a time in this buffer
+    cdef dtype_t[:, :] insideDp = np.empty((nObs, M), dtype=np.float)
+    cdef np.int64_t[:, :] insideTb = np.empty((nObs, M), dtype=np.int64)
+    cdef itype_t i
+    cdef itype_t j
+    cdef itype_t p
+    cdef itype_t q
+    cdef itype_t x
+    cdef itype_t anchor
+    cdef itype_t insideEnd
+    cdef itype_t lState
+    cdef itype_t rState
+    cdef dtype_t pairLp
+    cdef dtype_t lp
+    with nogil:
+        for i in xrange(nObs - 2, -1, -1):
+            if iPtr[i + 1] == iPtr[i]:
+                continue
+            # anchors starting at i are sorted by end, so the last one
+            # has the longest inside
+            insideEnd = anchorJ[iPtr[i + 1] - 1] - 1
+            if insideEnd > i:
+                _sparseChain(i + 1, insideEnd, insideDp, insideTb, emLogProbs,
+                             isNest, logProbs1, helper1, helperDim1,
+                             emittingStates, anchorI, jPtr, jIdx, unitDp,
+                             tbStride)
+            for p in xrange(iPtr[i], iPtr[i + 1]):
+                anchor = p
+                j = anchorJ[anchor]
+                for x in xrange(M):
+                    lState = emittingStates[x]
+                    if isNest[lState] == 0:
+                        continue
+                    pairLp = emLogProbs[i, lState] + emLogProbs[j, lState] + \
+                             logPriors[lState, 1]
+                    if j == i + 1:
+                        unitDp[anchor, lState] = pairLp
+                        unitTb[anchor, lState] = adjacentTb
+                        continue
+                    for q in xrange(helperDim2[lState]):
+                        rState = helper2[lState, q]
+                        lp = pairLp + logProbs2[lState, rState] + \
+                             insideDp[j - 1 - (i + 1), rState]
+                        if lp > unitDp[anchor, lState]:
+                            unitDp[anchor, lState] = lp
+                            unitTb[anchor, lState] = q
+        _sparseChain(0, nObs - 1, chainDp, chainTb, emLogProbs, isNest,
+                     logProbs1, helper1, helperDim1, emittingStates, anchorI,
+                     jPtr, jIdx, unitDp, tbStride)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def fastInsideTable(cfg, np.uint16_t[:, :] alignmentTrack,
+                    dtype_t[:, :, :] dp, dtype_t[:, :] chainDp,
+                    dtype_t[:, :] scale, dtype_t[:] chainScale,
+                    np.int_t numThreads):
+    """ Inside algorithm: the same recursion as fastCykTable(), in the same
+    (banded) tables, but summing over the derivations of each cell instead
+    of taking the best one.  To avoid a log and an exp for every term of
+    every sum, each cell is stored as a log scale (in scale, or chainScale
+    for the prefixes beyond the band) and a probability for each state
+    relative to it (in dp or chainDp), scaled so the largest is 1.
+    So the inside log probability of cell (d, i) for state X is
+    scale[d, i] + log(dp[d, i, X]).  Only one exp is needed per split
+    point of a cell, and one log per cell.  On entry, dp holds the log
+    probabilities of the single columns and adjacent pairs (as set up for
+    CYK), and chainDp is empty if the band covers the whole sequence.
+    These are separate tables from the CYK ones (cfg.dp), which hold
+    scores.  The cells of a diagonal are independent and are split between
+    the threads. """
+    cdef itype_t nObs = len(cfg.emLogProbs)
+    cdef itype_t M = cfg.M
+    cdef itype_t baseMatch = len(alignmentTrack) > 0
+    cdef np.int_t[:] emittingStates = cfg.emittingStates
+    cdef itype_t[:] helperDim1 = cfg.helperDim1
+    cdef itype_t[:] helperDim2 = cfg.helperDim2
+    cdef np.int32_t[:, :, :] helper1 = cfg.helper1
+    cdef np.int32_t[:, :] helper2 = cfg.helper2
+    cdef dtype_t[:, :, :] probs1 = np.exp(cfg.logProbs1)
+    cdef dtype_t[:, :] probs2 = np.exp(cfg.logProbs2)
+    cdef dtype_t[:, :] emLogProbs = cfg.emLogProbs
+    cdef dtype_t[:, :] logPriors = cfg.pairEmissionModel.logPriors
+    cdef np.uint8_t[:] isNest = cfg.nestMask
+    cdef itype_t W = dp.shape[0]
+    cdef itype_t chain = chainDp.shape[0] > 0
+    cdef dtype_t[:] chainWeights = np.zeros((W,), dtype=np.float)
+    cdef dtype_t[:] chainTotals = np.zeros((M,), dtype=np.float)
+    cdef itype_t defAlignmentSymbol = cfg.defAlignmentSymbol
+    cdef dtype_t* weights
+    cdef dtype_t* totals
+    cdef itype_t size
+    cdef itype_t match
+    cdef itype_t i
+    cdef itype_t j
+    cdef itype_t end
+    cdef itype_t k
+    cdef itype_t q
+    cdef itype_t x
+    cdef itype_t lState
+    cdef itype_t rState
+    cdef itype_t r1State
+    cdef itype_t r2State
+    cdef dtype_t ref
+    cdef dtype_t t
+    cdef dtype_t sub
+    cdef dtype_t total
+    cdef dtype_t best
+    cdef dtype_t leftScale
+    cdef dtype_t left
+    with nogil, parallel(num_threads=numThreads):
+        # (per thread) weight of each split point, and total of each state
+        weights = <dtype_t*>malloc(sizeof(dtype_t) * (W + M))
+        totals = weights + W
+        for size in xrange(1, W + 1):
+            for i in prange(nObs + 1 - size, schedule='static'):
+                j = i + size - 1
+                match = _pairMatch(alignmentTrack, baseMatch,
+                                   defAlignmentSymbol, i, j)
+                # the scale of the largest term
+                ref = _NINF
+                if size <= 2:
+                    for x in xrange(M):
+                        if dp[size - 1, i, x] > ref:
+                            ref = dp[size - 1, i, x]
+                for k in xrange(i, j):
+                    t = scale[k - i, i] + scale[j - k - 1, k + 1]
+                    if t > ref:
+                        ref = t
+                if size > 2:
+                    for x in xrange(M):
+                        lState = emittingStates[x]
+                        if isNest[lState] != 0:
+                            t = scale[size - 3, i + 1] + \
+                                emLogProbs[i, lState] + \
+                                emLogProbs[j, lState] + \
+                                logPriors[lState, match]
+                            if t > ref:
+                                ref = t
+                best = 0.
+                if ref > _NINF:
+                    for k in xrange(i, j):
+                        weights[k - i] = exp(scale[k - i, i] +
+                                             scale[j - k - 1, k + 1] - ref)
+                    for x in xrange(M):
+                        lState = emittingStates[x]
+                        total = 0.
+                        # single column or adjacent pair
+                        if size <= 2 and dp[size - 1, i, lState] > _NINF:
+                            total = exp(dp[size - 1, i, lState] - ref)
+                        for q in xrange(helperDim1[lState]):
+                            r1State = helper1[lState, q, 0]
+                            r2State = helper1[lState, q, 1]
+                            sub = 0.
+                            for k in xrange(i, j):
+                                sub = sub + weights[k - i] * \
+                                      dp[k - i, i, r1State] * \
+                                      dp[j - k - 1, k + 1, r2State]
+                            total = total + \
+                                    probs1[lState, r1State, r2State] * sub
+                        if size > 2 and helperDim2[lState] > 0:
+                            sub = 0.
+                            for q in xrange(helperDim2[lState]):
+                                rState = helper2[lState, q]
+                                sub = sub + probs2[lState, rState] * \
+                                      dp[size - 3, i + 1, rState]
+                            total = total + sub * exp(
+                                scale[size - 3, i + 1] +
+                                emLogProbs[i, lState] +
+                                emLogProbs[j, lState] +
+                                logPriors[lState, match] - ref)
+                        totals[lState] = total
+                        if total > best:
+                            best = total
+                if best > 0.:
+                    scale[size - 1, i] = ref + log(best)
+                    for x in xrange(M):
+                        lState = emittingStates[x]
+                        dp[size - 1, i, lState] = totals[lState] / best
+                else:
+                    scale[size - 1, i] = _NINF
+                    for x in xrange(M):
+                        dp[size - 1, i, x] = 0.
+        free(weights)
+
+    # prefixes longer than the band (see fastCykTable())
+    if chain != 0:
+        with nogil:
+            for end in xrange(W, nObs):
+                ref = _NINF
+                for k in xrange(end - W, end):
+                    leftScale = scale[k, 0] if k < W else chainScale[k]
+                    t = leftScale + scale[end - k - 1, k + 1]
+                    if t > ref:
+                        ref = t
+                best = 0.
+                if ref > _NINF:
+                    for k in xrange(end - W, end):
+                        leftScale = scale[k, 0] if k < W else chainScale[k]
+                        chainWeights[k - end + W] = exp(
+                            leftScale + scale[end - k - 1, k + 1] - ref)
+                    for x in xrange(M):
+                        lState = emittingStates[x]
+                        total = 0.
+                        for q in xrange(helperDim1[lState]):
+                            r1State = helper1[lState, q, 0]
+                            r2State = helper1[lState, q, 1]
+                            sub = 0.
+                            for k in xrange(end - W, end):
+                                if k < W:
+                                    left = dp[k, 0, r1State]
+                                else:
+                                    left = chainDp[k, r1State]
+                                sub = sub + chainWeights[k - end + W] * \
+                                      left * dp[end - k - 1, k + 1, r2State]
+                            total = total + \
+                                    probs1[lState, r1State, r2State] * sub
+                        chainTotals[lState] = total
+                        if total > best:
+                            best = total
+                if best > 0.:
+                    chainScale[end] = ref + log(best)
+                    for x in xrange(M):
+                        lState = emittingStates[x]
+                        chainDp[end, lState] = chainTotals[lState] / best
+                else:
+                    chainScale[end] = _NINF
+                    for x in xrange(M):
+                        chainDp[end, x] = 0.
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def fastOutsideTable(cfg, np.uint16_t[:, :] alignmentTrack,
+                     dtype_t[:, :, :] dp, dtype_t[:, :] chainDp,
+                     dtype_t[:, :] scale, dtype_t[:] chainScale,
+                     dtype_t[:, :, :] outDp, dtype_t[:, :] outScale,
+                     dtype_t[:, :] outChainDp, dtype_t[:] outChainScale,
+                     dtype_t[:, :] posteriors, np.int_t numThreads):
+    """ Outside algorithm, once fastInsideTable() has filled the inside
+    tables (dp, chainDp, scale and chainScale).  The outside tables get, for each cell, the probability of
+    everything outside of it given that its subsequence is derived from
+    each state, stored the same way as the inside tables (a log scale per
+    cell and relative probabilities).  Each cell collects (pulls) its value
+    from the cells it can be a child of, so the cells on a diagonal can be
+    done independently, from the longest diagonal down, using the reverse
+    production tables (see MultitrackCfg.createReverseHelperTables()).
+
+    posteriors[p, X] gets the probability that column p is emitted by state
+    X: either as a single column or as one side of a pair.  The two
+    sides of the pairs are added up in separate buffers (no two cells on
+    a diagonal have the same left or the same right end). """
+    cdef itype_t nObs = len(cfg.emLogProbs)
+    cdef itype_t M = cfg.M
+    cdef itype_t baseMatch = len(alignmentTrack) > 0
+    cdef np.int_t[:] emittingStates = cfg.emittingStates
+    cdef itype_t[:] helperDim2 = cfg.helperDim2
+    cdef np.int32_t[:, :] helper2 = cfg.helper2
+    cdef itype_t[:] revLeftDim = cfg.revLeftDim
+    cdef np.int32_t[:, :, :] revLeft = cfg.revLeft
+    cdef itype_t[:] revRightDim = cfg.revRightDim
+    cdef np.int32_t[:, :, :] revRight = cfg.revRight
+    cdef itype_t[:] revPairDim = cfg.revPairDim
+    cdef np.int32_t[:, :, :] revPair = cfg.revPair
+    cdef dtype_t[:, :, :] probs1 = np.exp(cfg.logProbs1)
+    cdef dtype_t[:, :] probs2 = np.exp(cfg.logProbs2)
+    cdef dtype_t[:, :] emLogProbs = cfg.emLogProbs
+    cdef dtype_t[:, :] logPriors = cfg.pairEmissionModel.logPriors
+    cdef dtype_t[:] startProbs = cfg.startProbs
+    cdef np.uint8_t[:] isNest = cfg.nestMask
+    cdef itype_t W = dp.shape[0]
+    cdef itype_t chain = chainDp.shape[0] > 0
+    cdef dtype_t logProb = cfg.insideLogProb
+    cdef dtype_t[:, :] leftPost = np.zeros((nObs, M), dtype=np.float)
+    cdef dtype_t[:, :] rightPost = np.zeros((nObs, M), dtype=np.float)
+    cdef dtype_t[:] chainTotals = np.zeros((M,), dtype=np.float)
+    cdef itype_t defAlignmentSymbol = cfg.defAlignmentSymbol
+    cdef dtype_t* totals
+    cdef itype_t size
+    cdef itype_t match
+    cdef itype_t i
+    cdef itype_t j
+    cdef itype_t i2
+    cdef itype_t j2
+    cdef itype_t end
+    cdef itype_t r
+    cdef itype_t q
+    cdef itype_t y
+    cdef itype_t lState
+    cdef itype_t rState
+    cdef itype_t zState
+    cdef dtype_t ref
+    cdef dtype_t t
+    cdef dtype_t w
+    cdef dtype_t sub
+    cdef dtype_t best
+    cdef dtype_t leftScale
+    cdef dtype_t pairIn
+    cdef dtype_t pairPost
+
+    # prefixes longer than the band: their parents are longer prefixes
+    if chain != 0:
+        with nogil:
+            for end in xrange(nObs - 1, W - 1, -1):
+                ref = _NINF
+                if end == nObs - 1:
+                    for y in xrange(M):
+                        if startProbs[emittingStates[y]] > ref:
+                            ref = startProbs[emittingStates[y]]
+                for j2 in xrange(end + 1, min(end + W, nObs - 1) + 1):
+                    t = outChainScale[j2] + scale[j2 - end - 1, end + 1]
+                    if t > ref:
+                        ref = t
+                best = 0.
+                if ref > _NINF:
+                    for y in xrange(M):
+                        rState = emittingStates[y]
+                        chainTotals[rState] = 0.
+                        if end == nObs - 1:
+                            chainTotals[rState] = exp(startProbs[rState] - ref)
+                    for j2 in xrange(end + 1, min(end + W, nObs - 1) + 1):
+                        w = exp(outChainScale[j2] +
+                                scale[j2 - end - 1, end + 1] - ref)
+                        if w == 0.:
+                            continue
+                        for y in xrange(M):
+                            rState = emittingStates[y]
+                            sub = 0.
+                            for r in xrange(revLeftDim[rState]):
+                                lState = revLeft[rState, r, 0]
+                                zState = revLeft[rState, r, 1]
+                                sub = sub + probs1[lState, rState, zState] * \
+                                      outChainDp[j2, lState] * \
+                                      dp[j2 - end - 1, end + 1, zState]
+                            chainTotals[rState] += w * sub
+                    for y in xrange(M):
+                        if chainTotals[emittingStates[y]] > best:
+                            best = chainTotals[emittingStates[y]]
+                if best > 0.:
+                    outChainScale[end] = ref + log(best)
+                    for y in xrange(M):
+                        rState = emittingStates[y]
+                        outChainDp[end, rState] = chainTotals[rState] / best
+                else:
+                    outChainScale[end] = _NINF
+                    for y in xrange(M):
+                        outChainDp[end, y] = 0.
+
+    with nogil, parallel(num_threads=numThreads):
+        totals = <dtype_t*>malloc(sizeof(dtype_t) * M)
+        for size in xrange(W, 0, -1):
+            for i in prange(nObs + 1 - size, schedule='static'):
+                j = i + size - 1
+                # for the pair around the cell
+                match = 0
+                if i > 0 and j < nObs - 1:
+                    match = _pairMatch(alignmentTrack, baseMatch,
+                                       defAlignmentSymbol, i - 1, j + 1)
+                # the scale of the largest term
+                ref = _NINF
+                if size == nObs:
+                    for y in xrange(M):
+                        if startProbs[emittingStates[y]] > ref:
+                            ref = startProbs[emittingStates[y]]
+                for j2 in xrange(j + 1, min(i + W - 1, nObs - 1) + 1):
+                    t = outScale[j2 - i, i] + scale[j2 - j - 1, j + 1]
+                    if t > ref:
+                        ref = t
+                for i2 in xrange(max(0, j - W + 1), i):
+                    t = outScale[j - i2, i2] + scale[i - 1 - i2, i2]
+                    if t > ref:
+                        ref = t
+                if i > 0 and j < nObs - 1 and size + 2 <= W:
+                    for y in xrange(M):
+                        lState = emittingStates[y]
+                        if isNest[lState] != 0:
+                            t = outScale[size + 1, i - 1] + \
+                                emLogProbs[i - 1, lState] + \
+                                emLogProbs[j + 1, lState] + \
+                                logPriors[lState, match]
+                            if t > ref:
+                                ref = t
+                if chain != 0 and i == 0:
+                    for j2 in xrange(W, min(j + W, nObs - 1) + 1):
+                        t = outChainScale[j2] + scale[j2 - j - 1, j + 1]
+                        if t > ref:
+                            ref = t
+                if chain != 0 and i > 0 and j >= W:
+                    leftScale = scale[i - 1, 0] if i - 1 < W else \
+                                chainScale[i - 1]
+                    t = outChainScale[j] + leftScale
+                    if t > ref:
+                        ref = t
+
+                best = 0.
+                if ref > _NINF:
+                    for y in xrange(M):
+                        rState = emittingStates[y]
+                        totals[rState] = 0.
+                        if size == nObs:
+                            totals[rState] = exp(startProbs[rState] - ref)
+                    # left child of a band cell [i, j2]
+                    for j2 in xrange(j + 1, min(i + W - 1, nObs - 1) + 1):
+                        w = exp(outScale[j2 - i, i] +
+                                scale[j2 - j - 1, j + 1] - ref)
+                        for y in xrange(M):
+                            rState = emittingStates[y]
+                            sub = 0.
+                            for r in xrange(revLeftDim[rState]):
+                                lState = revLeft[rState, r, 0]
+                                zState = revLeft[rState, r, 1]
+                                sub = sub + probs1[lState, rState, zState] * \
+                                      outDp[j2 - i, i, lState] * \
+                                      dp[j2 - j - 1, j + 1, zState]
+                            totals[rState] += w * sub
+                    # right child of a band cell [i2, j]
+                    for i2 in xrange(max(0, j - W + 1), i):
+                        w = exp(outScale[j - i2, i2] +
+                                scale[i - 1 - i2, i2] - ref)
+                        for y in xrange(M):
+                            rState = emittingStates[y]
+                            sub = 0.
+                            for r in xrange(revRightDim[rState]):
+                                lState = revRight[rState, r, 0]
+                                zState = revRight[rState, r, 1]
+                                sub = sub + probs1[lState, zState, rState] * \
+                                      outDp[j - i2, i2, lState] * \
+                                      dp[i - 1 - i2, i2, zState]
+                            totals[rState] += w * sub
+                    # nested in a pair [i - 1, j + 1]
+                    if i > 0 and j < nObs - 1 and size + 2 <= W:
+                        for y in xrange(M):
+                            rState = emittingStates[y]
+                            for r in xrange(revPairDim[rState]):
+                                lState = revPair[rState, r, 0]
+                                totals[rState] += exp(
+                                    outScale[size + 1, i - 1] +
+                                    emLogProbs[i - 1, lState] +
+                                    emLogProbs[j + 1, lState] +
+                                    logPriors[lState, match] - ref) * \
+                                    probs2[lState, rState] * \
+                                    outDp[size + 1, i - 1, lState]
+                    # left child of a chained prefix [0, j2]
+                    if chain != 0 and i == 0:
+                        for j2 in xrange(W, min(j + W, nObs - 1) + 1):
+                            w = exp(outChainScale[j2] +
+                                    scale[j2 - j - 1, j + 1] - ref)
+                            for y in xrange(M):
+                                rState = emittingStates[y]
+                                sub = 0.
+                                for r in xrange(revLeftDim[rState]):
+                                    lState = revLeft[rState, r, 0]
+                                    zState = revLeft[rState, r, 1]
+                                    sub = sub + \
+                                          probs1[lState, rState, zState] * \
+                                          outChainDp[j2, lState] * \
+                                          dp[j2 - j - 1, j + 1, zState]
+                                totals[rState] += w * sub
+                    # right child of the chained prefix [0, j]
+                    if chain != 0 and i > 0 and j >= W:
+                        leftScale = scale[i - 1, 0] if i - 1 < W else \
+                                    chainScale[i - 1]
+                        w = exp(outChainScale[j] + leftScale - ref)
+                        for y in xrange(M):
+                            rState = emittingStates[y]
+                            sub = 0.
+                            for r in xrange(revRightDim[rState]):
+                                lState = revRight[rState, r, 0]
+                                zState = revRight[rState, r, 1]
+                                if i - 1 < W:
+                                    t = dp[i - 1, 0, zState]
+                                else:
+                                    t = chainDp[i - 1, zState]
+                                sub = sub + probs1[lState, zState, rState] * \
+                                      outChainDp[j, lState] * t
+                            totals[rState] += w * sub
+                    for y in xrange(M):
+                        if totals[emittingStates[y]] > best:
+                            best = totals[emittingStates[y]]
+                if best > 0.:
+                    outScale[size - 1, i] = ref + log(best)
+                    for y in xrange(M):
+                        rState = emittingStates[y]
+                        outDp[size - 1, i, rState] = totals[rState] / best
+                else:
+                    outScale[size - 1, i] = _NINF
+                    for y in xrange(M):
+                        outDp[size - 1, i, y] = 0.
+
+                # expected number of times the cell's columns are emitted
+                for y in xrange(M):
+                    rState = emittingStates[y]
+                    if outDp[size - 1, i, rState] == 0. or \
+                       (size == 1 and isNest[rState] != 0) or \
+                       (size > 1 and isNest[rState] == 0):
+                        continue
+                    if size == 1:
+                        posteriors[i, rState] = exp(
+                            outScale[0, i] + scale[0, i] - logProb) * \
+                            outDp[0, i, rState] * dp[0, i, rState]
+                        continue
+                    # X -> aa, or the sum of X -> aYa over Y
+                    pairIn = emLogProbs[i, rState] + emLogProbs[j, rState] + \
+                             logPriors[rState, _pairMatch(
+                                 alignmentTrack, baseMatch,
+                                 defAlignmentSymbol, i, j)]
                     if size > 2:
-                        for q in xrange(helperDim2[lState]):
-                            rState = helper2[lState, q]
-                            lp = logProbs2[lState, rState] +\
-                                 dp[i+1, j-1, rState] +\
-                                 emLogProbs[i, lState] +\
-                                 emLogProbs[j, lState] +\
-                                 logPriors[lState, match]
-                            #assert lp <= 0
-                            if lp > dp[i, j, lState]:
-                                dp[i, j, lState] = lp
-                                #tb[i, j, lState] = [PAIRFLAG, rState, rState]
-                                tb[i, j, lState, 0] = PAIRFLAG
-                                tb[i, j, lState, 1] = rState
-                                tb[i, j, lState, 2] = rState
+                        sub = 0.
+                        for q in xrange(helperDim2[rState]):
+                            zState = helper2[rState, q]
+                            sub = sub + probs2[rState, zState] * \
+                                  dp[size - 3, i + 1, zState]
+                        if sub == 0.:
+                            continue
+                        pairIn = pairIn + scale[size - 3, i + 1] + log(sub)
+                    pairPost = exp(outScale[size - 1, i] + pairIn - logProb) * \
+                               outDp[size - 1, i, rState]
+                    leftPost[i, rState] += pairPost
+                    rightPost[j, rState] += pairPost
+        free(totals)
+
+    for i in xrange(nObs):
+        for y in xrange(M):
+            rState = emittingStates[y]
+            posteriors[i, rState] += leftPost[i, rState] + \
+                                     rightPost[i, rState]
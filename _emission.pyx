@@ -2,6 +2,7 @@ from libc.math cimport exp, log
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel import prange
 from .track import TrackTable
 np.import_array()
 
@@ -18,7 +19,10 @@ def canFast(obs):
                                          obs.dtype == np.uint8))
         
 @cython.boundscheck(False)
-def fastAllLogProbs(obs, logProbs, outProbs, normalize, segRatios):
+def fastAllLogProbs(obs, logProbs, outProbs, normalize, segRatios,
+                    numThreads = 1):
+    """ Rows of the output are independent, so they are split across
+    numThreads OpenMP threads (when compiled with OpenMP support) """
     if isinstance(obs, TrackTable):
         obs = obs.getNumPyArray()
     assert isinstance(obs, np.ndarray)
@@ -33,16 +37,17 @@ def fastAllLogProbs(obs, logProbs, outProbs, normalize, segRatios):
     cdef itype_t nObs = obs.shape[0]
     cdef itype_t nTracks = obs.shape[1]
     cdef itype_t nStates = logProbs.shape[1]
+    numThreads = max(1, min(numThreads, nObs))
 
     if obs.dtype == np.int32:
         _fastAllLogProbs32(nObs, nTracks, nStates, obs, logProbs, outProbs,
-                           normalize, segRatios)
+                           normalize, segRatios, numThreads)
     elif obs.dtype == np.uint16:
         _fastAllLogProbsU16(nObs, nTracks, nStates, obs, logProbs, outProbs,
-                            normalize, segRatios)
+                            normalize, segRatios, numThreads)
     elif obs.dtype == np.uint8:
         _fastAllLogProbsU8(nObs, nTracks, nStates, obs, logProbs, outProbs,
-                           normalize, segRatios)
+                           normalize, segRatios, numThreads)
     else:
         print obs.dtype
         assert False
@@ -53,16 +58,18 @@ def _fastAllLogProbsU8(itype_t nObs, itype_t nTracks, itype_t nStates,
                       np.ndarray[dtype_t, ndim=3] logProbs,
                       np.ndarray[dtype_t, ndim=2] outProbs,
                       dtype_t normalize,
-                      np.ndarray[dtype_t, ndim=1] segRatios):
+                      np.ndarray[dtype_t, ndim=1] segRatios,
+                      int numThreads):
     cdef itype_t i, j, k
     cdef dtype_t minDbl = _MINDBL
-    cdef dtype_t maxProb = _MINDBL
+    cdef dtype_t maxProb
     cdef itype_t hasRatio = 0
     if segRatios is not None:
         hasRatio = 1
         
     with nogil:
-        for i in xrange(nObs):
+        for i in prange(nObs, num_threads=numThreads, schedule='static'):
+           maxProb = minDbl
            for j in xrange(nStates):
                outProbs[i,j] = 0.0
                for k in xrange(nTracks):
@@ -85,16 +92,18 @@ def _fastAllLogProbsU16(itype_t nObs, itype_t nTracks, itype_t nStates,
                         np.ndarray[dtype_t, ndim=3] logProbs,
                         np.ndarray[dtype_t, ndim=2] outProbs,
                         dtype_t normalize,
-                        np.ndarray[dtype_t, ndim=1] segRatios):
+                        np.ndarray[dtype_t, ndim=1] segRatios,
+                        int numThreads):
     cdef itype_t i, j, k
     cdef dtype_t minDbl = _MINDBL
-    cdef dtype_t maxProb = _MINDBL
+    cdef dtype_t maxProb
     cdef itype_t hasRatio = 0
     if segRatios is not None:
         hasRatio = 1
         
     with nogil:
-        for i in xrange(nObs):
+        for i in prange(nObs, num_threads=numThreads, schedule='static'):
+           maxProb = minDbl
            for j in xrange(nStates):
                outProbs[i,j] = 0.0
                for k in xrange(nTracks):
@@ -117,16 +126,18 @@ def _fastAllLogProbs32(itype_t nObs, itype_t nTracks, itype_t nStates,
                       np.ndarray[dtype_t, ndim=3] logProbs,
                       np.ndarray[dtype_t, ndim=2] outProbs,
                       dtype_t normalize,
-                      np.ndarray[dtype_t, ndim=1] segRatios):                      
+                      np.ndarray[dtype_t, ndim=1] segRatios,
+                      int numThreads):
     cdef itype_t i, j, k
     cdef dtype_t minDbl = _MINDBL
-    cdef dtype_t maxProb = _MINDBL
+    cdef dtype_t maxProb
     cdef itype_t hasRatio = 0
     if segRatios is not None:
         hasRatio = 1
         
     with nogil:
-        for i in xrange(nObs):
+        for i in prange(nObs, num_threads=numThreads, schedule='static'):
+           maxProb = minDbl
            for j in xrange(nStates):
                outProbs[i,j] = 0.0
                for k in xrange(nTracks):
@@ -144,7 +155,12 @@ def _fastAllLogProbs32(itype_t nObs, itype_t nTracks, itype_t nStates,
                    outProbs[i, j] = 0.0
 
 @cython.boundscheck(False)
-def fastAccumulateStats(obs, obsStats, posteriors, segRatios):
+def fastAccumulateStats(obs, obsStats, posteriors, segRatios,
+                        numThreads = 1):
+    """ With more than one thread, the observations are split into
+    numThreads contiguous blocks, each of which is accumulated into its own
+    copy of the statistics (so threads never write to the same memory).
+    The copies are summed into obsStats at the end"""
     if isinstance(obs, TrackTable):
         obs = obs.getNumPyArray()
     assert isinstance(obs, np.ndarray)
@@ -155,83 +171,120 @@ def fastAccumulateStats(obs, obsStats, posteriors, segRatios):
     cdef itype_t nTracks = obs.shape[1]
     cdef itype_t nStates = obsStats[0].shape[0]
 
+    numThreads = max(1, min(numThreads, nObs))
+    if numThreads == 1:
+        # a view, so we accumulate directly into obsStats
+        slabs = obsStats[np.newaxis]
+    else:
+        slabs = np.zeros((numThreads,) + obsStats.shape, dtype=np.float)
+
     if obs.dtype == np.int32:
-        _fastAccumulateStats32(nObs, nTracks, nStates, obs, obsStats,
-                               posteriors, segRatios)
+        _fastAccumulateStats32(nObs, nTracks, nStates, obs, slabs,
+                               posteriors, segRatios, numThreads)
     elif obs.dtype == np.uint16:
-        _fastAccumulateStatsU16(nObs, nTracks, nStates, obs, obsStats,
-                               posteriors, segRatios)
+        _fastAccumulateStatsU16(nObs, nTracks, nStates, obs, slabs,
+                               posteriors, segRatios, numThreads)
     elif obs.dtype == np.uint8:
-        _fastAccumulateStatsU8(nObs, nTracks, nStates, obs, obsStats,
-                               posteriors, segRatios)
+        _fastAccumulateStatsU8(nObs, nTracks, nStates, obs, slabs,
+                               posteriors, segRatios, numThreads)
     else:
         assert False
 
+    if numThreads > 1:
+        obsStats += np.sum(slabs, axis=0)
+
 @cython.boundscheck(False)
 def _fastAccumulateStatsU8(itype_t nObs, itype_t nTracks, itype_t nStates,
                            np.ndarray[np.uint8_t, ndim=2] obs, 
-                           np.ndarray[dtype_t, ndim=3] obsStats,
+                           np.ndarray[dtype_t, ndim=4] slabs,
                            np.ndarray[dtype_t, ndim=2] posteriors,
-                           np.ndarray[dtype_t, ndim=1] segRatios):
-    cdef itype_t i, track, state, obsVal
+                           np.ndarray[dtype_t, ndim=1] segRatios,
+                           int numThreads):
+    cdef itype_t i, track, state, obsVal, block, blockStart, blockEnd
+    cdef itype_t blockSize = nObs / numThreads
     cdef dtype_t segProb
     cdef itype_t hasRatio = 0
     if segRatios is not None:
         hasRatio = 1
 
     with nogil:
-        for i in xrange(nObs):
-            for track in xrange(nTracks):
-                obsVal = obs[i,track]
-                for state in xrange(nStates):
-                    segProb = posteriors[i, state]
-                    if hasRatio == 1:
-                        segProb *= segRatios[i]
-                    obsStats[track, state, obsVal] += segProb
+        # thread-private slab for each block of observations
+        for block in prange(numThreads, num_threads=numThreads,
+                            schedule='static'):
+            blockStart = blockSize * block
+            blockEnd = blockStart + blockSize
+            if block == numThreads - 1:
+                blockEnd = nObs
+            for i in xrange(blockStart, blockEnd):
+                for track in xrange(nTracks):
+                    obsVal = obs[i,track]
+                    for state in xrange(nStates):
+                        segProb = posteriors[i, state]
+                        if hasRatio == 1:
+                            segProb = segProb * segRatios[i]
+                        slabs[block, track, state, obsVal] += segProb
 
 @cython.boundscheck(False)
 def _fastAccumulateStatsU16(itype_t nObs, itype_t nTracks, itype_t nStates,
                            np.ndarray[np.uint16_t, ndim=2] obs, 
-                           np.ndarray[dtype_t, ndim=3] obsStats,
+                           np.ndarray[dtype_t, ndim=4] slabs,
                            np.ndarray[dtype_t, ndim=2] posteriors,
-                           np.ndarray[dtype_t, ndim=1] segRatios):
-    cdef itype_t i, track, state, obsVal
+                           np.ndarray[dtype_t, ndim=1] segRatios,
+                           int numThreads):
+    cdef itype_t i, track, state, obsVal, block, blockStart, blockEnd
+    cdef itype_t blockSize = nObs / numThreads
     cdef dtype_t segProb
     cdef itype_t hasRatio = 0
     if segRatios is not None:
         hasRatio = 1
 
     with nogil:
-        for i in xrange(nObs):
-            for track in xrange(nTracks):
-                obsVal = obs[i,track]
-                for state in xrange(nStates):
-                    segProb = posteriors[i, state]
-                    if hasRatio == 1:
-                        segProb *= segRatios[i]
-                    obsStats[track, state, obsVal] += segProb
+        # thread-private slab for each block of observations
+        for block in prange(numThreads, num_threads=numThreads,
+                            schedule='static'):
+            blockStart = blockSize * block
+            blockEnd = blockStart + blockSize
+            if block == numThreads - 1:
+                blockEnd = nObs
+            for i in xrange(blockStart, blockEnd):
+                for track in xrange(nTracks):
+                    obsVal = obs[i,track]
+                    for state in xrange(nStates):
+                        segProb = posteriors[i, state]
+                        if hasRatio == 1:
+                            segProb = segProb * segRatios[i]
+                        slabs[block, track, state, obsVal] += segProb
 
 @cython.boundscheck(False)
 def _fastAccumulateStats32(itype_t nObs, itype_t nTracks, itype_t nStates,
                             np.ndarray[np.int32_t, ndim=2] obs, 
-                            np.ndarray[dtype_t, ndim=3] obsStats,
+                            np.ndarray[dtype_t, ndim=4] slabs,
                             np.ndarray[dtype_t, ndim=2] posteriors,
-                            np.ndarray[dtype_t, ndim=1] segRatios):                            
-    cdef itype_t i, track, state, obsVal
+                            np.ndarray[dtype_t, ndim=1] segRatios,
+                            int numThreads):
+    cdef itype_t i, track, state, obsVal, block, blockStart, blockEnd
+    cdef itype_t blockSize = nObs / numThreads
     cdef dtype_t segProb
     cdef itype_t hasRatio = 0
     if segRatios is not None:
         hasRatio = 1
 
     with nogil:
-        for i in xrange(nObs):
-            for track in xrange(nTracks):
-                obsVal = obs[i,track]
-                for state in xrange(nStates):
-                    segProb = posteriors[i, state]
-                    if hasRatio == 1:
-                        segProb *= segRatios[i]
-                    obsStats[track, state, obsVal] += segProb
+        # thread-private slab for each block of observations
+        for block in prange(numThreads, num_threads=numThreads,
+                            schedule='static'):
+            blockStart = blockSize * block
+            blockEnd = blockStart + blockSize
+            if block == numThreads - 1:
+                blockEnd = nObs
+            for i in xrange(blockStart, blockEnd):
+                for track in xrange(nTracks):
+                    obsVal = obs[i,track]
+                    for state in xrange(nStates):
+                        segProb = posteriors[i, state]
+                        if hasRatio == 1:
+                            segProb = segProb * segRatios[i]
+                        slabs[block, track, state, obsVal] += segProb
 
 @cython.boundscheck(False)
 def fastUpdateCounts(bedInterval, trackTable, obsStats, segRatios):
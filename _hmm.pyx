@@ -203,12 +203,12 @@ def _viterbi(int n_observations, int n_components,
         np.ndarray[dtype_t, ndim=1] log_startprob,
         np.ndarray[dtype_t, ndim=2] log_transmat,
         np.ndarray[dtype_t, ndim=1] segRatios,
-        np.ndarray[dtype_t, ndim=2] framelogprob):
+        np.ndarray[dtype_t, ndim=2] framelogprob,
+        np.ndarray[dtype_t, ndim=2] viterbi_lattice=None,
+        np.ndarray[np.int16_t, ndim=2] trace_back=None):
 
     cdef int t, max_pos, hasRatios = 0
-    cdef np.ndarray[dtype_t, ndim = 2] viterbi_lattice
     cdef np.ndarray[np.int_t, ndim = 1] state_sequence
-    cdef np.ndarray[np.int16_t, ndim = 2] trace_back
     cdef dtype_t logprob
     cdef dtype_t maxprob
     cdef dtype_t curprob
@@ -216,15 +216,18 @@ def _viterbi(int n_observations, int n_components,
     if segRatios is not None:
         hasRatios = 1
 
-    # Initialization
+    # Initialization (lattice and traceback, both n_observations x
+    # n_components, can be passed in to avoid allocating them every call)
     state_sequence = np.empty(n_observations, dtype=np.int)
-    viterbi_lattice = np.zeros((n_observations, n_components))
+    if viterbi_lattice is None:
+        viterbi_lattice = np.zeros((n_observations, n_components))
     viterbi_lattice[0] = log_startprob + framelogprob[0]
     if hasRatios == 1 and segRatios[0] > 1.:
         for toState in xrange(0, n_components):
             viterbi_lattice[0, toState] += log_transmat[toState, toState] * (segRatios[0] - 1.)
 
-    trace_back = np.empty((n_observations, n_components), dtype=np.int16)
+    if trace_back is None:
+        trace_back = np.empty((n_observations, n_components), dtype=np.int16)
 
     # Induction
     for t in xrange(1, n_observations):
@@ -257,3 +260,688 @@ def _viterbi(int n_observations, int n_components,
         state_sequence[t - 1] = trace_back[t, state_sequence[t]]
 
     return state_sequence, logprob
+
+###############################################################################
+# Sparse versions of the above kernels.  Transition matrices learned from
+# supervised or semi-supervised (--initTransProbs / --forceTransProbs)
+# models are mostly zero, so it is a waste to visit all M^2 edges at each
+# position.  Instead, these kernels iterate over CSR-style lists of the
+# nonzero edges only: predPtr/predIdx give the predecessors i of each state j
+# (predIdx[predPtr[j]:predPtr[j+1]]) and succPtr/succIdx give the successors
+# j of each state i.  Index lists must be sorted in increasing order so that
+# Viterbi ties are broken exactly as in the dense version.  Absent edges
+# contribute nothing (rather than exp(-1e100)) so the results are the same
+# as the dense kernels up to unreachable (-inf vs -1e100) lattice cells.
+###############################################################################
+
+@cython.boundscheck(False)
+def _log_sum_lneta_sparse(int n_observations, int n_components,
+        np.ndarray[dtype_t, ndim=2] fwdlattice,
+        np.ndarray[dtype_t, ndim=2] log_transmat,
+        np.ndarray[dtype_t, ndim=2] bwdlattice,
+        np.ndarray[dtype_t, ndim=2] framelogprob,
+        double logprob,
+        np.ndarray[dtype_t, ndim=1] segRatios,
+        np.ndarray[np.int32_t, ndim=1] succPtr,
+        np.ndarray[np.int32_t, ndim=1] succIdx,
+        np.ndarray[dtype_t, ndim=2] logsum_lneta):
+    cdef int i, j, t, p, hasRatios = 0
+    cdef int n_edges = succPtr[n_components]
+    cdef np.ndarray[dtype_t, ndim = 1] edgeMax
+    cdef np.ndarray[dtype_t, ndim = 1] edgeSum
+    cdef double x, y
+    edgeMax = _NINF + np.zeros(n_edges)
+    edgeSum = np.zeros(n_edges)
+    if segRatios is not None:
+        hasRatios = 1
+
+    with nogil:
+        # find max
+        for t in range(n_observations - 1):
+            for i in range(n_components):
+                for p in range(succPtr[i], succPtr[i + 1]):
+                    j = succIdx[p]
+                    x = fwdlattice[t, i] + log_transmat[i, j] \
+                      + framelogprob[t + 1, j] + bwdlattice[t + 1, j] - logprob
+                    if hasRatios == 1 and segRatios[t + 1] > 1.:
+                        x += log_transmat[j, j] * (segRatios[t + 1] - 1.)
+                        if i == j:
+                            y = fwdlattice[t + 1, i] + bwdlattice[t + 1, j] + \
+                              log(segRatios[t + 1] - 1.) - logprob
+                            if y > edgeMax[p]:
+                                edgeMax[p] = y
+                    if x > edgeMax[p]:
+                        edgeMax[p] = x
+
+        # sum exp(x - max)
+        for t in range(n_observations - 1):
+            for i in range(n_components):
+                for p in range(succPtr[i], succPtr[i + 1]):
+                    if edgeMax[p] == _NINF:
+                        continue
+                    j = succIdx[p]
+                    x = fwdlattice[t, i] + log_transmat[i, j] \
+                      + framelogprob[t + 1, j] + bwdlattice[t + 1, j] - logprob
+                    if hasRatios == 1 and segRatios[t + 1] > 1.:
+                        x += log_transmat[j, j] * (segRatios[t + 1] - 1.)
+                        if i == j:
+                            y = fwdlattice[t + 1, i] + bwdlattice[t + 1, j] + \
+                              log(segRatios[t + 1] - 1.) - logprob
+                            edgeSum[p] += exp(y - edgeMax[p])
+                    edgeSum[p] += exp(x - edgeMax[p])
+
+        # return log(sum(x-max)) + max, leaving -inf for absent edges
+        for i in range(n_components):
+            for j in range(n_components):
+                logsum_lneta[i, j] = _NINF
+            for p in range(succPtr[i], succPtr[i + 1]):
+                if edgeMax[p] != _NINF:
+                    logsum_lneta[i, succIdx[p]] = log(edgeSum[p]) + edgeMax[p]
+
+@cython.boundscheck(False)
+def _forward_sparse(int n_observations, int n_components,
+        np.ndarray[dtype_t, ndim=1] log_startprob,
+        np.ndarray[dtype_t, ndim=2] log_transmat,
+        np.ndarray[dtype_t, ndim=2] framelogprob,
+        np.ndarray[dtype_t, ndim=1] segRatios,
+        np.ndarray[np.int32_t, ndim=1] predPtr,
+        np.ndarray[np.int32_t, ndim=1] predIdx,
+        np.ndarray[dtype_t, ndim=2] fwdlattice):
+
+    cdef int t, i, j, p, hasRatios = 0
+    cdef dtype_t vmax = 0
+    cdef dtype_t power_sum = 0.0
+    cdef dtype_t selfFac = 0.0
+    cdef double* work_buffer = <double *> \
+      malloc((n_components + 1) * cython.sizeof(double))
+    if segRatios is not None:
+        hasRatios = 1
+
+    with nogil:
+        for i in xrange(n_components):
+            fwdlattice[0, i] = log_startprob[i] + framelogprob[0, i]
+            if hasRatios == 1 and segRatios[0] > 1.:
+                fwdlattice[0, i] += log_transmat[i, i] * (segRatios[0] - 1.)
+
+        for t in xrange(1, n_observations):
+            for j in xrange(n_components):
+                selfFac = 0.0
+                if hasRatios == 1 and segRatios[t] > 1.:
+                    selfFac = log_transmat[j, j] * (segRatios[t] - 1.)
+                vmax = _NINF
+                for p in xrange(predPtr[j], predPtr[j + 1]):
+                    i = predIdx[p]
+                    work_buffer[p - predPtr[j]] = fwdlattice[t - 1, i] + \
+                      log_transmat[i, j] + selfFac
+                    if work_buffer[p - predPtr[j]] > vmax:
+                        vmax = work_buffer[p - predPtr[j]]
+                if vmax == _NINF:
+                    fwdlattice[t, j] = _NINF
+                    continue
+                power_sum = 0.0
+                for p in xrange(0, predPtr[j + 1] - predPtr[j]):
+                    power_sum += exp(work_buffer[p] - vmax)
+                fwdlattice[t, j] = log(power_sum) + vmax + framelogprob[t, j]
+                if fwdlattice[t, j] <= ZEROLOGPROB:
+                    fwdlattice[t, j] = _NINF
+        free(work_buffer)
+
+@cython.boundscheck(False)
+def _backward_sparse(int n_observations, int n_components,
+        np.ndarray[dtype_t, ndim=1] log_startprob,
+        np.ndarray[dtype_t, ndim=2] log_transmat,
+        np.ndarray[dtype_t, ndim=2] framelogprob,
+        np.ndarray[dtype_t, ndim=1] segRatios,
+        np.ndarray[np.int32_t, ndim=1] succPtr,
+        np.ndarray[np.int32_t, ndim=1] succIdx,
+        np.ndarray[dtype_t, ndim=2] bwdlattice):
+
+    cdef int t, i, j, p, hasRatios = 0
+    cdef dtype_t vmax = 0
+    cdef dtype_t power_sum = 0.0
+    cdef double* work_buffer = <double *> \
+      malloc((n_components + 1) * cython.sizeof(double))
+    if segRatios is not None:
+        hasRatios = 1
+
+    with nogil:
+        for i in xrange(n_components):
+            bwdlattice[n_observations - 1, i] = log(1. / float(n_components))
+
+        for t in xrange(n_observations - 2, -1, -1):
+            for i in xrange(n_components):
+                vmax = _NINF
+                for p in xrange(succPtr[i], succPtr[i + 1]):
+                    j = succIdx[p]
+                    work_buffer[p - succPtr[i]] = log_transmat[i, j] + \
+                      framelogprob[t + 1, j] + bwdlattice[t + 1, j]
+                    if hasRatios == 1 and segRatios[t+1] > 1.:
+                        work_buffer[p - succPtr[i]] += \
+                          log_transmat[j, j] * (segRatios[t+1] - 1.)
+                    if work_buffer[p - succPtr[i]] > vmax:
+                        vmax = work_buffer[p - succPtr[i]]
+                if vmax == _NINF:
+                    bwdlattice[t, i] = _NINF
+                    continue
+                power_sum = 0.0
+                for p in xrange(0, succPtr[i + 1] - succPtr[i]):
+                    power_sum += exp(work_buffer[p] - vmax)
+                bwdlattice[t, i] = log(power_sum) + vmax
+                if bwdlattice[t, i] <= ZEROLOGPROB:
+                    bwdlattice[t, i] = _NINF
+
+        free(work_buffer)
+
+@cython.boundscheck(False)
+def _viterbi_sparse(int n_observations, int n_components,
+        np.ndarray[dtype_t, ndim=1] log_startprob,
+        np.ndarray[dtype_t, ndim=2] log_transmat,
+        np.ndarray[dtype_t, ndim=1] segRatios,
+        np.ndarray[dtype_t, ndim=2] framelogprob,
+        np.ndarray[np.int32_t, ndim=1] predPtr,
+        np.ndarray[np.int32_t, ndim=1] predIdx,
+        np.ndarray[dtype_t, ndim=2] viterbi_lattice=None,
+        np.ndarray[np.int16_t, ndim=2] trace_back=None):
+
+    cdef int t, p, max_pos, fromState, toState, hasRatios = 0
+    cdef np.ndarray[np.int_t, ndim = 1] state_sequence
+    cdef dtype_t logprob
+    cdef dtype_t maxprob
+    cdef dtype_t curprob
+    cdef np.int16_t maxState
+    if segRatios is not None:
+        hasRatios = 1
+
+    # Initialization (see _viterbi)
+    state_sequence = np.empty(n_observations, dtype=np.int)
+    if viterbi_lattice is None:
+        viterbi_lattice = np.zeros((n_observations, n_components))
+    viterbi_lattice[0] = log_startprob + framelogprob[0]
+    if hasRatios == 1 and segRatios[0] > 1.:
+        for toState in xrange(0, n_components):
+            viterbi_lattice[0, toState] += log_transmat[toState, toState] * (segRatios[0] - 1.)
+
+    if trace_back is None:
+        trace_back = np.empty((n_observations, n_components), dtype=np.int16)
+
+    # Induction (segment ratio terms for fromState 0 mirror _viterbi exactly)
+    with nogil:
+        for t in xrange(1, n_observations):
+            for toState in xrange(0, n_components):
+                maxprob = _NINF
+                maxState = 0
+                for p in xrange(predPtr[toState], predPtr[toState + 1]):
+                    fromState = predIdx[p]
+                    curprob = viterbi_lattice[t-1, fromState] + \
+                      log_transmat[fromState, toState] +\
+                      framelogprob[t, toState]
+                    if hasRatios == 1:
+                        if fromState == 0:
+                            curprob += log_transmat[toState, toState] * segRatios[t]
+                            if 0 == toState:
+                                curprob -= log_transmat[0, toState]
+                        elif segRatios[t] > 1.:
+                            curprob += log_transmat[toState, toState] * (segRatios[t] - 1.)
+                    if p == predPtr[toState] or curprob > maxprob:
+                        maxprob = curprob
+                        maxState = fromState
+                viterbi_lattice[t, toState] = maxprob
+                trace_back[t, toState] = maxState
+
+    # Observation traceback
+    max_pos = np.argmax(viterbi_lattice[n_observations - 1, :])
+    state_sequence[n_observations - 1] = max_pos
+    logprob = viterbi_lattice[n_observations - 1, max_pos]
+
+    for t in xrange(n_observations - 1, 0, -1):
+        state_sequence[t - 1] = trace_back[t, state_sequence[t]]
+
+    return state_sequence, logprob
+
+###############################################################################
+# Fused E-step.  Rather than computing the full backward lattice, then the
+# N x M posterior matrix (in numpy), then walking everything twice more in
+# _log_sum_lneta and once more in fastAccumulateStats, we do it all during
+# the backward sweep.  Only two rows of the backward lattice are ever kept.
+# At each column we compute the posterior, add it into the start and
+# emission statistics, and add the expected transition counts using an
+# online log-sum-exp (running max and rescaled sum) for each edge.  Edges
+# are given as successor lists (see sparse kernels above); pass all M^2 of
+# them for a dense matrix.
+###############################################################################
+
+ctypedef fused obs_t:
+    np.uint8_t
+    np.uint16_t
+    np.int32_t
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _fused_estep(int n_observations, int n_components,
+        np.ndarray[dtype_t, ndim=2] fwdlattice,
+        np.ndarray[dtype_t, ndim=2] log_transmat,
+        np.ndarray[dtype_t, ndim=2] framelogprob,
+        np.ndarray[obs_t, ndim=2] obs,
+        np.ndarray[dtype_t, ndim=1] segRatios,
+        double logprob,
+        np.ndarray[np.int32_t, ndim=1] succPtr,
+        np.ndarray[np.int32_t, ndim=1] succIdx,
+        int doStart, int doTrans, int doEmissions,
+        np.ndarray[dtype_t, ndim=1] startStats,
+        np.ndarray[dtype_t, ndim=2] transStats,
+        np.ndarray[dtype_t, ndim=3] obsStats):
+
+    cdef int t, i, j, p, k, hasRatios = 0
+    cdef int n_tracks = obs.shape[1]
+    cdef int n_edges = succPtr[n_components]
+    cdef dtype_t vmax, power_sum, x, y, gmax, gsum, post, ratio
+    cdef np.ndarray[dtype_t, ndim = 1] edgeMax
+    cdef np.ndarray[dtype_t, ndim = 1] edgeSum
+    cdef np.ndarray[dtype_t, ndim = 2] bwdRows
+    cdef dtype_t* bwdCur
+    cdef dtype_t* bwdNext
+    cdef dtype_t* tmp
+    cdef double* work_buffer = <double *> \
+      malloc((n_components + 1) * cython.sizeof(double))
+    edgeMax = _NINF + np.zeros(n_edges)
+    edgeSum = np.zeros(n_edges)
+    bwdRows = np.zeros((2, n_components))
+    bwdCur = <dtype_t*>bwdRows.data
+    bwdNext = bwdCur + n_components
+    if segRatios is not None:
+        hasRatios = 1
+    assert obs.shape[0] == n_observations
+
+    with nogil:
+        for t in xrange(n_observations - 1, -1, -1):
+            if t == n_observations - 1:
+                for i in xrange(n_components):
+                    bwdCur[i] = log(1. / float(n_components))
+            else:
+                # backward recursion from row t + 1
+                for i in xrange(n_components):
+                    vmax = _NINF
+                    for p in xrange(succPtr[i], succPtr[i + 1]):
+                        j = succIdx[p]
+                        work_buffer[p - succPtr[i]] = log_transmat[i, j] + \
+                          framelogprob[t + 1, j] + bwdNext[j]
+                        if hasRatios == 1 and segRatios[t + 1] > 1.:
+                            work_buffer[p - succPtr[i]] += \
+                              log_transmat[j, j] * (segRatios[t + 1] - 1.)
+                        if work_buffer[p - succPtr[i]] > vmax:
+                            vmax = work_buffer[p - succPtr[i]]
+                    if vmax == _NINF:
+                        bwdCur[i] = _NINF
+                        continue
+                    power_sum = 0.0
+                    for p in xrange(0, succPtr[i + 1] - succPtr[i]):
+                        power_sum += exp(work_buffer[p] - vmax)
+                    bwdCur[i] = log(power_sum) + vmax
+                    if bwdCur[i] <= ZEROLOGPROB:
+                        bwdCur[i] = _NINF
+
+                # expected transitions between t and t + 1
+                if doTrans == 1:
+                    for i in xrange(n_components):
+                        for p in xrange(succPtr[i], succPtr[i + 1]):
+                            j = succIdx[p]
+                            x = fwdlattice[t, i] + log_transmat[i, j] \
+                              + framelogprob[t + 1, j] + bwdNext[j] - logprob
+                            if hasRatios == 1 and segRatios[t + 1] > 1.:
+                                x += log_transmat[j, j] * \
+                                  (segRatios[t + 1] - 1.)
+                                if i == j:
+                                    y = fwdlattice[t + 1, i] + bwdNext[j] + \
+                                      log(segRatios[t + 1] - 1.) - logprob
+                                    if y > edgeMax[p]:
+                                        edgeSum[p] = edgeSum[p] * \
+                                          exp(edgeMax[p] - y) + 1.
+                                        edgeMax[p] = y
+                                    elif y != _NINF:
+                                        edgeSum[p] += exp(y - edgeMax[p])
+                            if x > edgeMax[p]:
+                                edgeSum[p] = edgeSum[p] * \
+                                  exp(edgeMax[p] - x) + 1.
+                                edgeMax[p] = x
+                            elif x != _NINF:
+                                edgeSum[p] += exp(x - edgeMax[p])
+
+            # posteriors for column t
+            gmax = _NINF
+            for i in xrange(n_components):
+                work_buffer[i] = fwdlattice[t, i] + bwdCur[i]
+                if work_buffer[i] > gmax:
+                    gmax = work_buffer[i]
+            gsum = 0.0
+            for i in xrange(n_components):
+                gsum += exp(work_buffer[i] - gmax)
+            gmax += log(gsum)
+            ratio = 1.
+            if hasRatios == 1:
+                ratio = segRatios[t]
+            for i in xrange(n_components):
+                post = exp(work_buffer[i] - gmax)
+                if doStart == 1 and t == 0:
+                    startStats[i] += post
+                if doEmissions == 1:
+                    post *= ratio
+                    for k in xrange(n_tracks):
+                        obsStats[k, i, obs[t, k]] += post
+
+            tmp = bwdNext
+            bwdNext = bwdCur
+            bwdCur = tmp
+
+        if doTrans == 1:
+            for i in xrange(n_components):
+                for p in xrange(succPtr[i], succPtr[i + 1]):
+                    if edgeMax[p] != _NINF:
+                        transStats[i, succIdx[p]] += \
+                          exp(log(edgeSum[p]) + edgeMax[p])
+        free(work_buffer)
+
+###############################################################################
+# Semiring matrix kernels for run-length compressed inference (see
+# TransferPowers in hmm.py).  A run of L identical columns is equivalent to
+# multiplying by the L-th power of the transfer matrix A[i,j] =
+# log_transmat[i,j] + framelogprob[j], either in the log sum-product
+# semiring (forward/backward) or the max-plus semiring (Viterbi).  All
+# functions are robust to -inf entries (ie zero probabilities).
+###############################################################################
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _log_matmul(np.ndarray[dtype_t, ndim=2] A,
+                np.ndarray[dtype_t, ndim=2] B,
+                np.ndarray[dtype_t, ndim=2] out):
+    """ out[i,j] = log(sum_m exp(A[i,m] + B[m,j])) """
+    cdef int i, j, m
+    cdef int n = A.shape[0]
+    cdef dtype_t vmax, power_sum
+    with nogil:
+        for i in range(n):
+            for j in range(n):
+                vmax = _NINF
+                for m in range(n):
+                    if A[i, m] + B[m, j] > vmax:
+                        vmax = A[i, m] + B[m, j]
+                if vmax == _NINF:
+                    out[i, j] = _NINF
+                    continue
+                power_sum = 0.0
+                for m in range(n):
+                    power_sum += exp(A[i, m] + B[m, j] - vmax)
+                out[i, j] = log(power_sum) + vmax
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _max_matmul(np.ndarray[dtype_t, ndim=2] A,
+                np.ndarray[dtype_t, ndim=2] B,
+                np.ndarray[dtype_t, ndim=2] out,
+                np.ndarray[np.int32_t, ndim=2] argOut):
+    """ out[i,j] = max_m A[i,m] + B[m,j] and argOut[i,j] = the (first)
+    m that achieves it """
+    cdef int i, j, m
+    cdef int n = A.shape[0]
+    cdef dtype_t vmax
+    with nogil:
+        for i in range(n):
+            for j in range(n):
+                vmax = A[i, 0] + B[0, j]
+                argOut[i, j] = 0
+                for m in range(1, n):
+                    if A[i, m] + B[m, j] > vmax:
+                        vmax = A[i, m] + B[m, j]
+                        argOut[i, j] = m
+                out[i, j] = vmax
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _log_vecmat(np.ndarray[dtype_t, ndim=1] v,
+                np.ndarray[dtype_t, ndim=2] A,
+                np.ndarray[dtype_t, ndim=1] out):
+    """ out[j] = log(sum_i exp(v[i] + A[i,j])) (out must not alias v) """
+    cdef int i, j
+    cdef int n = A.shape[0]
+    cdef dtype_t vmax, power_sum
+    with nogil:
+        for j in range(n):
+            vmax = _NINF
+            for i in range(n):
+                if v[i] + A[i, j] > vmax:
+                    vmax = v[i] + A[i, j]
+            if vmax == _NINF:
+                out[j] = _NINF
+                continue
+            power_sum = 0.0
+            for i in range(n):
+                power_sum += exp(v[i] + A[i, j] - vmax)
+            out[j] = log(power_sum) + vmax
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _log_matvec(np.ndarray[dtype_t, ndim=2] A,
+                np.ndarray[dtype_t, ndim=1] v,
+                np.ndarray[dtype_t, ndim=1] out):
+    """ out[i] = log(sum_j exp(A[i,j] + v[j])) (out must not alias v) """
+    cdef int i, j
+    cdef int n = A.shape[0]
+    cdef dtype_t vmax, power_sum
+    with nogil:
+        for i in range(n):
+            vmax = _NINF
+            for j in range(n):
+                if A[i, j] + v[j] > vmax:
+                    vmax = A[i, j] + v[j]
+            if vmax == _NINF:
+                out[i] = _NINF
+                continue
+            power_sum = 0.0
+            for j in range(n):
+                power_sum += exp(A[i, j] + v[j] - vmax)
+            out[i] = log(power_sum) + vmax
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _max_vecmat(np.ndarray[dtype_t, ndim=1] v,
+                np.ndarray[dtype_t, ndim=2] A,
+                np.ndarray[dtype_t, ndim=1] out,
+                np.ndarray[np.int32_t, ndim=1] argOut):
+    """ out[j] = max_i v[i] + A[i,j] and argOut[j] = the (first) i that
+    achieves it (out must not alias v) """
+    cdef int i, j
+    cdef int n = A.shape[0]
+    cdef dtype_t vmax
+    with nogil:
+        for j in range(n):
+            vmax = v[0] + A[0, j]
+            argOut[j] = 0
+            for i in range(1, n):
+                if v[i] + A[i, j] > vmax:
+                    vmax = v[i] + A[i, j]
+                    argOut[j] = i
+            out[j] = vmax
+
+cdef void _expand_path_rec(np.int32_t* mids, int n, int k, int i, int j,
+                           np.int_t* out) nogil:
+    # mids is a (K x n x n) array where mids[k] is the argmax midpoint
+    # table for squaring A^(2^(k-1)) into A^(2^k)
+    cdef int m
+    if k == 0:
+        out[0] = j
+    else:
+        m = mids[(k * n + i) * n + j]
+        _expand_path_rec(mids, n, k - 1, i, m, out)
+        _expand_path_rec(mids, n, k - 1, m, j, out + (1 << (k - 1)))
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _expand_path(np.ndarray[np.int32_t, ndim=3] mids, int k, int i, int j,
+                 np.ndarray[np.int_t, ndim=1] state_sequence, int start):
+    """ Write the best path of 2^k states through A^(2^k) from state i
+    (before the first position) to state j (at the last position) into
+    state_sequence[start : start + 2^k] """
+    cdef int n = mids.shape[1]
+    assert k < mids.shape[0] and start + (1 << k) <= state_sequence.shape[0]
+    assert mids.flags['C_CONTIGUOUS'] and state_sequence.flags['C_CONTIGUOUS']
+    _expand_path_rec(<np.int32_t*>mids.data, n, k, i, j,
+                     (<np.int_t*>state_sequence.data) + start)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _forward_steps(np.ndarray[dtype_t, ndim=1] alpha,
+                   np.ndarray[dtype_t, ndim=2] log_transmat,
+                   np.ndarray[dtype_t, ndim=2] framelogprob):
+    """ Advance the forward vector alpha (in place) over each row of
+    framelogprob in turn """
+    cdef int t, i, j
+    cdef int n = alpha.shape[0]
+    cdef dtype_t vmax, power_sum
+    cdef np.ndarray[dtype_t, ndim=1] prev = np.empty(n)
+    with nogil:
+        for t in range(framelogprob.shape[0]):
+            for i in range(n):
+                prev[i] = alpha[i]
+            for j in range(n):
+                vmax = _NINF
+                for i in range(n):
+                    if prev[i] + log_transmat[i, j] > vmax:
+                        vmax = prev[i] + log_transmat[i, j]
+                if vmax == _NINF:
+                    alpha[j] = _NINF
+                    continue
+                power_sum = 0.0
+                for i in range(n):
+                    power_sum += exp(prev[i] + log_transmat[i, j] - vmax)
+                alpha[j] = log(power_sum) + vmax + framelogprob[t, j]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _backward_steps(np.ndarray[dtype_t, ndim=1] beta,
+                    np.ndarray[dtype_t, ndim=2] log_transmat,
+                    np.ndarray[dtype_t, ndim=2] framelogprob):
+    """ Move the backward vector beta (in place) back over each row of
+    framelogprob, last row first, so that it ends up at the position
+    before the first row """
+    cdef int t, i, j
+    cdef int n = beta.shape[0]
+    cdef dtype_t vmax, power_sum
+    cdef np.ndarray[dtype_t, ndim=1] prev = np.empty(n)
+    with nogil:
+        for t in range(framelogprob.shape[0] - 1, -1, -1):
+            for j in range(n):
+                prev[j] = beta[j] + framelogprob[t, j]
+            for i in range(n):
+                vmax = _NINF
+                for j in range(n):
+                    if log_transmat[i, j] + prev[j] > vmax:
+                        vmax = log_transmat[i, j] + prev[j]
+                if vmax == _NINF:
+                    beta[i] = _NINF
+                    continue
+                power_sum = 0.0
+                for j in range(n):
+                    power_sum += exp(log_transmat[i, j] + prev[j] - vmax)
+                beta[i] = log(power_sum) + vmax
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _viterbi_steps(np.ndarray[dtype_t, ndim=1] delta,
+                   np.ndarray[dtype_t, ndim=2] log_transmat,
+                   np.ndarray[dtype_t, ndim=2] framelogprob,
+                   np.ndarray[np.int16_t, ndim=2] trace_back):
+    """ Advance the Viterbi vector delta (in place) over each row of
+    framelogprob in turn, storing the traceback pointers of each row """
+    cdef int t, i, j
+    cdef int n = delta.shape[0]
+    cdef dtype_t vmax
+    cdef np.ndarray[dtype_t, ndim=1] prev = np.empty(n)
+    with nogil:
+        for t in range(framelogprob.shape[0]):
+            for i in range(n):
+                prev[i] = delta[i]
+            for j in range(n):
+                vmax = prev[0] + log_transmat[0, j]
+                trace_back[t, j] = 0
+                for i in range(1, n):
+                    if prev[i] + log_transmat[i, j] > vmax:
+                        vmax = prev[i] + log_transmat[i, j]
+                        trace_back[t, j] = i
+                delta[j] = vmax + framelogprob[t, j]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _stretch_posteriors(np.ndarray[dtype_t, ndim=1] alphaIn,
+                        np.ndarray[dtype_t, ndim=1] betaOut,
+                        np.ndarray[dtype_t, ndim=2] log_transmat,
+                        np.ndarray[dtype_t, ndim=2] framelogprob,
+                        np.ndarray[dtype_t, ndim=2] posteriors):
+    """ Expand the (normalized) posteriors of a stretch of positions given
+    the forward vector alphaIn just before its first position (or None if
+    the stretch starts the sequence, in which case the first row of
+    posteriors must contain the forward vector of position 0 as input)
+    and the backward vector betaOut at its last position.  framelogprob
+    and posteriors must have one row per position in the stretch. """
+    cdef int t, i, j
+    cdef int n = log_transmat.shape[0]
+    cdef int length = framelogprob.shape[0]
+    cdef int first = 0
+    cdef int cur = 0
+    cdef dtype_t vmax, power_sum
+    cdef np.ndarray[dtype_t, ndim=2] beta = np.empty((2, n))
+    cdef np.ndarray[dtype_t, ndim=1] prev = np.empty(n)
+    if alphaIn is None:
+        first = 1
+    else:
+        prev[:] = alphaIn
+    with nogil:
+        # forward vectors stored directly in the posterior rows
+        for t in range(first, length):
+            if t > 0:
+                for i in range(n):
+                    prev[i] = posteriors[t - 1, i]
+            for j in range(n):
+                vmax = _NINF
+                for i in range(n):
+                    if prev[i] + log_transmat[i, j] > vmax:
+                        vmax = prev[i] + log_transmat[i, j]
+                if vmax == _NINF:
+                    posteriors[t, j] = _NINF
+                    continue
+                power_sum = 0.0
+                for i in range(n):
+                    power_sum += exp(prev[i] + log_transmat[i, j] - vmax)
+                posteriors[t, j] = log(power_sum) + vmax + framelogprob[t, j]
+        # backward pass, combining into normalized posteriors as we go
+        for i in range(n):
+            beta[cur, i] = betaOut[i]
+        for t in range(length - 1, -1, -1):
+            if t < length - 1:
+                for i in range(n):
+                    vmax = _NINF
+                    for j in range(n):
+                        if log_transmat[i, j] + framelogprob[t + 1, j] + \
+                          beta[1 - cur, j] > vmax:
+                            vmax = log_transmat[i, j] + \
+                              framelogprob[t + 1, j] + beta[1 - cur, j]
+                    if vmax == _NINF:
+                        beta[cur, i] = _NINF
+                        continue
+                    power_sum = 0.0
+                    for j in range(n):
+                        power_sum += exp(log_transmat[i, j] +
+                                         framelogprob[t + 1, j] +
+                                         beta[1 - cur, j] - vmax)
+                    beta[cur, i] = log(power_sum) + vmax
+            vmax = _NINF
+            for i in range(n):
+                posteriors[t, i] += beta[cur, i]
+                if posteriors[t, i] > vmax:
+                    vmax = posteriors[t, i]
+            power_sum = 0.0
+            for i in range(n):
+                posteriors[t, i] = exp(posteriors[t, i] - vmax)
+                power_sum += posteriors[t, i]
+            for i in range(n):
+                posteriors[t, i] /= power_sum
+            cur = 1 - cur
@@ -24,3 +24,185 @@ def runSum(np.ndarray[np.uint8_t, ndim=1] mask,
             if mask[i] == 0:
                 runningSum += 1
     
+
+ctypedef fused track_t:
+    np.uint8_t
+    np.uint16_t
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def segmentFirstScan(track_t[:, :] data, np.uint8_t[:] ignoreMask,
+                     np.uint8_t[:] cutMask, itype_t thresh, itype_t maxLen,
+                     np.uint8_t[:] outCuts):
+    """ Scan for segmentTracks.py --comp first.  Each column is compared
+    with the first column of its segment, so unlike --comp prev, where a
+    segment starts depends on where the last one did.  outCuts[i] is set to
+    1 if a new segment starts at column i because more than thresh
+    (non-ignored) tracks, or any cut track, changed, 2 if it starts because
+    the segment reached maxLen (<= 0 for no max), and 0 otherwise"""
+    cdef itype_t N = data.shape[0]
+    cdef itype_t numTracks = data.shape[1]
+    cdef itype_t first = 0
+    cdef itype_t difCount
+    cdef itype_t cutFound
+    cdef itype_t i
+    cdef itype_t j
+    assert N == len(outCuts)
+    assert numTracks == len(ignoreMask) and numTracks == len(cutMask)
+
+    with nogil:
+        if N > 0:
+            outCuts[0] = 0
+        for i in xrange(1, N):
+            outCuts[i] = 0
+            if maxLen > 0 and i - first >= maxLen:
+                outCuts[i] = 2
+            else:
+                difCount = 0
+                cutFound = 0
+                for j in xrange(numTracks):
+                    if ignoreMask[j] == 0 and data[i, j] != data[first, j]:
+                        difCount += 1
+                        if cutMask[j] != 0:
+                            cutFound = 1
+                if cutFound != 0 or difCount > thresh:
+                    outCuts[i] = 1
+            if outCuts[i] != 0:
+                first = i
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def peltSegment(track_t[:, :] data, np.int64_t[:] runStarts,
+                np.uint8_t[:] isForced, itype_t[:] catTracks,
+                itype_t[:] catOffsets, dtype_t[:, :] gaussValues,
+                dtype_t penalty):
+    """ Optimal segmentation for segmentTracks.py --pelt: minimize the sum of
+    the segments' costs plus penalty for each segment, with the PELT pruned
+    dynamic programming (Killick, Fearnhead and Eckley 2012).  The cost of a
+    segment is the number of its columns that differ from its most common
+    value in each of the catTracks, plus the sum of squared differences from
+    its mean in each column of gaussValues (the real values of the gaussian
+    tracks, with NaN for missing data, which costs nothing).  Both costs only go down when a
+    segment is split, so a candidate segment start can be dropped for good
+    as soon as it can't beat the best segmentation up to the current column.
+
+    The table is given as runs of identical columns (starting at
+    runStarts, which ends with len(data)).  These costs are concave in the
+    position of a cut inside a run, so an optimal segmentation only cuts
+    between runs.  A run with isForced set always starts a new segment.
+    catOffsets[k] is where the symbol counts of catTracks[k] start in the
+    count table of a candidate (catOffsets[len(catTracks)] is its size).
+    Returns the array of columns (other than 0) where a segment starts """
+    cdef itype_t numRuns = len(runStarts) - 1
+    cdef itype_t numCat = len(catTracks)
+    cdef itype_t numGauss = gaussValues.shape[1]
+    cdef itype_t numSymbols = max(catOffsets[numCat], 1)
+    cdef dtype_t[:] F = np.zeros((numRuns + 1,), dtype=np.float)
+    cdef np.int64_t[:] back = np.zeros((numRuns + 1,), dtype=np.int64)
+    # statistics of each segment start that's still a candidate
+    cdef itype_t capacity = 16
+    cdef itype_t numCand = 1
+    cdef np.int64_t[:] candStart = np.zeros((capacity,), dtype=np.int64)
+    cdef np.int64_t[:] candLen = np.zeros((capacity,), dtype=np.int64)
+    cdef dtype_t[:] candCost = np.zeros((capacity,), dtype=np.float)
+    cdef np.int64_t[:, :] candCounts = np.zeros((capacity, numSymbols),
+                                                dtype=np.int64)
+    cdef np.int64_t[:, :] candMax = np.zeros((capacity, max(numCat, 1)),
+                                             dtype=np.int64)
+    cdef dtype_t[:, :] candSum = np.zeros((capacity, max(numGauss, 1)),
+                                          dtype=np.float)
+    cdef dtype_t[:, :] candSumSq = np.zeros((capacity, max(numGauss, 1)),
+                                            dtype=np.float)
+    cdef np.int64_t[:, :] candGaussLen = np.zeros((capacity, max(numGauss, 1)),
+                                                  dtype=np.int64)
+    cdef itype_t t
+    cdef itype_t c
+    cdef itype_t n
+    cdef itype_t k
+    cdef itype_t v
+    cdef np.int64_t w
+    cdef np.int64_t col
+    cdef np.int64_t bestStart
+    cdef dtype_t best
+    cdef dtype_t cost
+    cdef dtype_t x
+
+    F[0] = -penalty
+    for t in xrange(1, numRuns + 1):
+        # extend every candidate segment with run t - 1
+        w = runStarts[t] - runStarts[t - 1]
+        col = runStarts[t - 1]
+        best = np.inf
+        bestStart = 0
+        for c in xrange(numCand):
+            candLen[c] += w
+            cost = 0.
+            for k in xrange(numCat):
+                v = catOffsets[k] + data[col, catTracks[k]]
+                candCounts[c, v] += w
+                if candCounts[c, v] > candMax[c, k]:
+                    candMax[c, k] = candCounts[c, v]
+                cost += candLen[c] - candMax[c, k]
+            for k in xrange(numGauss):
+                x = gaussValues[col, k]
+                if x == x:
+                    candGaussLen[c, k] += w
+                    candSum[c, k] += w * x
+                    candSumSq[c, k] += w * x * x
+                if candGaussLen[c, k] > 0:
+                    cost += candSumSq[c, k] - candSum[c, k] * \
+                            candSum[c, k] / candGaussLen[c, k]
+            candCost[c] = F[candStart[c]] + cost
+            if candCost[c] + penalty < best:
+                best = candCost[c] + penalty
+                bestStart = candStart[c]
+        F[t] = best
+        back[t] = bestStart
+        if t == numRuns:
+            break
+
+        # prune (or start over at a forced cut)
+        n = 0
+        if isForced[t] == 0:
+            for c in xrange(numCand):
+                if candCost[c] <= F[t]:
+                    if n != c:
+                        candStart[n] = candStart[c]
+                        candLen[n] = candLen[c]
+                        candCounts[n, :] = candCounts[c, :]
+                        candMax[n, :] = candMax[c, :]
+                        candSum[n, :] = candSum[c, :]
+                        candSumSq[n, :] = candSumSq[c, :]
+                        candGaussLen[n, :] = candGaussLen[c, :]
+                    n += 1
+        numCand = n
+
+        # add t as a candidate
+        if numCand == capacity:
+            capacity *= 2
+            candStart = np.resize(candStart, (capacity,))
+            candLen = np.resize(candLen, (capacity,))
+            candCost = np.resize(candCost, (capacity,))
+            candCounts = np.resize(candCounts, (capacity, numSymbols))
+            candMax = np.resize(candMax, (capacity, candMax.shape[1]))
+            candSum = np.resize(candSum, (capacity, candSum.shape[1]))
+            candSumSq = np.resize(candSumSq, (capacity, candSumSq.shape[1]))
+            candGaussLen = np.resize(candGaussLen,
+                                     (capacity, candGaussLen.shape[1]))
+        candStart[numCand] = t
+        candLen[numCand] = 0
+        candCounts[numCand, :] = 0
+        candMax[numCand, :] = 0
+        candSum[numCand, :] = 0.
+        candSumSq[numCand, :] = 0.
+        candGaussLen[numCand, :] = 0
+        numCand += 1
+
+    cuts = []
+    t = numRuns
+    while t > 0:
+        t = back[t]
+        if t > 0:
+            cuts.append(runStarts[t])
+    return np.array(cuts[::-1], dtype=np.int64)
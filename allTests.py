@@ -14,6 +14,8 @@ from teHmm.tests.hmmTest import TestCase as hmmTest
 from teHmm.tests.compareTest import TestCase as compareTest
 from teHmm.tests.cfgTest import TestCase as cfgTest
 from teHmm.tests.kmerTest import TestCase as kmerTest
+from teHmm.tests.segmentTest import TestCase as segmentTest
+from teHmm.tests.evalTest import TestCase as evalTest
 from teHmm.common import addLoggingOptions, setLoggingFromOptions, logger
 
 def allSuites(): 
@@ -22,7 +24,9 @@ def allSuites():
                                    unittest.makeSuite(hmmTest, 'test'),
                                    unittest.makeSuite(compareTest, 'test'),
                                    unittest.makeSuite(cfgTest, 'test'),
-                                   unittest.makeSuite(kmerTest, 'test')))
+                                   unittest.makeSuite(kmerTest, 'test'),
+                                   unittest.makeSuite(segmentTest, 'test'),
+                                   unittest.makeSuite(evalTest, 'test')))
     return allTests
         
 def main(argv=None):
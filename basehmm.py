@@ -504,22 +504,7 @@ class BaseHMM(object):
         logprob = []
         for i in range(copy.deepcopy(self.n_iter)):
             # Expectation step
-            stats = self._initialize_sufficient_statistics()
-            curr_logprob = 0
-            for seq in obs:
-                framelogprob = self._compute_log_likelihood(seq)
-                lpr, fwdlattice = self._do_forward_pass(framelogprob, obs = seq)
-                bwdlattice = self._do_backward_pass(framelogprob, obs = seq)
-                logger.debug("Computing posteriors from forward/backward"
-                             " tables. (last unoptimized part that needs"
-                             " redoing for both time and memory)")
-                gamma = fwdlattice + bwdlattice
-                posteriors = np.exp(gamma.T - logsumexp(gamma, axis=1)).T
-                logger.debug("Done posteriors")
-                curr_logprob += lpr
-                self._accumulate_sufficient_statistics(
-                    stats, seq, framelogprob, posteriors, fwdlattice,
-                    bwdlattice, self.params)
+            stats, curr_logprob = self._do_estep(obs)
             logprob.append(curr_logprob)
             logMsgString = "BW Iteration %d: LogProb %f" % (i, curr_logprob)
             if i > 0:
@@ -540,6 +525,28 @@ class BaseHMM(object):
 
         return self
 
+    def _do_estep(self, obs):
+        """ Expectation step over all observation sequences: return the
+        sufficient statistics and the total log probability """
+        stats = self._initialize_sufficient_statistics()
+        curr_logprob = 0
+        for seq in obs:
+            curr_logprob += self._do_sequence_estep(stats, seq)
+        return stats, curr_logprob
+
+    def _do_sequence_estep(self, stats, seq):
+        """ Expectation step for a single observation sequence: add its
+        sufficient statistics to stats and return its log probability """
+        framelogprob = self._compute_log_likelihood(seq)
+        lpr, fwdlattice = self._do_forward_pass(framelogprob, obs = seq)
+        bwdlattice = self._do_backward_pass(framelogprob, obs = seq)
+        gamma = fwdlattice + bwdlattice
+        posteriors = np.exp(gamma.T - logsumexp(gamma, axis=1)).T
+        self._accumulate_sufficient_statistics(
+            stats, seq, framelogprob, posteriors, fwdlattice,
+            bwdlattice, self.params)
+        return lpr
+
     def _get_algorithm(self):
         "decoder algorithm"
         return self._algorithm
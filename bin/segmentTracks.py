@@ -20,6 +20,10 @@ from teHmm.common import myLog, EPSILON, initBedTool, cleanBedTool
 from teHmm.common import addLoggingOptions, setLoggingFromOptions, logger
 from teHmm.common import runParallelShellCommands, runShellCommand, getLocalTempPath
 from teHmm.bin.compareBedStates import cutOutMaskIntervals
+from teHmm._track import segmentFirstScan, peltSegment
+
+# number of columns compared at once in the --comp prev segmentation
+SEGMENT_BLOCK = 1000000
 
 def main(argv=None):
     if argv is None:
@@ -58,6 +62,17 @@ def main(argv=None):
                         " first compares with first column of segment and "
                         "prev compares with column immediately left",
                         default="first")
+    parser.add_argument("--pelt", help="Instead of --thresh and --comp, "
+                        "find the segmentation that minimizes the total "
+                        "within-segment cost plus this penalty for each "
+                        "segment (solved exactly with PELT pruned dynamic "
+                        "programming).  The cost of a segment is, for each "
+                        "(non-ignored) track, the number of its bases that "
+                        "differ from the segment's most common value, or for "
+                        "gaussian tracks the sum of squared differences from "
+                        "the segment's mean.  Cut tracks still always cut, "
+                        "and --maxLen is applied to the result",
+                        type=float, default=None)
     parser.add_argument("--ignore", help="Comma-separated list of tracks to "
                         "ignore (the FASTA DNA sequence would be a good "
                         "candidate", default="sequence")
@@ -95,6 +110,8 @@ def main(argv=None):
 
     if args.comp != "first" and args.comp != "prev":
         raise RuntimeError("--comp must be either first or prev")
+    if args.pelt is not None and args.pelt < 0:
+        raise RuntimeError("--pelt penalty must be >= 0")
 
     if args.chroms is not None:
         # hack to allow chroms argument to chunk and rerun 
@@ -188,93 +205,174 @@ def main(argv=None):
               cutList[trackNo] = 1
               
 
+    # gaussian tracks get the squared error cost (of their real values, not
+    # their category codes) with --pelt
+    mbTables = None
+    if args.pelt is not None:
+        mbTables = dict()
+        for track in trackList:
+            if track.getDist() == "gaussian":
+                mbTables[track.getNumber()] = \
+                  track.getValueMap().getMapBackTable(trackData.dtype)
+
     # segment the tracks
     stats = dict()
-    segmentTracks(trackData, args, stats)
+    segmentTracks(trackData, args, stats, mbTables)
     writeStats(trackData, args, stats)
 
     if len(tempFiles) > 0:
         runShellCommand("rm -f %s" % " ".join(tempFiles))
     cleanBedTool(tempBedToolPath)
 
-def segmentTracks(trackData, args, stats):
-    """ produce a segmentation of the data based on the track values. start with
-    a hacky prototype..."""
+def segmentTracks(trackData, args, stats, mbTables = None):
+    """ produce a segmentation of the data based on the track values.  The
+    segment start points of each table are found all at once (see
+    getCutPoints()) instead of testing one base at a time.  mbTables are
+    the map back tables of the gaussian tracks, only needed for --pelt"""
     oFile = open(args.outBed, "w")
-    prevMode = args.comp == "prev"
 
     trackTableList = trackData.getTrackTableList()
     # for every non-contiguous region
     count = int(args.co)
     for trackTable in trackTableList:
-        start = trackTable.getStart()
-        end = trackTable.getEnd()
         chrom = trackTable.getChrom()
-        interval = [chrom, start, start + 1]
-        intervalLen = end - start
-        # scan each column (base) in region, and write new bed segment
-        # if necessary (ie too much change in track values)
-        pi = 0
-        curLen = 0
-        for i in xrange(1, intervalLen):
-            curLen += 1
-            if isNewSegment(trackTable, pi, i, curLen, args, stats) is True:
-                oFile.write("%s\t%d\t%d\t%s\n" % (chrom, interval[1], start + i,
-                                                  hex(count)[2:]))
-                interval[1] = start + i
-                interval[2] = interval[1] + 1
-                count += 1
-                pi = i
-                curLen = 0
-            if prevMode is True:
-                pi = i
-        # write last segment
-        if interval[1] < trackTable.getEnd():
-            oFile.write("%s\t%d\t%d\t%s\n" % (chrom, interval[1],
-                                              trackTable.getEnd(),
-                                              hex(count)[2:]))
-            count += 1        
+        cuts = getCutPoints(trackTable, args, stats, mbTables)
+        starts = trackTable.getStart() + np.append([0], cuts)
+        ends = np.append(starts[1:], trackTable.getEnd())
+        oFile.writelines("%s\t%d\t%d\t%x\n" % (chrom, starts[k], ends[k],
+                                                count + k)
+                         for k in xrange(len(starts)))
+        count += len(starts)
     
     oFile.close()
 
-def isNewSegment(trackTable, pi, i, curLen, args, stats):
-    """ may be necessary to cythonize this down the road """
-    assert i > 0
-    assert i < len(trackTable)
-    assert pi >= 0
-    assert pi < i
-
+def getCutPoints(trackTable, args, stats, mbTables = None):
+    """ Return the (sorted) array of table coordinates where a new segment
+    starts (not including 0).  With --comp prev, whether a column starts a
+    segment only depends on the column to its left, so the change flags are
+    computed with numpy for all columns at once.  With --comp first, it
+    depends on where the current segment started, so the columns are
+    scanned (in cython) with segmentFirstScan().  With --pelt, see
+    getPeltCuts() (which needs mbTables) """
+    N = len(trackTable)
     if args.fixLen > 0:
-        return curLen >= args.fixLen
-    if args.maxLen > 0 and curLen >= args.maxLen:
-        return True
-
-    # faster to just call pdist(trackTable[i-1:i], 'hamming')? 
-    col = trackTable[i]
-    prev = trackTable[pi]
-    difCount = 0
-    cutTrackFound = False
-    for j in xrange(len(col)):
-        if args.ignoreList[j] == 0 and col[j] != prev[j]:
-            difCount += 1
-            # cutList track is different
-            if args.cutList[j] == 1:
-                cutTrackFound = True
-                if args.stats is None:
-                    return True
-
-    retVal = cutTrackFound is True or difCount > args.thresh
-    
-    # second pass (with difCount in hand) for stats if wanted
-    if args.stats is not None and retVal is True:
-        for j in xrange(len(col)):
-            if args.ignoreList[j] == 0 and col[j] != prev[j]:
-                if j not in stats:
-                    stats[j] = (0, 0)
-                stats[j] = (stats[j][0] + 1, stats[j][1] + 1. / float(difCount))
-                 
-
-    return retVal
+        return np.arange(args.fixLen, N, args.fixLen)
+    data = trackTable.getNumPyArray()
+    if args.pelt is not None:
+        cuts, statCuts = addMaxLenCuts(getPeltCuts(data, args, mbTables),
+                                       N, args.maxLen)
+        statRefs = statCuts - 1
+    elif args.comp == "prev":
+        changeCuts = getPrevChangeCuts(data, args.ignoreList, args.cutList,
+                                       args.thresh)
+        cuts, statCuts = addMaxLenCuts(changeCuts, N, args.maxLen)
+        statRefs = statCuts - 1
+    else:
+        outCuts = np.zeros((N,), dtype=np.uint8)
+        segmentFirstScan(data, (args.ignoreList != 0).astype(np.uint8),
+                         (args.cutList != 0).astype(np.uint8),
+                         args.thresh, args.maxLen, outCuts)
+        cuts = np.nonzero(outCuts)[0]
+        # each column is compared with the start of the previous segment
+        refs = np.append([0], cuts[:-1])
+        isChange = outCuts[cuts] == 1
+        statCuts, statRefs = cuts[isChange], refs[isChange]
+    if args.stats is not None:
+        updateStats(data, statCuts, statRefs, args, stats)
+    return cuts
+
+def getPrevChangeCuts(data, ignoreList, cutList, thresh):
+    """ Columns that differ from the previous column in more than
+    thresh tracks not in ignoreList, or in any track in cutList.  Done in
+    blocks of SEGMENT_BLOCK columns to bound the memory of the temporary
+    arrays on whole chromosomes"""
+    keep = np.nonzero(ignoreList == 0)[0]
+    cutKeep = cutList[keep] == 1
+    changeCuts = []
+    for blockStart in xrange(1, len(data), SEGMENT_BLOCK):
+        blockEnd = min(blockStart + SEGMENT_BLOCK, len(data))
+        changed = data[blockStart:blockEnd, keep] != \
+                  data[blockStart - 1:blockEnd - 1, keep]
+        isCut = (np.sum(changed, axis=1) > thresh) | \
+                np.any(changed[:, cutKeep], axis=1)
+        changeCuts.append(blockStart + np.nonzero(isCut)[0])
+    if len(changeCuts) == 0:
+        return np.zeros((0,), dtype=np.int)
+    return np.concatenate(changeCuts)
+
+def getPeltCuts(data, args, mbTables):
+    """ Optimal segmentation (see peltSegment() in _track.pyx) of a table
+    with penalty args.pelt.  Segments are only cut between runs of
+    identical (non-ignored) columns, and always cut where a cut track
+    changes.  The tracks in mbTables (track number to map back table) are
+    gaussian, and are scored on their values """
+    N = len(data)
+    noTracks = np.zeros(args.ignoreList.shape, dtype=np.int)
+    runStarts = np.concatenate((
+        [0], getPrevChangeCuts(data, args.ignoreList, noTracks, 0),
+        [N])).astype(np.int64)
+    forcedCuts = getPrevChangeCuts(data, 1 - args.cutList, noTracks, 0)
+    isForced = np.in1d(runStarts[:-1], forcedCuts).astype(np.uint8)
+    useTrack = (args.ignoreList == 0) & (args.cutList == 0)
+    isGaussian = np.array([x in mbTables for x in
+                           xrange(len(useTrack))], dtype=np.bool)
+    catTracks = np.nonzero(useTrack & ~isGaussian)[0]
+    gaussTracks = np.nonzero(useTrack & isGaussian)[0]
+    numSymbols = np.zeros((len(catTracks),), dtype=np.int)
+    if N > 0 and len(catTracks) > 0:
+        numSymbols = np.max(data[:, catTracks], axis=0).astype(np.int) + 1
+    catOffsets = np.append([0], np.cumsum(numSymbols))
+    return peltSegment(data, runStarts, isForced,
+                       catTracks.astype(np.int32),
+                       catOffsets.astype(np.int32),
+                       getGaussianValues(data, gaussTracks, mbTables),
+                       args.pelt)
+
+def getGaussianValues(data, gaussTracks, mbTables):
+    """ Map the given gaussian track columns of the table back to their
+    values (as TrackTable.setAverages() does), with NaN for missing
+    values """
+    values = np.zeros((len(data), len(gaussTracks)), dtype=np.float)
+    for k, trackNo in enumerate(gaussTracks):
+        values[:, k] = mbTables[trackNo][data[:, trackNo]]
+    values[values == sys.maxint] = np.nan
+    return values
+
+def addMaxLenCuts(changeCuts, N, maxLen):
+    """ Cut any segment between changeCuts that is longer than maxLen (<= 0
+    for no max) every maxLen columns.  Returns all the cuts, along with the
+    change cuts that don't fall on a maxLen cut (which are the only ones
+    that count towards the --stats) """
+    if maxLen <= 0:
+        return changeCuts, changeCuts
+    bounds = np.concatenate(([0], changeCuts, [N]))
+    gaps = np.diff(bounds)
+    numExtra = (gaps - 1) // maxLen
+    extraStart = np.cumsum(numExtra) - numExtra
+    multiple = np.arange(np.sum(numExtra)) - np.repeat(extraStart, numExtra)
+    extraCuts = np.repeat(bounds[:-1], numExtra) + (multiple + 1) * maxLen
+    statCuts = changeCuts[gaps[:-1] % maxLen != 0]
+    return np.union1d(changeCuts, extraCuts), statCuts
+
+def updateStats(data, cuts, refs, args, stats):
+    """ For each track, add up the number of cuts where its value changed
+    (between columns cuts[k] and refs[k]) and the fraction of all (non-ignored)
+    changes at the cut that it accounts for """
+    keep = np.nonzero(args.ignoreList == 0)[0]
+    for blockStart in xrange(0, len(cuts), SEGMENT_BLOCK):
+        blockEnd = min(blockStart + SEGMENT_BLOCK, len(cuts))
+        changed = data[cuts[blockStart:blockEnd]][:, keep] != \
+                  data[refs[blockStart:blockEnd]][:, keep]
+        difCount = np.sum(changed, axis=1)
+        trackCounts = np.sum(changed, axis=0)
+        trackPcts = np.sum(changed / difCount[:, np.newaxis].astype(np.float),
+                           axis=0)
+        for k in np.nonzero(trackCounts)[0]:
+            j = int(keep[k])
+            if j not in stats:
+                stats[j] = (0, 0)
+            stats[j] = (stats[j][0] + int(trackCounts[k]),
+                        stats[j][1] + trackPcts[k])
 
 def writeStats(trackData, args, stats):
     """ write the cutting statistics if wanted"""
@@ -11,7 +11,8 @@ import logging
 import numpy as np
 import math
 import copy
-import itertools
+import bisect
+import StringIO
 
 from teHmm.track import TrackData, CategoryMap
 from teHmm.hmm import MultitrackHmm
@@ -20,7 +21,7 @@ from teHmm.trackIO import getMergedBedIntervals, readBedIntervals
 from teHmm.modelIO import loadModel
 from teHmm.common import myLog, EPSILON, initBedTool, cleanBedTool
 from teHmm.common import addLoggingOptions, setLoggingFromOptions, logger
-from teHmm.common import runParallelShellCommands, runShellCommand, getLocalTempPath
+from teHmm.common import runParallelShellCommands, getParallelContext
 
 def main(argv=None):
     if argv is None:
@@ -40,14 +41,46 @@ def main(argv=None):
     parser.add_argument("--bed", help="path of file to write viterbi "
                         "output to (most likely sequence of hidden states)",
                         default=None)
-    parser.add_argument("--numThreads", help="Number of threads to use (only"
-                        " applies to CFG parser for the moment)",
+    parser.add_argument("--numThreads", help="Number of threads to use (for"
+                        " the CFG parser and the emission probabilities)",
                         type=int, default=1)
     parser.add_argument("--slice", help="Make sure that regions are sliced"
                         " to a maximum length of the given value.  Most "
-                        "useful when model is a CFG to keep memory down. "
+                        "useful when model is a CFG to keep memory down "
+                        "(though see --window). "
                         "When 0, no slicing is done",
                         type=int, default=0)
+    parser.add_argument("--window", help="Sliding window decoding for CFG "
+                        "models: decode regions longer than the given value"
+                        " in overlapping windows of this many columns, and "
+                        "stitch the results together.  Unlike --slice, "
+                        "structures near the edge of a window are parsed "
+                        "with the context from the overlap.  The windows "
+                        "are decoded in --numThreads processes.  When 0, "
+                        "the whole region is decoded at once.",
+                        type=int, default=0)
+    parser.add_argument("--overlap", help="Number of columns that adjacent "
+                        "windows share (use with --window).  Each window's "
+                        "result is used up to the middle of the overlap.",
+                        type=int, default=0)
+    parser.add_argument("--maxSpan", help="Banded CYK for CFG models: only "
+                        "allow nested (pair emission) structures spanning at"
+                        " most the given number of columns.  Anything longer"
+                        " is parsed by chaining these together left to "
+                        "right, like an HMM.  Memory and time are then "
+                        "linear in the region length, so regions don't need"
+                        " to be sliced.  When 0, there is no limit.",
+                        type=int, default=0)
+    parser.add_argument("--sparse", help="Sparse CYK for CFG models: only "
+                        "allow nested (pair emission) structures between "
+                        "columns that share a self-alignment in the "
+                        "alignment track (for example LTR pairs or TIRs), "
+                        "and parse everything else left to right, like an "
+                        "HMM.  Time and memory are then roughly linear in "
+                        "the region length.  Anchors can be limited to "
+                        "--maxSpan columns apart.  Only for decoding: --pd "
+                        "is not supported with --sparse.",
+                        action="store_true", default=False)
     parser.add_argument("--segment", help="Use the intervals in bedRegions"
                         " as segments which each count as a single column"
                         " for evaluattion.  Note the model should have been"
@@ -56,6 +89,14 @@ def main(argv=None):
     parser.add_argument("--segLen", help="Effective segment length used for"
                         " normalizing input segments (specifying 0 means no"
                         " normalization applied)", type=int, default=0)    
+    parser.add_argument("--compressRuns", help="Use exact run-length "
+                        "compressed inference for HMMs, where long runs of "
+                        "identical columns are handled by raising the "
+                        "transition matrix to a power rather than one base at"
+                        " a time.  Gives the same result as the default but "
+                        "can be much faster on data with long stretches of "
+                        "unannotated sequence.  Not used with --segment",
+                        action="store_true", default=False)
     parser.add_argument("--maxPost", help="Use maximum posterior decoding instead"
                         " of Viterbi for evaluation", action="store_true",
                         default=False)
@@ -96,6 +137,11 @@ def main(argv=None):
     elif args.segment is True:
         raise RuntimeError("--slice and --segment options are not compatible at "
                            "this time")
+    if args.window > 0 and args.segment is True:
+        raise RuntimeError("--window and --segment options are not compatible"
+                           " at this time")
+    if args.window > 0 and not 0 <= args.overlap < args.window:
+        raise RuntimeError("--overlap must be between 0 and --window - 1")
     if (args.pd is not None) ^ (args.pdStates is not None):
         raise RuntimeError("--pd requires --pdStates and vice versa")
     if (args.ed is not None) ^ (args.edStates is not None):
@@ -104,12 +150,6 @@ def main(argv=None):
         raise RuntimeError("Both --ed and --pd only usable in conjunction with"
                            " --bed")
 
-    if args.chroms is not None:
-        # hack to allow chroms argument to chunk and rerun 
-        parallelDispatch(argv, args)
-        cleanBedTool(tempBedToolPath)
-        return 0
-    
     # load model created with teHmmTrain.py
     logger.info("loading model %s" % args.inputModel)
     model = loadModel(args.inputModel)
@@ -117,6 +157,23 @@ def main(argv=None):
     if isinstance(model, MultitrackCfg):
         if args.maxPost is True:
            raise RuntimeErorr("--post not supported on CFG models")
+        if args.maxSpan > 0:
+            model.maxSpan = args.maxSpan
+        model.sparse = args.sparse
+        if args.sparse is True and args.pd is not None:
+            raise RuntimeError("--pd not supported with --sparse")
+        if args.window > 0:
+            model.windowSize = args.window
+            model.windowOverlap = args.overlap
+    elif args.window > 0 or args.sparse is True:
+        raise RuntimeError("--window and --sparse only supported on CFG "
+                           "models")
+
+    if isinstance(model, MultitrackHmm):
+        model.compressRuns = args.compressRuns
+    if args.window <= 0:
+        # (with --window, the threads are used for window processes instead)
+        model.emissionModel.numThreads = args.numThreads
 
     # apply the effective segment length
     if args.segLen > 0:
@@ -130,15 +187,54 @@ def main(argv=None):
         raise RuntimeError("Could not read any intervals from %s" %
                            args.bedRegions)
 
-    # slice if desired
-    choppedIntervals = [x for x in slicedIntervals(mergedIntervals, args.slice)]
-
     # read segment intervals
     segIntervals = None
     if args.segment is True:
         logger.info("loading segment intervals from %s" % args.bedRegions)
         segIntervals = readBedIntervals(args.bedRegions, sort=True)
 
+    if args.chroms is not None:
+        chromIntervals = readBedIntervals(args.chroms, sort=True)
+        parallelDispatch(args, model, mergedIntervals, segIntervals,
+                         chromIntervals)
+        cleanBedTool(tempBedToolPath)
+        return 0
+
+    vitOutFile, posteriorsFile, emissionsFile = None, None, None
+    if args.bed is not None:
+        vitOutFile = open(args.bed, "w")
+    if args.pd is not None:
+        posteriorsFile = open(args.pd, "w")
+    if args.ed is not None:
+        emissionsFile = open(args.ed, "w")
+
+    totalScore, totalDatapoints = evaluate(args, model, mergedIntervals,
+                                           segIntervals, vitOutFile,
+                                           posteriorsFile, emissionsFile)
+
+    print "Viterbi (log) score: %f" % totalScore
+    if isinstance(model, MultitrackHmm) and model.current_iteration is not None:
+        print "Number of EM iterations: %d" % model.current_iteration
+    for outFile in [vitOutFile, posteriorsFile, emissionsFile]:
+        if outFile is not None:
+            outFile.close()
+
+    if args.bic is not None:
+        bicFile = open(args.bic, "w")
+        bicFile.write(getBic(model, totalScore, totalDatapoints))
+        bicFile.close()
+
+    cleanBedTool(tempBedToolPath)
+
+def evaluate(args, model, mergedIntervals, segIntervals, vitOutFile,
+             posteriorsFile, emissionsFile):
+    """ Load the tracks for the given intervals and decode them, writing the
+    states (and posterior and emission distributions if wanted) to the
+    given files.  Returns the total (Viterbi) score along with the number
+    of data points (for the BIC) """
+    # slice if desired
+    choppedIntervals = [x for x in slicedIntervals(mergedIntervals, args.slice)]
+
     # load the input
     # read the tracks, while intersecting them with the given interval
     trackData = TrackData()
@@ -158,9 +254,6 @@ def main(argv=None):
     elif isinstance(model, MultitrackCfg):
         logger.info("running CYK algorithm")
 
-    vitOutFile = None
-    if args.bed is not None:
-        vitOutFile = open(args.bed, "w")
     totalScore = 0
     tableIndex = 0
     totalDatapoints = 0
@@ -169,19 +262,19 @@ def main(argv=None):
     # track table at once (just need to add table by table interface to hmm...)
     
     posteriors = [None] * trackData.getNumTrackTables()
-    posteriorsFile = None
     posteriorsMask = None
     if args.pd is not None:
-        posteriors = model.posteriorDistribution(trackData)
-        posteriorsFile = open(args.pd, "w")
+        if isinstance(model, MultitrackCfg):
+            posteriors = model.posteriorDistribution(
+                trackData, numThreads=args.numThreads)
+        else:
+            posteriors = model.posteriorDistribution(trackData)
         posteriorsMask = getPosteriorsMask(args.pdStates, model)
         assert len(posteriors[0][0]) == len(posteriorsMask)
     emProbs = [None] * trackData.getNumTrackTables()
-    emissionsFile = None
     emissionsMask = None
     if args.ed is not None:
         emProbs = model.emissionDistribution(trackData)
-        emissionsFile = open(args.ed, "w")
         emissionsMask = getPosteriorsMask(args.edStates, model)
         assert len(emProbs[0][0]) == len(emissionsMask)
 
@@ -203,37 +296,27 @@ def main(argv=None):
                         posteriorsFile, emProbs[i], emissionsMask, emissionsFile)
             totalDatapoints += len(vitStates) * trackTable.getNumTracks()
 
-    print "Viterbi (log) score: %f" % totalScore
-    if isinstance(model, MultitrackHmm) and model.current_iteration is not None:
-        print "Number of EM iterations: %d" % model.current_iteration
-    if args.bed is not None:
-        vitOutFile.close()
-    if posteriorsFile is not None:
-        posteriorsFile.close()
-    if emissionsFile is not None:
-        emissionsFile.close()
-
-    if args.bic is not None:
-        bicFile = open(args.bic, "w")
-        # http://en.wikipedia.org/wiki/Bayesian_information_criterion
-        lnL = float(totalScore)
-        try:
-            k = float(model.getNumFreeParameters())
-        except:
-            # numFreeParameters still not done for semi-supervised
-            # just pass through a 0 instead of crashing for now
-            k = 0.0 
-        n = float(totalDatapoints)
-        bic = -2.0 * lnL + k * (np.log(n) + np.log(2 * np.pi))
-        bicFile.write("%f\n" % bic)
-        bicFile.write("# = -2.0 * lnL + k * (lnN + ln(2 * np.pi))\n"
-                      "# where lnL=%f  k=%d (%d states)  N=%d (%d obs * %d tracks)  lnN=%f\n" % (
+    return totalScore, totalDatapoints
+
+def getBic(model, totalScore, totalDatapoints):
+    """ Bayesian Information Criterion (BIC) score, with an explanation line,
+    for the text of the --bic file """
+    # http://en.wikipedia.org/wiki/Bayesian_information_criterion
+    lnL = float(totalScore)
+    try:
+        k = float(model.getNumFreeParameters())
+    except:
+        # numFreeParameters still not done for semi-supervised
+        # just pass through a 0 instead of crashing for now
+        k = 0.0 
+    n = float(totalDatapoints)
+    bic = -2.0 * lnL + k * (np.log(n) + np.log(2 * np.pi))
+    return "%f\n" % bic + \
+        "# = -2.0 * lnL + k * (lnN + ln(2 * np.pi))\n" \
+        "# where lnL=%f  k=%d (%d states)  N=%d (%d obs * %d tracks)  lnN=%f\n" % (
             lnL, int(k), model.getEmissionModel().getNumStates(), int(totalDatapoints),
             totalDatapoints / model.getEmissionModel().getNumTracks(),
-            model.getEmissionModel().getNumTracks(), np.log(n)))
-        bicFile.close()
-
-    cleanBedTool(tempBedToolPath)
+            model.getEmissionModel().getNumTracks(), np.log(n))
 
 def statesToBed(trackTable, states, bedFile,
                 posteriors, posteriorsMask, posteriorsFile,
@@ -285,7 +368,7 @@ def slicedIntervals(bedIntervals, chunkSize):
             nCuts = int(math.ceil(float(iLen) / float(chunkSize)))
             for sliceNo in xrange(nCuts):
                 sInt = list(copy.deepcopy(interval))
-                sInt[1] = sliceNo * chunkSize
+                sInt[1] = interval[1] + sliceNo * chunkSize
                 if sliceNo < nCuts - 1:
                     sInt[2] = sInt[1] + chunkSize
                 assert sInt[2] > sInt[1]
@@ -309,79 +392,94 @@ def getPosteriorsMask(pdStates, hmm):
             mask[stateNumber] = 1
     return mask
 
-def parallelDispatch(argv, args):
-    """ chunk up input with chrom option.  recursivlely launch eval. merge
-    results """
-    jobList = []
-    chromIntervals = readBedIntervals(args.chroms, sort=True)
-    chromFiles = []
-    regionFiles = []
-    bedFiles = []
-    pdFiles = []
-    bicFiles = []
-    edFiles = []
-    for chrom in chromIntervals:
-        cmdToks = copy.deepcopy(argv)
-        cmdToks[cmdToks.index("--chrom") + 1] = ""
-        cmdToks[cmdToks.index("--chrom")] = ""
-        
-        chromPath = getLocalTempPath("Temp", ".bed")
-        cpFile = open(chromPath, "w")
-        cpFile.write("%s\t%d\t%d\t0\t0\t.\n" % (chrom[0], chrom[1], chrom[2]))
-        cpFile.close()
-        
-        regionPath = getLocalTempPath("Temp", ".bed")
-        runShellCommand("intersectBed -a %s -b %s | sortBed > %s" % (args.bedRegions,
-                                                                     chromPath,
-                                                                     regionPath))
+def parallelDispatch(args, model, mergedIntervals, segIntervals,
+                     chromIntervals):
+    """ chunk up input with chrom option (chromIntervals are the intervals
+    read from it).  Each chunk is evaluated in a (forked) process from a
+    pool, so the model only gets loaded once.  The largest chunks are
+    started first for better load balance, and the outputs are written in
+    the order of the chroms """
+    mergedChunks = intersectIntervals(mergedIntervals, chromIntervals)
+    segChunks = [None] * len(chromIntervals)
+    if segIntervals is not None:
+        segChunks = intersectIntervals(segIntervals, chromIntervals)
+    jobList = [(chromMerged, chromSeg) for chromMerged, chromSeg in
+               zip(mergedChunks, segChunks) if len(chromMerged) > 0]
+    if len(jobList) == 0:
+        raise RuntimeError("No intervals in %s intersect %s" % (
+            args.bedRegions, args.chroms))
+    jobSize = lambda job : sum(x[2] - x[1] for x in job[0])
+    order = sorted(range(len(jobList)), key = lambda i : jobSize(jobList[i]),
+                   reverse=True)
+
+    if args.proc > 1 and args.window > 0:
+        # the workers can't fork window processes of their own
+        args = copy.copy(args)
+        args.numThreads = 1
+    results = runParallelShellCommands([jobList[i] for i in order],
+                                       args.proc, execFunction=evaluateChunk,
+                                       chunkSize=1, context=(args, model))
+    orderedResults = [None] * len(jobList)
+    for i, result in zip(order, results):
+        orderedResults[i] = result
+
+    print "Viterbi (log) score: %f" % sum(x[0] for x in orderedResults)
+    if isinstance(model, MultitrackHmm) and model.current_iteration is not None:
+        print "Number of EM iterations: %d" % model.current_iteration
+    for path, k in [(args.bed, 2), (args.pd, 3), (args.ed, 4)]:
+        if path is not None:
+            outFile = open(path, "w")
+            for result in orderedResults:
+                outFile.write(result[k])
+            outFile.close()
+    if args.bic is not None:
+        bicFile = open(args.bic, "w")
+        for totalScore, totalDatapoints in [x[:2] for x in orderedResults]:
+            bicFile.write(getBic(model, totalScore, totalDatapoints))
+        bicFile.close()
+
+def intersectIntervals(intervals, regions):
+    """ Clip the (sorted, non-overlapping) bed intervals to each of the
+    given regions, leaving out those that don't overlap it.  Returns a list
+    of clipped intervals for each region.  The overlapping intervals are
+    found by binary search on their ends, which are sorted within each
+    chromosome """
+    chromIntervals = dict()
+    for interval in intervals:
+        if interval[0] not in chromIntervals:
+            chromIntervals[interval[0]] = []
+        chromIntervals[interval[0]].append(interval)
+    chromEnds = dict([(chrom, [x[2] for x in chromIntervals[chrom]])
+                      for chrom in chromIntervals])
+    output = []
+    for region in regions:
+        clippedList = []
+        candidates = chromIntervals.get(region[0], [])
+        i = bisect.bisect_right(chromEnds.get(region[0], []), region[1])
+        while i < len(candidates) and candidates[i][1] < region[2]:
+            clipped = list(candidates[i])
+            clipped[1] = max(candidates[i][1], region[1])
+            clipped[2] = min(candidates[i][2], region[2])
+            clippedList.append(tuple(clipped))
+            i += 1
+        output.append(clippedList)
+    return output
+
+def evaluateChunk(job):
+    """ Evaluate the (mergedIntervals, segIntervals) of one chunk (in a
+    forked process), given the (args, model) context from
+    parallelDispatch().  Returns the score, number of data points, and the
+    text of the bed, posterior and emission outputs """
+    args, model = getParallelContext()
+    chromMerged, chromSeg = job
+    outFiles = [None, None, None]
+    for k, path in enumerate([args.bed, args.pd, args.ed]):
+        if path is not None:
+            outFiles[k] = StringIO.StringIO()
+    totalScore, totalDatapoints = evaluate(args, model, chromMerged, chromSeg,
+                                           *outFiles)
+    return (totalScore, totalDatapoints) + tuple(
+        x.getvalue() if x is not None else "" for x in outFiles)
 
-        if os.path.getsize(regionPath) < 2:
-            continue
-        
-        regionFiles.append(regionPath)
-        chromFiles.append(chromPath)
-
-        cmdToks[3] = regionPath
-
-        if args.bed is not None:
-            bedPath =  getLocalTempPath("Temp", ".bed")
-            cmdToks[cmdToks.index("--bed")+1] = bedPath
-            bedFiles.append(bedPath)
-        if args.pd is not None:
-            pdPath = getLocalTempPath("Temp", ".bed")
-            cmdToks[cmdToks.index("--pd")+1] = pdPath
-            pdFiles.append(pdPath)
-        if args.ed is not None:
-            edPath = getLocalTempPath("Temp", ".bed")
-            cmdToks[cmdToks.index("--ed")+1] = edPath
-            edFiles.append(edPath)
-        if args.bic is not None:
-            bicPath = getLocalTempPath("Temp", ".bic")
-            cmdToks[cmdToks.index("--bic")+1] = bicPath
-            bicFiles.append(bicPath)
-        cmd = " ".join(cmdToks)
-        jobList.append(cmd)
-
-    runParallelShellCommands(jobList, args.proc)
-
-    for i in xrange(len(jobList)):
-        if i == 0:
-            ct = ">"
-        else:
-            ct = ">>"
-        if len(bedFiles) > 0:
-            runShellCommand("cat %s %s %s" % (bedFiles[i], ct, args.bed))
-        if len(pdFiles) > 0:
-            runShellCommand("cat %s %s %s" % (pdFiles[i], ct, args.pd))
-        if len(edFiles) > 0:
-            runShellCommand("cat %s %s %s" % (edFiles[i], ct, args.ed))
-        if len(bicFiles) > 0:
-            runShellCommand("cat %s %s %s" % (bicFiles[i], ct, args.bic))
-
-    for i in itertools.chain(chromFiles, regionFiles, bedFiles, pdFiles, edFiles,
-                             bicFiles):
-        runShellCommand("rm %s" % i)            
-    
-    
 if __name__ == "__main__":
     sys.exit(main())
@@ -13,7 +13,8 @@ import numpy as np
 
 from teHmm.track import TrackData
 from teHmm.trackIO import readBedIntervals, getMergedBedIntervals
-from teHmm.hmm import MultitrackHmm
+from teHmm.hmm import MultitrackHmm, ONLINE_STEP_DECAY, ONLINE_CHUNK_SIZE
+from teHmm.hmm import ONLINE_HELD_OUT
 from teHmm.emission import IndependentMultinomialAndGaussianEmissionModel
 from teHmm.emission import PairEmissionModel
 from teHmm.track import CategoryMap, BinaryMap
@@ -21,8 +22,10 @@ from teHmm.cfg import MultitrackCfg
 from teHmm.modelIO import saveModel
 from teHmm.common import myLog, EPSILON, initBedTool, cleanBedTool, LOGZERO
 from teHmm.common import addLoggingOptions, setLoggingFromOptions, logger
-from teHmm.common import runParallelShellCommands
+from teHmm.common import runParallelShellCommands, getParallelContext
 from teHmm.bin.compareBedStates import checkExactOverlap
+from teHmm.distributedEm import startLocalEmWorkerPool, runFileEmWorker
+from teHmm.distributedEm import connectFileEmWorkerPool, shardIntervals
 
 def main(argv=None):
     if argv is None:
@@ -153,8 +156,21 @@ def main(argv=None):
                          " random initializations) to run. The replicate"
                          " with the highest likelihood will be chosen for the"
                          " output", default=1, type=int)
-    parser.add_argument("--numThreads", help="Number of threads to use when"
-                        " running replicates (see --rep) in parallel.",
+    parser.add_argument("--halving", help="Choose among the replicates "
+                        "(--reps) by successive halving: train all of them"
+                        " for the given number of iterations, drop the "
+                        "worse half (by likelihood), double the number of "
+                        "iterations and repeat until one is left, which is"
+                        " then trained to completion (--iter iterations in"
+                        " total).  Replicates are trained in --numThreads "
+                        "processes.  Not compatible with --onlineBatch or"
+                        " --accelerate.  0 means train all replicates to "
+                        "completion", type=int, default=0)
+    parser.add_argument("--numThreads", help="Number of processes to use when"
+                        " running replicates (see --rep) in parallel.  Threads"
+                        " left over (ie when there are more threads than "
+                        "replicates) are used to compute the emission "
+                        "probabilities within each replicate",
                         type=int, default=1)
     parser.add_argument("--emThresh", help="Threshold used for convergence"
                         " in baum welch training.  IE delta log likelihood"
@@ -182,6 +198,55 @@ def main(argv=None):
                         " unsupervised training.  Use this option to force this"
                         " behaviour for supervised and semisupervised modes",
                         action="store_true", default=False)
+    parser.add_argument("--onlineBatch", help="Use online (stepwise) EM, "
+                        "doing an M-step after each random minibatch of the "
+                        "given number of training intervals (or chunks, see "
+                        "--onlineChunk) instead of after each full pass over"
+                        " the data.  --iter then gives the number of passes"
+                        ". 0 means regular Baum-Welch", type=int, default=0)
+    parser.add_argument("--onlineChunk", help="Cut unsegmented training "
+                        "intervals longer than this into chunks for "
+                        "--onlineBatch", type=int, default=ONLINE_CHUNK_SIZE)
+    parser.add_argument("--onlineDecay", help="Step size for the k'th "
+                        "--onlineBatch update is (k+2)^-onlineDecay.  Should"
+                        " be in [0.5, 1]: smaller values forget old "
+                        "minibatches faster", type=float,
+                        default=ONLINE_STEP_DECAY)
+    parser.add_argument("--onlineHeldOut", help="Fraction of --onlineBatch "
+                        "chunks to hold out of training.  The log probability"
+                        " of these is used to check convergence (and for "
+                        "--maxProb)", type=float, default=ONLINE_HELD_OUT)
+    parser.add_argument("--accelerate", help="Speed up EM convergence with "
+                        "SQUAREM extrapolation: every two Baum-Welch "
+                        "iterations, take a longer step in the direction "
+                        "the parameters are moving (falling back to "
+                        "the regular update when the step lowers the "
+                        "likelihood).  Usually needs several times "
+                        "fewer iterations to converge.", action="store_true",
+                        default=False)
+    parser.add_argument("--emWorkers", help="Number of worker processes to"
+                        " split the EM E-step across.  Each worker gets its"
+                        " own share of the training intervals and only "
+                        "parameters and expected counts are passed between"
+                        " processes.  0 means no workers (train in this "
+                        "process)", type=int, default=0)
+    parser.add_argument("--emRendezvous", help="Directory (on a filesystem"
+                        " shared by all workers) through which --emWorkers "
+                        "communicate, instead of pipes",
+                        default=None)
+    parser.add_argument("--emRemoteWorkers", help="Don't start the "
+                        "--emWorkers but wait for them to be started "
+                        "separately (on any machine that can see "
+                        "--emRendezvous) with --emWorkerShard",
+                        action="store_true", default=False)
+    parser.add_argument("--emWorkerShard", help="Run as the worker for the"
+                        " given shard (from 0 to --emWorkers - 1), using the"
+                        " same arguments as the training process.  Requires"
+                        " --emRendezvous", type=int, default=None)
+    parser.add_argument("--emTimeout", help="Number of seconds the training"
+                        " process and the --emWorkerShard workers wait for "
+                        "each other through --emRendezvous before giving up",
+                        type=float, default=3600.)
 
     addLoggingOptions(parser)
     args = parser.parse_args()
@@ -218,6 +283,31 @@ def main(argv=None):
                                 float(args.emRandRange[1]))
         except:
             raise RuntimeError("Invalid --emRandRange specified")
+    if args.onlineBatch > 0 and (args.supervised is True or
+                                 args.emWorkers > 0):
+        raise RuntimeError("--onlineBatch cannot be used with --supervised "
+                           "or --emWorkers")
+    if args.accelerate is True and (args.supervised is True or
+                                    args.onlineBatch > 0):
+        raise RuntimeError("--accelerate cannot be used with --supervised "
+                           "or --onlineBatch")
+    if args.emWorkers > 0:
+        if args.supervised is True or args.cfg is True:
+            raise RuntimeError("--emWorkers only works for EM training of"
+                               " HMMs")
+        if args.reps > 1:
+            raise RuntimeError("--emWorkers cannot be used with --reps")
+    if args.halving > 0 and (args.supervised is True or args.cfg is True):
+        raise RuntimeError("--halving only works for EM training of HMMs")
+    if args.halving > 0 and (args.onlineBatch > 0 or args.accelerate is True):
+        # the rounds continue Baum-Welch where it left off, but the online
+        # and SQUAREM state would be lost between them
+        raise RuntimeError("--halving cannot be used with --onlineBatch "
+                           "or --accelerate")
+    if (args.emRemoteWorkers is True or args.emWorkerShard is not None) and\
+      (args.emRendezvous is None or args.emWorkers < 1):
+        raise RuntimeError("--emRemoteWorkers and --emWorkerShard require "
+                           "--emWorkers and --emRendezvous")
     if args.transMatEpsilons is False:
         # old logic here. now overriden with above options
         args.transMatEpsilons = (args.supervised is False and
@@ -252,6 +342,26 @@ def main(argv=None):
         logger.warning("--segLen should be 0 (no correction) or 1 (base"
                        " correction).  Values > 1 may cause bias.")
 
+    # worker for distributed EM: load our share of the intervals using
+    # the track list (category maps) of the model we get sent, and serve
+    # the training process
+    if args.emWorkerShard is not None:
+        # same largest-first balancing as the local workers get
+        workerIntervals = [mergedIntervals[x] for x in shardIntervals(
+            mergedIntervals, args.emWorkers)[args.emWorkerShard]]
+        def loadShard(model):
+            if len(workerIntervals) == 0:
+                return []
+            shardData = TrackData()
+            shardData.loadTrackData(args.tracksInfo, workerIntervals,
+                                    trackList=model.getTrackList(),
+                                    segmentIntervals=segIntervals)
+            return shardData.getTrackTableList()
+        runFileEmWorker(args.emRendezvous, args.emWorkerShard,
+                        loadShard=loadShard, timeout=args.emTimeout)
+        cleanBedTool(tempBedToolPath)
+        return 0
+
     # read the tracks, while intersecting them with the training intervals
     logger.info("loading tracks %s" % args.tracksInfo)
     trackData = TrackData()
@@ -282,14 +392,26 @@ def main(argv=None):
         random.seed(args.seed)
     seeds += [random.randint(0, sys.maxint) for x in xrange(1, args.reps)]
 
-    def trainClosure(randomSeed):
-        return trainModel(randomSeed, trackData=trackData, catMap=catMap,
-                          userTrans=userTrans, truthIntervals=truthIntervals,
-                          args=args)
-    
-    modelList = runParallelShellCommands(argList=seeds, numProc = args.numThreads,
-                                         execFunction = trainClosure,
-                                         useThreads = True)
+    emPool = None
+    if args.emWorkers > 0 and args.emRemoteWorkers is True:
+        # we still needed to load all the data to build the category maps
+        # but the workers will load their own
+        emPool = connectFileEmWorkerPool(args.emRendezvous, args.emWorkers,
+                                         args.emTimeout)
+    elif args.emWorkers > 0:
+        emPool = startLocalEmWorkerPool(trackData.getTrackTableList(),
+                                        args.emWorkers, args.emRendezvous)
+
+    if emPool is not None:
+        modelList = [trainModel(seeds[0], trackData=trackData, catMap=catMap,
+                                userTrans=userTrans,
+                                truthIntervals=truthIntervals, args=args,
+                                emPool=emPool)]
+    elif args.halving > 0 and len(seeds) > 1:
+        modelList = trainReplicatesHalving(seeds, trackData, catMap, args)
+    else:
+        modelList = trainReplicates(seeds, trackData, catMap, truthIntervals,
+                                    args)
 
     # select best model
     logmsg = ""
@@ -304,6 +426,8 @@ def main(argv=None):
         logging.info("Training Replicates Statistics:\n%s" % logmsg)
         logging.info("Selecting best replicate (%d, %f)" % bestModel)
     model = modelList[bestModel[0]]
+    if emPool is not None:
+        emPool.close()
         
     # write the model to a pickle
     logger.info("saving trained model to %s" % args.outputModel)
@@ -324,9 +448,27 @@ def main(argv=None):
 ###########################################################################
 
 def trainModel(randomSeed, trackData, catMap, userTrans, truthIntervals,
-               args):
+               args, emPool = None):
     """ Run the whole training pipeline
     """
+    model = createModel(randomSeed, trackData, catMap, args)
+
+    # do the training
+    if args.supervised is False:
+        logger.info("training via EM")
+        model.emPool = emPool
+        model.train(trackData)
+        model.emPool = None
+    else:
+        logger.info("training from input bed states")
+        model.supervisedTrain(trackData, truthIntervals)
+
+    applyForcedParams(model, args)
+    return model
+
+def createModel(randomSeed, trackData, catMap, args):
+    """ Create and initialize the (untrained) model
+    """
     # activate the random seed
     randGen = np.random.RandomState(randomSeed)
 
@@ -345,6 +487,8 @@ def trainModel(randomSeed, trackData, catMap, userTrans, truthIntervals,
         effectiveSegmentLength = args.segLen,
         random_state = randGen,
         randRange = args.emRandRange)
+    emissionModel.numThreads = max(1, args.numThreads /
+                                   max(1, min(args.reps, args.numThreads)))
 
     # create the model
     if not args.cfg:
@@ -360,7 +504,12 @@ def trainModel(randomSeed, trackData, catMap, userTrans, truthIntervals,
                               thresh = args.emThresh,
                               transMatEpsilons = args.transMatEpsilons,
                               maxProb = args.maxProb,
-                              maxProbCut = args.maxProbCut)
+                              maxProbCut = args.maxProbCut,
+                              onlineBatchSize = args.onlineBatch,
+                              onlineStepDecay = args.onlineDecay,
+                              onlineChunkSize = args.onlineChunk,
+                              onlineHeldOut = args.onlineHeldOut,
+                              accelerate = args.accelerate)
     else:
         pairEM = PairEmissionModel(emissionModel, [args.saPrior] *
                                    emissionModel.getNumStates())
@@ -393,14 +542,11 @@ def trainModel(randomSeed, trackData, catMap, userTrans, truthIntervals,
     # make sure initialization didnt screw up
     model.validate()
 
-    # do the training
-    if args.supervised is False:
-        logger.info("training via EM")
-        model.train(trackData)
-    else:
-        logger.info("training from input bed states")
-        model.supervisedTrain(trackData, truthIntervals)
+    return model
 
+def applyForcedParams(model, args):
+    """ Apply the user specified parameters to a trained model
+    """
     # reset the user specified transition probabilities now if necessary
     if args.forceTransProbs is not None:
         with open(args.forceTransProbs) as f:
@@ -411,7 +557,108 @@ def trainModel(randomSeed, trackData, catMap, userTrans, truthIntervals,
         with open(args.forceEmProbs) as f:
             model.applyUserEmissions(f.readlines())
 
-    return model
+###########################################################################
+
+def trainReplicate(randomSeed):
+    """ Train the replicate for the given seed (in a forked process), given
+    the (trackData, catMap, truthIntervals, args) context from
+    trainReplicates() """
+    trackData, catMap, truthIntervals, args = getParallelContext()
+    return trainModel(randomSeed, trackData=trackData, catMap=catMap,
+                      userTrans=None, truthIntervals=truthIntervals,
+                      args=args)
+
+def trainReplicates(seeds, trackData, catMap, truthIntervals, args):
+    """ Train a replicate for each seed in args.numThreads processes, forked
+    after the track data was loaded (so it's shared rather than copied,
+    and training isn't held up by the GIL as it would be with threads).
+    Only the trained models are sent back.  Returns the models in the order
+    of the seeds.
+    """
+    modelList = runParallelShellCommands(
+        argList=seeds, numProc=args.numThreads, execFunction=trainReplicate,
+        context=(trackData, catMap, truthIntervals, args))
+    return modelList
+
+def trainReplicateRound(task):
+    """ Train a replicate for a given number of EM iterations (M-steps) in
+    a round of successive halving.  task is (randomSeed, model, numIter,
+    estep), where model is None in the first round (it's then created from
+    the seed).  Otherwise training continues from the model's current
+    parameters, and estep, if not None, is the (stats, log prob) of the
+    E-step at those parameters from the end of the previous round, so it
+    doesn't need to be redone.  Returns the model and the E-step at its
+    final parameters (or None if there is none to reuse).  The
+    (trackData, catMap, truthIntervals, args) context comes from
+    trainReplicatesHalving().
+    """
+    randomSeed, model, numIter, estep = task
+    trackData, catMap, truthIntervals, args = getParallelContext()
+    initParams = None
+    if model is None:
+        model = createModel(randomSeed, trackData, catMap, args)
+    else:
+        # don't reinitialize the parameters we're continuing from
+        initParams = model.init_params
+        model.init_params = ""
+        model.resumeEstep = estep
+    # fit() stops after the E-step of its last iteration, so that the
+    # log prob we compare the replicates with is that of their parameters
+    model.n_iter = numIter + 1
+    model.train(trackData)
+    model.n_iter = args.iter
+    if initParams is not None:
+        model.init_params = initParams
+    applyForcedParams(model, args)
+    estep = model.lastEstep
+    if args.forceTransProbs is not None or args.forceEmProbs is not None:
+        estep = None
+    return model, estep
+
+def trainReplicatesHalving(seeds, trackData, catMap, args):
+    """ Successive halving: train all the replicates for args.halving
+    iterations, keep the better half (by log probability), double the
+    iterations and repeat.  The last replicate left (or any that converge)
+    is trained up to args.iter iterations in total.  The rounds are run in
+    args.numThreads processes, forked after the track data was loaded.
+    Returns the list of models (the dropped ones only partially trained),
+    in the order of the seeds.
+    """
+    modelList = [None] * len(seeds)
+    estepList = [None] * len(seeds)
+    active = range(len(seeds))
+    numIter = args.halving
+    totalIter = 0
+    while len(active) > 0 and totalIter < args.iter:
+        if len(active) == 1:
+            numIter = args.iter - totalIter
+        numIter = min(numIter, args.iter - totalIter)
+        logger.info("Successive halving: training %d replicates for %d "
+                    "iterations" % (len(active), numIter))
+        tasks = [(seeds[i], modelList[i], numIter, estepList[i])
+                 for i in active]
+        lastLogProbs = [None if modelList[i] is None else
+                        modelList[i].getLastLogProb() for i in active]
+        results = runParallelShellCommands(
+            argList=tasks, numProc=args.numThreads,
+            execFunction=trainReplicateRound,
+            context=(trackData, catMap, None, args))
+        for i, (model, estep) in zip(active, results):
+            modelList[i] = model
+            estepList[i] = estep
+        totalIter += numIter
+        # replicates whose likelihood stopped changing are done: they can
+        # still win but don't need to be trained any more
+        active = [i for i, lastLogProb in zip(active, lastLogProbs) if
+                  lastLogProb is None or
+                  abs(modelList[i].getLastLogProb() - lastLogProb) >=
+                  args.emThresh]
+        if len(active) > 1:
+            active = sorted(active, key = lambda x :
+                            modelList[x].getLastLogProb(), reverse=True)
+            active = sorted(active[:(len(active) + 1) / 2])
+        numIter *= 2
+    return modelList
 
 ###########################################################################
                 
@@ -18,9 +18,15 @@ from .emission import IndependentMultinomialEmissionModel
 from .track import TrackList, TrackTable, Track
 from .hmm import MultitrackHmm
 from .common import EPSILON, LOGZERO, myLog, logger
-from ._cfg import fastCykTable
+from .common import runParallelShellCommands, getParallelContext
+from ._cfg import fastCykTable, fastSparseCykTable, fastSparseChain
+from ._cfg import fastInsideTable, fastOutsideTable
 from .basehmm import normalize
-from .basehmm import NEGINF
+from .basehmm import NEGINF, logsumexp
+
+# the CYK table is filled in square tiles of this many columns.  Each tile is
+# done by one thread, and should fit in cache (see fastCykTable())
+CYK_TILE_SIZE = 64
 
 """ Generalize MultitrackHmm (hmm.py) to a Stochastic Context Free Grammer
 (CFG) while preserving more or less the same interface (and using the same
@@ -43,8 +49,21 @@ The first two are Chmosky Normal Form, but we add the last two kinds because
 we want to explicitly model pair emissions.
 """
 class MultitrackCfg(object):
+    # default for models pickled before the option was added
+    maxSpan = None
+    # width of the tiles the CYK table is filled in (see fastCykTable())
+    cykTileSize = CYK_TILE_SIZE
+    # sliding window decoding (see windowDecode()).  Sequences longer than
+    # windowSize are decoded in windows that overlap by windowOverlap
+    windowSize = None
+    windowOverlap = 0
+    # sparse CYK: only allow nested pairs at self-alignment anchors, and
+    # chain everything else together left to right (see getAnchors() and
+    # fastSparseCykTable())
+    sparse = False
+
     def __init__(self, emissionModel, pairEmissionModel,
-                 nestStates=[], state_name_map = None):
+                 nestStates=[], state_name_map = None, maxSpan = None):
         """ For now we take in an emission model (that was used for the HMM)
         and a list singling out a few states as nested / pair emission states"""
         self.emissionModel = emissionModel
@@ -56,6 +75,11 @@ class MultitrackCfg(object):
         self.PAIRFLAG = -2
         self.trackList = None
         self.stateNameMap = state_name_map
+        # banded CYK: when set, only subsequences of at most this length are
+        # parsed with the full grammar.  Longer prefixes are built by chaining
+        # these together left to right (like an HMM).  Memory is then
+        # O(N * maxSpan * M) instead of O(N^2 * M)
+        self.maxSpan = maxSpan
 
         # all states that can emit a column
         self.M = self.emissionModel.getNumStates()
@@ -88,6 +112,31 @@ class MultitrackCfg(object):
     def getTrackList(self):
         return self.trackList
 
+    def getStateNameMap(self):
+        return self.stateNameMap
+
+    def getEmissionModel(self):
+        return self.emissionModel
+
+    def getNumFreeParameters(self):
+        """ Return number of free, learnable parameters: the nonzero
+        productions of each state (less one since they sum to one), the
+        start probabilities, and the emissions (as in the HMM). """
+        states = self.emittingStates
+        numParams = np.sum(self.helperDim1[states] +
+                           self.helperDim2[states] - 1)
+        numParams += len(states) - 1
+        numStates = self.emissionModel.getNumStates()
+        for track in self.trackList:
+            trackNo = track.getNumber()
+            if track.getDist() == "gaussian":
+                numTrackParams = 2
+            else:
+                numTrackParams = \
+                  self.emissionModel.getNumSymbolsPerTrack()[trackNo] - 1
+            numParams += numStates * numTrackParams
+        return int(numParams)
+
     def viterbi(self, trackData, numThreads = 1):
         """ Return the output of the Viterbi algorithm on the loaded
         data: a tuple of (log likelihood of best path, and the path itself)
@@ -99,9 +148,16 @@ class MultitrackCfg(object):
         for i, trackTable in enumerate(trackData.getTrackTableList()):
             if len(alignmentTrackTableList) > 0:
                alignmentTable = alignmentTrackTableList[i]
-            prob, states = self.decode(trackTable,
-                                       alignmentTrack=alignmentTable,
-                                       numThreads=numThreads)
+            if self.windowSize is not None and self.windowSize > 0 and\
+               len(trackTable) > self.windowSize:
+                # the windows are decoded in numThreads processes
+                prob, states = self.windowDecode(trackTable,
+                                                 alignmentTrack=alignmentTable,
+                                                 numProc=numThreads)
+            else:
+                prob, states = self.decode(trackTable,
+                                           alignmentTrack=alignmentTable,
+                                           numThreads=numThreads)
             if self.stateNameMap is not None:
                 states = map(self.stateNameMap.getMapBack, states)
             output.append((prob,states))
@@ -121,42 +177,65 @@ class MultitrackCfg(object):
     def createHelperTables(self):
         """ to avoid iterating over all possible productions when many may
         have zero probaiblities, we keep arrays of nozero productions """
-        self.helper1 = []
+        states = self.emittingStates
+        used1 = self.logProbs1[np.ix_(states, states, states)] > NEGINF
         self.helperDim1 = np.zeros((self.M,), dtype=np.int32)
-        maxRow = 0
-        for state in self.emittingStates:
-            stateList = []
-            for next1 in self.emittingStates:
-                for next2 in self.emittingStates:
-                    if self.logProbs1[state, next1, next2] > NEGINF:
-                        stateList.append([next1, next2])
-            maxRow = max(len(stateList), maxRow)
-            self.helperDim1[state] = len(stateList)
-            self.helper1.append(stateList)
-        npHelper1 = -1 + np.zeros((self.M, maxRow, 2), dtype=np.int32)
-        for state in xrange(len(self.helper1)):
-            for i, entry in enumerate(self.helper1[state]):
-                assert len(entry) == 2
-                npHelper1[state, i] = entry
-        self.helper1 = npHelper1
-
-        self.helper2 = []
+        self.helperDim1[states] = np.sum(used1, axis=(1, 2))
+        # nonzero() lists the productions of each state together (in order)
+        # so the column of each is its rank within its state
+        lStates, r1States, r2States = np.nonzero(used1)
+        rank = np.arange(len(lStates)) - np.searchsorted(lStates, lStates)
+        self.helper1 = -1 + np.zeros((self.M, np.max(self.helperDim1), 2),
+                                     dtype=np.int32)
+        self.helper1[states[lStates], rank, 0] = states[r1States]
+        self.helper1[states[lStates], rank, 1] = states[r2States]
+
+        used2 = self.logProbs2[np.ix_(states, states)] > NEGINF
         self.helperDim2 = np.zeros((self.M,), dtype=np.int32)
-        maxRow = 0
-        for state in self.emittingStates:
-            stateList = []
-            for nextState in self.emittingStates:
-                if self.logProbs2[state, nextState] > NEGINF:
-                    stateList.append(nextState)
-            maxRow = max(len(stateList), maxRow)
-            self.helperDim2[state] = len(stateList)
-            self.helper2.append(stateList)
-        npHelper2 = -1 + np.zeros((self.M, maxRow), dtype=np.int32)
-        for state in xrange(len(self.helper2)):
-            for i, entry in enumerate(self.helper2[state]):
-                npHelper2[state, i] = entry
-        self.helper2 = npHelper2
-        
+        self.helperDim2[states] = np.sum(used2, axis=1)
+        lStates, rStates = np.nonzero(used2)
+        rank = np.arange(len(lStates)) - np.searchsorted(lStates, lStates)
+        self.helper2 = -1 + np.zeros((self.M, np.max(self.helperDim2)),
+                                     dtype=np.int32)
+        self.helper2[states[lStates], rank] = states[rStates]
+
+    def createReverseHelperTables(self):
+        """ The helper tables indexed by child instead of by parent, for the
+        outside algorithm: revLeft[Y] lists the (X, Z) such that X -> Y Z,
+        revRight[Y] the (X, Z) such that X -> Z Y, and revPair[Y] the X
+        such that X -> aYa (with the number of entries of each in
+        revLeftDim, revRightDim and revPairDim)"""
+        used1 = np.arange(self.helper1.shape[1]) < self.helperDim1[:, np.newaxis]
+        lStates, q = np.nonzero(used1)
+        r1States = self.helper1[lStates, q, 0]
+        r2States = self.helper1[lStates, q, 1]
+        self.revLeft, self.revLeftDim = self.__reverseTable(
+            r1States, np.column_stack((lStates, r2States)))
+        self.revRight, self.revRightDim = self.__reverseTable(
+            r2States, np.column_stack((lStates, r1States)))
+        used2 = np.arange(self.helper2.shape[1]) < self.helperDim2[:, np.newaxis]
+        lStates, q = np.nonzero(used2)
+        self.revPair, self.revPairDim = self.__reverseTable(
+            self.helper2[lStates, q], lStates[:, np.newaxis])
+
+    def __reverseTable(self, children, parents):
+        """ Group the rows of parents by child into an M x maxRow x
+        len(parents[0]) table padded with -1 """
+        order = np.argsort(children, kind="mergesort")
+        children = children[order]
+        parents = parents[order]
+        dim = np.bincount(children, minlength=self.M).astype(np.int32)
+        rank = np.arange(len(children)) - np.searchsorted(children, children)
+        table = -1 + np.zeros((self.M, np.max(dim), parents.shape[1]),
+                              dtype=np.int32)
+        table[children, rank] = parents
+        return table, dim
+
+    def getNestMask(self):
+        """ 1 for each nest state and 0 for each HMM state """
+        nestMask = np.zeros((self.M,), dtype=np.uint8)
+        nestMask[np.array(self.nestStates, dtype=np.int)] = 1
+        return nestMask
 
     def initParams(self):
         """ Allocate the production (transition) probability matrix and
@@ -168,19 +247,18 @@ class MultitrackCfg(object):
         self.startProbs = oneOfAny + np.zeros((self.M,), dtype=np.float)
 
         # hmm states flat of X - > X Y (where Y is any state)
-        for state in self.hmmStates:
-            for nextState in self.emittingStates:
-                self.logProbs1[state, state, nextState] = oneOfAny
+        hmmStates = np.array(self.hmmStates, dtype=np.int)[:, np.newaxis]
+        nextStates = self.emittingStates[np.newaxis, :]
+        self.logProbs1[hmmStates, hmmStates, nextStates] = oneOfAny
 
         # cfg states X -> a Y a (prob Y nested in X).  X is a nested state
         # but Y is any state
         # (-1 below to correct counting for state == nextState case)
         oneOfCfgRHS = myLog(1. / (3.0 * self.M - 1.0))
-        for state in self.nestStates:
-            for nextState in self.emittingStates:
-                self.logProbs1[state, state, nextState] = oneOfCfgRHS
-                self.logProbs1[state, nextState, state] = oneOfCfgRHS
-                self.logProbs2[state, nextState] = oneOfCfgRHS
+        nestStates = np.array(self.nestStates, dtype=np.int)[:, np.newaxis]
+        self.logProbs1[nestStates, nestStates, nextStates] = oneOfCfgRHS
+        self.logProbs1[nestStates, nextStates, nestStates] = oneOfCfgRHS
+        self.logProbs2[nestStates, nextStates] = oneOfCfgRHS
         
         # create shortcut tables:
         self.createHelperTables()
@@ -191,58 +269,104 @@ class MultitrackCfg(object):
         """ check that all the probabilities in the production matrix rows add
         up to one"""
         
-        total = 0.
-        for state in self.emittingStates:
-            total += np.exp(self.startProbs[state])
+        states = self.emittingStates
+        total = np.sum(np.exp(self.startProbs[states]))
         assert_array_almost_equal(total, 1.)
-        
-        for origin in self.emittingStates:
-            total = 0.
-            for next1 in self.emittingStates:
-                for next2 in self.emittingStates:
-                    total += np.exp(self.logProbs1[origin, next1, next2])
-                total += np.exp(self.logProbs2[origin, next1])
-            assert_array_almost_equal(total, 1.)
-
-        # now verify the helper tables exhibit the same behaviour
-        for origin in self.emittingStates:
-            total = 0.
-            for i in xrange(self.helperDim1[origin]):
-                total += np.exp(self.logProbs1[origin,
-                                               self.helper1[origin, i][0],
-                                               self.helper1[origin, i][1]])
-            for i in xrange(self.helperDim2[origin]):
-                total += np.exp(self.logProbs2[origin,
-                                               self.helper2[origin, i]])
-            assert_array_almost_equal(total, 1.)                
-
-    def __initDPTable(self, obs, alignmentTrack):
+
+        totals = np.sum(np.exp(self.logProbs1[np.ix_(states, states, states)]),
+                        axis=(1, 2))
+        totals += np.sum(np.exp(self.logProbs2[np.ix_(states, states)]),
+                         axis=1)
+        assert_array_almost_equal(totals, np.ones(len(states)))
+
+        # now verify the helper tables exhibit the same behaviour (unused
+        # entries at the end of each helper row are -1 and get masked out)
+        origins = np.arange(self.M)[:, np.newaxis]
+        used1 = np.arange(self.helper1.shape[1]) < self.helperDim1[:, np.newaxis]
+        probs1 = np.exp(self.logProbs1[origins, self.helper1[:, :, 0],
+                                       self.helper1[:, :, 1]])
+        used2 = np.arange(self.helper2.shape[1]) < self.helperDim2[:, np.newaxis]
+        probs2 = np.exp(self.logProbs2[origins, self.helper2])
+        totals = np.sum(np.where(used1, probs1, 0.), axis=1) + \
+                 np.sum(np.where(used2, probs2, 0.), axis=1)
+        assert_array_almost_equal(totals[states], np.ones(len(states)))
+
+    def getBandWidth(self, nObs):
+        """ Number of diagonals of the CYK table that get filled for a
+        sequence of given length (see maxSpan) """
+        if self.maxSpan is None or self.maxSpan <= 0:
+            return nObs
+        return min(self.maxSpan, nObs)
+
+    def getTracebackDtype(self, nObs):
+        """ The traceback tables store the production used for each cell as
+        a single integer: (split offset) * tbStride + production index (see
+        __traceBack()).  Use 32 bits unless that's not enough """
+        W = self.getBandWidth(nObs)
+        if W * self.tbStride < np.iinfo(np.int32).max:
+            return np.int32
+        return np.int64
+
+    def __initDPTable(self, obs, alignmentTrack, traceBack = True):
         """ Create the 2D dynamic programming table for CYK etc. and initialise
-        all the 1-length entries for each (emitting) state"""
+        all the 1-length entries for each (emitting) state.  The table is
+        stored by diagonal: dp[d, i] is the entry for the subsequence
+        [i, i + d], and only the first getBandWidth() diagonals are kept.
+        If these don't reach the end of the sequence, chainDp (and chainTb)
+        hold the entries for the longer prefixes [0, j].  The traceback
+        tables are left out (None) if traceBack is False """
+        W = self.getBandWidth(len(obs))
 
         # Create a dynamic programming traceback (for CYK) table to remember
-        #which states got used 
-        self.tb = -1 + np.zeros((len(obs), len(obs), self.M, 3),
-                                dtype = np.int64)
-
-        self.dp = NEGINF + np.zeros((len(obs), len(obs), self.M),
+        #which states got used.  The productions are numbered by their
+        # index in helper1, followed by the indexes in helper2 and then
+        # a last one for pairs emitted right beside eachother
+        self.tbStride = self.helper1.shape[1] + self.helper2.shape[1] + 1
+        tbDtype = self.getTracebackDtype(len(obs))
+        self.tb = None
+        if traceBack is True:
+            self.tb = -1 + np.zeros((W, len(obs), self.M), dtype = tbDtype)
+
+        self.dp = NEGINF + np.zeros((W, len(obs), self.M),
                                       dtype = np.float)
+        self.chainDp = None
+        self.chainTb = None
+        if W < len(obs):
+            self.chainDp = NEGINF + np.zeros((len(obs), self.M),
+                                             dtype = np.float)
+            if traceBack is True:
+                self.chainTb = -1 + np.zeros((len(obs), self.M),
+                                             dtype = tbDtype)
         self.emLogProbs = self.emissionModel.allLogProbs(obs)
-        # todo: how fast is this type of loop?
         assert len(self.emLogProbs) == len(obs)
-        for i in xrange(len(obs)):
-            for j in self.hmmStates:
-                self.dp[i,i,j] = self.emLogProbs[i,j]
-        baseMatch = alignmentTrack is not None
+        hmmStates = np.array(self.hmmStates, dtype=np.int)
+        self.dp[0][:, hmmStates] = self.emLogProbs[:, hmmStates]
+        if W < 2:
+            return
         # pair emissions where emitted columns are right beside eachother
-        for i in xrange(len(obs)-1):
-            match = baseMatch and\
-                    alignmentTrack[i,0] != self.defAlignmentSymbol and\
-                    alignmentTrack[i,0] == alignmentTrack[i+1,0]
-            for j in self.nestStates:
-                self.dp[i,i+1,j] = self.pairEmissionModel.pairLogProb(
-                    j, self.emLogProbs[i,j], self.emLogProbs[i+1,j], match)
-                self.tb[i, i+1, j] = [self.PAIRFLAG, 0, 0]
+        # (see PairEmissionModel.pairLogProb()).  The pair prior depends on
+        # whether the two columns are aligned to eachother
+        match = np.zeros((len(obs) - 1,), dtype=np.int)
+        if alignmentTrack is not None:
+            if isinstance(alignmentTrack, TrackTable):
+                alignmentTrack = alignmentTrack.getNumPyArray()
+            symbols = alignmentTrack[:, 0]
+            match = np.logical_and(symbols[:-1] != self.defAlignmentSymbol,
+                                   symbols[:-1] == symbols[1:]).astype(np.int)
+        nestStates = np.array(self.nestStates, dtype=np.int)
+        nestLogProbs = self.emLogProbs[:, nestStates]
+        logPriors = self.pairEmissionModel.logPriors
+        self.dp[1][:-1, nestStates] = nestLogProbs[:-1] + nestLogProbs[1:] + \
+            logPriors[nestStates[np.newaxis, :], match[:, np.newaxis]]
+        if traceBack is True:
+            self.tb[1][:-1, nestStates] = self.tbStride - 1
+
+    def __topScores(self, nObs):
+        """ Log probabilities of the whole sequence being derived from each
+        state (not counting the start probability) """
+        if self.chainDp is not None:
+            return self.chainDp[nObs - 1]
+        return self.dp[nObs - 1, 0]
 
     def __cyk(self, obs, alignmentTrack = None, numThreads=1):
         """ Do the CYK dynamic programming algorithm (like viterbi) to
@@ -256,18 +380,35 @@ class MultitrackCfg(object):
         if isinstance(alignmentTrack, TrackTable):
             alignmentTrack = alignmentTrack.getNumPyArray()
         assert alignmentTrack.dtype == np.uint16
-        fastCykTable(self, obs, alignmentTrack, numThreads)
-        score = max([self.startProbs[i] + self.dp[0, len(obs)-1, i]  \
+        chainTb = self.chainTb
+        if chainTb is None:
+            chainTb = np.zeros((0, 0), dtype = self.tb.dtype)
+        fastCykTable(self, obs, alignmentTrack, self.tb, chainTb, numThreads,
+                     self.cykTileSize)
+        topScores = self.__topScores(len(obs))
+        score = max([self.startProbs[i] + topScores[i]  \
                      for i in self.emittingStates])
         return score
 
     def __traceBack(self, obs):
         """ depth first search to determine most likely states from the
-        traceback table (self.tb) that was constructed during __cyk"""
-        trace = -1 + np.zeros(len(self.dp))
-        top = np.argmax([self.startProbs[i] + self.dp[0, len(obs)-1, i]\
+        traceback table (self.tb) that was constructed during __cyk.  Each
+        entry is packed as (split offset) * tbStride + production, where
+        production is an index into helper1 (X -> Y Z, split offset is
+        k - i), or into helper2 after the helper1 entries (X -> aYa), or
+        the last value for a pair with nothing nested in it.  For chained
+        prefixes (chainTb), the offset is the size of Z minus one.  The
+        (i, j) columns of each pair in the parse are left in
+        self.tracePairs"""
+        nObs = len(obs)
+        W = len(self.dp)
+        pairBase = self.helper1.shape[1]
+        trace = -1 + np.zeros(nObs)
+        topScores = self.__topScores(nObs)
+        top = np.argmax([self.startProbs[i] + topScores[i]\
                              for i in xrange(self.M)])
-        tbRecurseStack = [(0, len(self.tb) - 1, top, trace)]
+        tbRecurseStack = [(0, nObs - 1, top, trace)]
+        pairs = []
         while len(tbRecurseStack) > 0:
             i, j, state, trace = tbRecurseStack.pop()
             self.assigned = 0
@@ -278,31 +419,325 @@ class MultitrackCfg(object):
                 trace[i] = state
                 self.assigned += 1
             else:
-                (k, r1State, r2State) = self.tb[i, j, state]
-                if k == self.PAIRFLAG:
-                    #cheap hack, k set to -2 to flag a pair emission
+                if size > W:
+                    # prefix that was chained together beyond the band
+                    assert i == 0
+                    offset, production = divmod(self.chainTb[j, state],
+                                                self.tbStride)
+                    k = j - offset - 1
+                else:
+                    offset, production = divmod(self.tb[size - 1, i, state],
+                                                self.tbStride)
+                    k = i + offset
+                assert offset >= 0
+                if production >= pairBase:
                     trace[i] = state
                     trace[j] = state
-                    assert r1State == r2State
-                    if size > 2:
+                    pairs.append((i, j))
+                    if production < self.tbStride - 1:
+                        assert size > 2
+                        r1State = self.helper2[state, production - pairBase]
                         tbRecurseStack.append((i+1, j-1, r1State, trace))
                 else:
+                    r1State, r2State = self.helper1[state, production]
                     tbRecurseStack.append((i, k, r1State, trace))
                     tbRecurseStack.append((k+1, j, r2State, trace))
 
         assert self.assigned <= len(obs)
+        self.tracePairs = pairs
         return trace
             
+    def getAnchors(self, alignmentTrack):
+        """ Candidate nested pairs for sparse CYK: all pairs of columns
+        (i, j), i < j, with the same (non-default) alignment symbol, that are
+        in different runs of the symbol (ie in different copies of the
+        aligned sequence, like the two LTRs of an element) and that span at
+        most maxSpan columns.  Returns arrays of i and j, sorted by i then
+        by j.  Only the pairs that are kept are ever generated: the columns
+        of a symbol are in order, so the partners of each one are those from
+        the end of its run up to maxSpan columns away """
+        anchorI = [np.zeros((0,), dtype=np.int32)]
+        anchorJ = [np.zeros((0,), dtype=np.int32)]
+        if alignmentTrack is not None and len(alignmentTrack) > 1:
+            symbols = alignmentTrack[:, 0]
+            runs = np.cumsum(np.concatenate(([0],
+                                             symbols[1:] != symbols[:-1])))
+            positions = np.nonzero(symbols != self.defAlignmentSymbol)[0]
+            positions = positions[np.argsort(symbols[positions],
+                                             kind="mergesort")]
+            bounds = np.nonzero(np.diff(symbols[positions]))[0] + 1
+            for group in np.split(positions, bounds):
+                # [first, last) range of the partners of each column
+                groupRuns = runs[group]
+                first = np.searchsorted(groupRuns, groupRuns, side="right")
+                last = len(group)
+                if self.maxSpan is not None and self.maxSpan > 0:
+                    last = np.searchsorted(group, group + self.maxSpan)
+                counts = np.maximum(last - first, 0)
+                rowStarts = np.cumsum(counts) - counts
+                partners = np.arange(np.sum(counts)) + \
+                           np.repeat(first - rowStarts, counts)
+                anchorI.append(np.repeat(group, counts))
+                anchorJ.append(group[partners])
+        anchorI = np.concatenate(anchorI).astype(np.int32)
+        anchorJ = np.concatenate(anchorJ).astype(np.int32)
+        order = np.lexsort((anchorJ, anchorI))
+        return anchorI[order], anchorJ[order]
+
+    def __sparseCyk(self, obs, alignmentTrack = None):
+        """ Sparse version of __cyk(): see fastSparseCykTable().  The
+        anchors are indexed both by start (anchorIPtr[i] is the first anchor
+        starting at i) and by end (anchorJIdx[anchorJPtr[j]:anchorJPtr[j+1]]
+        are the anchors ending at j, by decreasing start)"""
+        nObs = len(obs)
+        if isinstance(alignmentTrack, TrackTable):
+            alignmentTrack = alignmentTrack.getNumPyArray()
+        self.emLogProbs = self.emissionModel.allLogProbs(obs)
+        self.anchorI, self.anchorJ = self.getAnchors(alignmentTrack)
+        logger.debug("Sparse CYK with %d anchors" % len(self.anchorI))
+        positions = np.arange(nObs + 1)
+        self.anchorIPtr = np.searchsorted(self.anchorI,
+                                          positions).astype(np.int32)
+        self.anchorJIdx = np.lexsort((-self.anchorI,
+                                      self.anchorJ)).astype(np.int32)
+        self.anchorJPtr = np.searchsorted(self.anchorJ[self.anchorJIdx],
+                                          positions).astype(np.int32)
+        self.nestMask = self.getNestMask()
+        self.sparseStride = self.helper1.shape[1] + 1
+        self.unitDp = NEGINF + np.zeros((len(self.anchorI), self.M),
+                                        dtype=np.float)
+        self.unitTb = -1 + np.zeros((len(self.anchorI), self.M),
+                                    dtype=np.int64)
+        self.sparseDp = NEGINF + np.zeros((nObs, self.M), dtype=np.float)
+        self.sparseTb = -1 + np.zeros((nObs, self.M), dtype=np.int64)
+        fastSparseCykTable(self, self.sparseDp, self.sparseTb)
+        return max([self.startProbs[i] + self.sparseDp[nObs - 1, i]
+                    for i in self.emittingStates])
+
+    def __sparseTraceBack(self, obs):
+        """ Trace back the chains filled in by __sparseCyk().  Each chain
+        entry is packed as unit * sparseStride + production (see
+        fastSparseChain()).  The chain inside an anchored pair isn't kept,
+        so it is recomputed when the pair is used.  As for __traceBack(),
+        the pairs of the parse are left in self.tracePairs"""
+        nObs = len(obs)
+        stride = self.sparseStride
+        trace = -1 + np.zeros(nObs)
+        top = np.argmax([self.startProbs[i] + self.sparseDp[nObs - 1, i]
+                         for i in xrange(self.M)])
+        # (start, end, state, traceback) of the chains left to trace
+        tbRecurseStack = [(0, nObs - 1, top, self.sparseTb)]
+        pairs = []
+        while len(tbRecurseStack) > 0:
+            start, end, state, chainTb = tbRecurseStack.pop()
+            while end >= start:
+                unit, production = divmod(chainTb[end - start, state], stride)
+                assert unit >= 0
+                if production == stride - 1:
+                    # the rest of the chain is the unit
+                    unitState = state
+                    unitStart = start
+                else:
+                    state, unitState = self.helper1[state, production]
+                    unitStart = end
+                    if unit > 0:
+                        unitStart = self.anchorI[unit - 1]
+                if unit == 0:
+                    trace[end] = unitState
+                else:
+                    i = self.anchorI[unit - 1]
+                    j = self.anchorJ[unit - 1]
+                    trace[i] = unitState
+                    trace[j] = unitState
+                    pairs.append((i, j))
+                    q = self.unitTb[unit - 1, unitState]
+                    assert q >= 0
+                    if q < self.helper2.shape[1]:
+                        insideDp = np.empty((j - i - 1, self.M),
+                                            dtype=np.float)
+                        insideTb = np.empty((j - i - 1, self.M),
+                                            dtype=np.int64)
+                        fastSparseChain(self, i + 1, j - 1, insideDp, insideTb)
+                        tbRecurseStack.append((i + 1, j - 1,
+                                               self.helper2[unitState, q],
+                                               insideTb))
+                end = unitStart - 1
+        self.tracePairs = pairs
+        return trace
+
     def decode(self, obs, alignmentTrack = None, defAlignmentSymbol=0,
                numThreads=1):
         """ return tuple of log prob and most likely state sequence.  same
         as in the hmm. """
         self.defAlignmentSymbol = defAlignmentSymbol
+        if self.sparse is True:
+            return self.__sparseCyk(obs, alignmentTrack), \
+                self.__sparseTraceBack(obs)
         if numThreads > 1:
             logger.info("%d threads activated for CYK" % numThreads)
         return self.__cyk(obs, alignmentTrack,
                           numThreads=numThreads), self.__traceBack(obs)
 
+    def insideOutside(self, obs, alignmentTrack = None, defAlignmentSymbol=0,
+                      numThreads=1):
+        """ Return the total log probability of the observations (summed over
+        all derivations) and the posterior probability of each column
+        being emitted by each state (an array of len(obs) X M), using the
+        inside and outside algorithms.  They use the same (banded) layout
+        as CYK, but in tables of their own (insideDp, insideChainDp and
+        their scales), since they hold relative probabilities rather than
+        scores.  The CYK tables are cleared, so no traceback can be done
+        from them until the next decode().  Not supported for sparse CYK. """
+        if self.sparse is True:
+            raise RuntimeError("Posterior distribution not supported by "
+                               "sparse CYK")
+        self.defAlignmentSymbol = defAlignmentSymbol
+        self.__initDPTable(obs, alignmentTrack, traceBack=False)
+        # the inside algorithm starts from the same first diagonals as CYK
+        self.insideDp, self.insideChainDp = self.dp, self.chainDp
+        if self.insideChainDp is None:
+            self.insideChainDp = np.zeros((0, 0), dtype=np.float)
+        self.dp, self.chainDp = None, None
+        if alignmentTrack is None:
+            alignmentTrack = np.ndarray((0,1), dtype = np.uint16)
+        if isinstance(alignmentTrack, TrackTable):
+            alignmentTrack = alignmentTrack.getNumPyArray()
+        self.createReverseHelperTables()
+        self.nestMask = self.getNestMask()
+        nObs = len(self.emLogProbs)
+        W = len(self.insideDp)
+        chain = len(self.insideChainDp) > 0
+        self.insideScale = NEGINF + np.zeros((W, nObs), dtype=np.float)
+        self.insideChainScale = NEGINF + np.zeros(nObs, dtype=np.float)
+        fastInsideTable(self, alignmentTrack, self.insideDp,
+                        self.insideChainDp, self.insideScale,
+                        self.insideChainScale, numThreads)
+        # inside log probability of each state for the whole sequence
+        with np.errstate(divide="ignore"):
+            if chain:
+                topScores = self.insideChainScale[nObs - 1] + \
+                            np.log(self.insideChainDp[nObs - 1])
+            else:
+                topScores = self.insideScale[nObs - 1, 0] + \
+                            np.log(self.insideDp[nObs - 1, 0])
+        self.insideLogProb = logsumexp(self.startProbs[self.emittingStates] +
+                                       topScores[self.emittingStates])
+        if not np.isfinite(self.insideLogProb):
+            raise RuntimeError("Observations have zero probability")
+        outDp = np.zeros(self.insideDp.shape, dtype=np.float)
+        outScale = NEGINF + np.zeros((W, nObs), dtype=np.float)
+        outChainDp = np.zeros(self.insideChainDp.shape, dtype=np.float)
+        outChainScale = NEGINF + np.zeros(nObs, dtype=np.float)
+        posteriors = np.zeros((nObs, self.M), dtype=np.float)
+        fastOutsideTable(self, alignmentTrack, self.insideDp,
+                         self.insideChainDp, self.insideScale,
+                         self.insideChainScale, outDp, outScale, outChainDp,
+                         outChainScale, posteriors, numThreads)
+        return self.insideLogProb, posteriors
+
+    def posteriorDistribution(self, trackData, numThreads=1):
+        """ Return the posterior probability (array of probabilities, 1 for
+        each state) distribution for the observations (see insideOutside())"""
+        output = []
+        alignmentTrackTableList = trackData.getAlignmentTrackTableList()
+        alignmentTable = None
+        for i, trackTable in enumerate(trackData.getTrackTableList()):
+            if len(alignmentTrackTableList) > 0:
+               alignmentTable = alignmentTrackTableList[i]
+            logger.debug("Beginning cfg posterior distribution computation")
+            logProb, posteriors = self.insideOutside(
+                trackTable, alignmentTrack=alignmentTable,
+                numThreads=numThreads)
+            logger.debug("Done cfg posterior distribution")
+            output.append(posteriors)
+        return output
+
+    def getWindows(self, nObs):
+        """ Cut a sequence of length nObs into windows of windowSize columns,
+        each starting windowSize - windowOverlap columns after the previous
+        one (the last is moved back to end at nObs).  Returns a list of
+        (start, end, coreStart, coreEnd) tuples.  The cores are where each
+        window's parse would be used if it were cut at the middle of the
+        overlaps, so that they are consecutive and cover the whole sequence
+        (stitchWindows() moves the cuts to avoid splitting pairs)"""
+        W = self.windowSize
+        assert W > 0 and 0 <= self.windowOverlap < W
+        step = W - self.windowOverlap
+        lastStart = max(nObs - W, 0)
+        numWindows = 1 + int(np.ceil(float(lastStart) / step))
+        starts = [min(k * step, lastStart) for k in xrange(numWindows)]
+        ends = [min(start + W, nObs) for start in starts]
+        cuts = [0] + [(starts[k + 1] + ends[k]) / 2 for k in
+                      xrange(numWindows - 1)] + [nObs]
+        return [(starts[k], ends[k], cuts[k], cuts[k + 1])
+                for k in xrange(numWindows)]
+
+    def windowDecode(self, obs, alignmentTrack = None, defAlignmentSymbol=0,
+                     numProc=1):
+        """ Decode each window from getWindows() on its own, in numProc
+        (forked) processes, and stitch together the states of their cores
+        (see stitchWindows()).  Unlike cutting the input into independent
+        slices, a nested structure near a window edge is parsed with the
+        overlap as context.  The CYK tables are only ever windowSize columns
+        wide.  The returned log probability is the sum of the window scores,
+        each scaled by the fraction of the window in its core, so it is only
+        an approximation of the score of the parse.  The cores that were
+        used are left in self.windowCores """
+        if isinstance(obs, TrackTable):
+            obs = obs.getNumPyArray()
+        if isinstance(alignmentTrack, TrackTable):
+            alignmentTrack = alignmentTrack.getNumPyArray()
+        windows = self.getWindows(len(obs))
+        logger.info("Decoding %d windows of %d columns in %d processes" % (
+            len(windows), self.windowSize, numProc))
+        results = runParallelShellCommands(
+            argList=[x[:2] for x in windows], numProc=numProc,
+            execFunction=decodeWindow,
+            context=(self, obs, alignmentTrack, defAlignmentSymbol))
+        cores = self.stitchWindows(windows, [x[2] for x in results])
+        prob = 0.
+        trace = -1 + np.zeros(len(obs))
+        for (start, end), (coreStart, coreEnd), (windowProb, windowTrace, p) \
+            in zip([x[:2] for x in windows], cores, results):
+            trace[coreStart:coreEnd] = windowTrace[coreStart - start:
+                                                   coreEnd - start]
+            prob += windowProb * float(coreEnd - coreStart) / (end - start)
+        self.windowCores = cores
+        return prob, trace
+
+    def stitchWindows(self, windows, windowPairs):
+        """ Choose where each window's parse gives way to the next one's,
+        given the windows from getWindows() and the (i, j) pairs (in window
+        coordinates) of each window's parse.  Each cut is the column of the
+        overlap closest to its middle that no pair of either parse spans, so
+        that a pair never ends up with its two sides coming from different
+        windows (if there is no such column, the one spanned by the fewest
+        pairs is used).  Returns the (coreStart, coreEnd) of each window """
+        # number of pairs spanning the cut before each column of each window
+        spans = []
+        for (start, end, coreStart, coreEnd), pairs in zip(windows,
+                                                           windowPairs):
+            span = np.zeros((end - start + 2,), dtype=np.int)
+            if len(pairs) > 0:
+                pairs = np.array(pairs)
+                np.add.at(span, pairs[:, 0] + 1, 1)
+                np.add.at(span, pairs[:, 1] + 1, -1)
+            spans.append(np.cumsum(span))
+        cuts = [0]
+        for k in xrange(len(windows) - 1):
+            candidates = np.arange(max(windows[k + 1][0], cuts[-1] + 1),
+                                   windows[k][1] + 1)
+            numSpans = spans[k][candidates - windows[k][0]] + \
+                       spans[k + 1][candidates - windows[k + 1][0]]
+            distance = np.abs(candidates - windows[k][3])
+            cut = candidates[np.lexsort((distance, numSpans))[0]]
+            if numSpans[candidates == cut][0] > 0:
+                logger.debug("Window cut at %d splits %d pairs" % (
+                    cut, numSpans[candidates == cut][0]))
+            cuts.append(cut)
+        cuts.append(windows[-1][1])
+        return [(cuts[k], cuts[k + 1]) for k in xrange(len(windows))]
+
     def supervisedTrain(self, trackData, bedIntervals):
         """ Production porbabilites determined by frequencies two states
         are adjacent in the training data.  In fact, we mostly piggyback
@@ -383,3 +818,17 @@ class MultitrackCfg(object):
                                                             prob, myLog(prob))
         return s
 
+###########################################################################
+
+def decodeWindow(window):
+    """ Decode the (start, end) window of the input (in a forked process),
+    given the (model, obs, alignmentTrack, defAlignmentSymbol) context from
+    windowDecode().  Returns the log prob, states and pairs of its parse """
+    model, obs, alignmentTrack, defAlignmentSymbol = getParallelContext()
+    start, end = window
+    windowAlignment = None
+    if alignmentTrack is not None:
+        windowAlignment = alignmentTrack[start:end]
+    prob, trace = model.decode(obs[start:end], windowAlignment,
+                               defAlignmentSymbol)
+    return prob, trace, model.tracePairs
@@ -31,6 +31,13 @@ def __myLogFloat(x, logZeroVal = LOGZERO, epsilonVal = EPSILON):
 
 """ Replace np.log to accept zero """
 myLog = np.vectorize(__myLogFloat)
+
+def myLogArray(x, logZeroVal = LOGZERO, epsilonVal = EPSILON):
+    """ Same as myLog but with numpy array operations instead of calling
+    a python function on every element (much faster on large arrays) """
+    x = np.asarray(x, dtype=np.float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(np.abs(x) < epsilonVal, logZeroVal, np.log(x))
     
 def runShellCommand(command):
     try:
@@ -46,12 +53,38 @@ def runShellCommand(command):
     except KeyboardInterrupt:
         raise RuntimeError("Aborting %s" % command)
 
+# context of the runParallelShellCommands() call that is running, see
+# getParallelContext()
+parallelContext = None
+
+def getParallelContext():
+    """ Return the context passed to runParallelShellCommands(), from
+    within its execFunction """
+    return parallelContext
+
 def runParallelShellCommands(argList, numProc, execFunction=runShellCommand,
-                             useThreads = False):
+                             useThreads = False, chunkSize = None,
+                             context = None):
     """ run some commands in parallel, either as processes or threads.
         argList should be a list of arguments, one for each instance of
-        execFunction (ie this function should take a single parameter
+        execFunction (ie this function should take a single parameter).
+        chunkSize is the number of arguments handed to a process at a time
+        (by default, about a quarter of its share).  Use 1 to have them run
+        in order of argList as processes free up.  context is made
+        available to execFunction through getParallelContext().  It's set
+        before the processes are forked, so large data (models, tracks)
+        they all need is shared rather than pickled and sent to each one
         """
+    global parallelContext
+    outerContext = parallelContext
+    parallelContext = context
+    try:
+        return __runParallel(argList, numProc, execFunction, useThreads,
+                             chunkSize)
+    finally:
+        parallelContext = outerContext
+
+def __runParallel(argList, numProc, execFunction, useThreads, chunkSize):
     if useThreads is False:
         poolType = Pool
     else:
@@ -61,16 +94,26 @@ def runParallelShellCommands(argList, numProc, execFunction=runShellCommand,
         output = map(execFunction, argList)
     elif len(argList) > 0:
         mpPool = poolType(processes=min(numProc, len(argList)))
-        result = mpPool.map_async(execFunction, argList)
+        result = mpPool.map_async(execFunction, argList, chunkSize)
         # specifying a timeout allows keyboard interrupts to work?!
         # http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool
         try:
             output = result.get(sys.maxint)
         except KeyboardInterrupt:
             mpPool.terminate()
+            mpPool.join()
             raise RuntimeError("Keyboard interrupt")
+        except:
+            mpPool.terminate()
+            mpPool.join()
+            raise
+        # don't leave the workers around (callers like the CFG window
+        # decoding can run this once per track table)
+        mpPool.close()
+        mpPool.join()
         if not result.successful():
-            raise "One or more of commands %s failed" % str(argList)
+            raise RuntimeError("One or more of commands %s failed" %
+                               str(argList))
     return output
 
 def getLocalTempPath(prefix="", extension="", tagLen=5):
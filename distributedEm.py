@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+#Copyright (C) 2013 by Glenn Hickey
+#
+#Released under the MIT license, see LICENSE.txt
+
+import os
+import sys
+import time
+import pickle
+import multiprocessing
+import numpy as np
+
+from .common import logger
+
+""" Map-reduce EM for MultitrackHmm.  The sufficient statistics of the E-step
+(start, trans, obs) are sums over the track tables, so the tables can be
+split into shards that are each owned by a worker process.  Every iteration,
+the coordinator (the model being trained) sends the current parameters to
+the workers, each worker runs the E-step on its own shard and sends back
+its statistics and the log probability of each of its tables, and the
+coordinator adds them up and does the M-step.  Only parameters and
+statistics ever get sent (the data stays with the workers).
+
+Workers talk to the coordinator through a channel.  PipeChannel is used for
+worker processes on the same machine.  FileChannel exchanges messages as
+files in a directory, so workers can run anywhere that can see a shared
+filesystem (see runFileEmWorker()).  A coordinator never waits forever
+on a worker: a channel to a local worker process gives up as soon as the
+process dies, and a FileChannel gives up after its timeout. """
+
+###########################################################################
+
+def checkWorkerProcess(process):
+    """ Raise a RuntimeError if the (local) worker process on the other
+    end of a channel is no longer running """
+    if process is not None and not process.is_alive():
+        raise RuntimeError("EM worker process %s exited with code %s" % (
+            process.name, str(process.exitcode)))
+
+class PipeChannel(object):
+    """ Send and receive python objects through a multiprocessing pipe.
+    If process is given, receive() checks that it is still alive every
+    pollInterval seconds while waiting """
+    def __init__(self, connection, process = None, pollInterval = 1.0):
+        self.connection = connection
+        self.process = process
+        self.pollInterval = pollInterval
+
+    def send(self, obj):
+        self.connection.send(obj)
+
+    def receive(self):
+        while not self.connection.poll(self.pollInterval):
+            checkWorkerProcess(self.process)
+        try:
+            return self.connection.recv()
+        except EOFError:
+            checkWorkerProcess(self.process)
+            raise RuntimeError("EM channel closed by the other end")
+
+class FileChannel(object):
+    """ Send and receive python objects as pickle files in a shared
+    directory.  Each message gets its own sequence number, and is written
+    to a temporary file that is renamed when complete so that the receiver
+    never reads a partial message.  receive() raises a RuntimeError if
+    nothing comes within timeout seconds (None to wait forever), or if
+    process is given and dies """
+    def __init__(self, path, sendName, receiveName, pollInterval = 0.05,
+                 timeout = 3600., process = None):
+        self.path = path
+        self.sendName = sendName
+        self.receiveName = receiveName
+        self.pollInterval = pollInterval
+        self.timeout = timeout
+        self.process = process
+        self.sendCount = 0
+        self.receiveCount = 0
+
+    def send(self, obj):
+        msgPath = os.path.join(self.path, "%s.%d.pkl" % (self.sendName,
+                                                         self.sendCount))
+        tempPath = msgPath + ".tmp"
+        with open(tempPath, "wb") as f:
+            pickle.dump(obj, f, 2)
+        os.rename(tempPath, msgPath)
+        self.sendCount += 1
+
+    def receive(self):
+        msgPath = os.path.join(self.path, "%s.%d.pkl" % (self.receiveName,
+                                                         self.receiveCount))
+        startTime = time.time()
+        while not os.path.isfile(msgPath):
+            if self.timeout is not None and \
+               time.time() - startTime > self.timeout:
+                raise RuntimeError("Timed out waiting for %s" % msgPath)
+            checkWorkerProcess(self.process)
+            time.sleep(self.pollInterval)
+        with open(msgPath, "rb") as f:
+            obj = pickle.load(f)
+        os.remove(msgPath)
+        self.receiveCount += 1
+        return obj
+
+def getFileChannels(path, shard, timeout = 3600.):
+    """ Get the (coordinator side, worker side) file channels for a shard """
+    toWorker = "toWorker%d" % shard
+    fromWorker = "fromWorker%d" % shard
+    return (FileChannel(path, toWorker, fromWorker, timeout=timeout),
+            FileChannel(path, fromWorker, toWorker, timeout=timeout))
+
+###########################################################################
+
+def runEmWorker(channel, trackTableList = None, loadShard = None):
+    """ Serve E-step requests from the coordinator until told to stop.  The
+    first message is the model.  The shard is either given directly as
+    trackTableList, or loaded by calling loadShard(model) (which lets the
+    track data be read with the model's track list, so that every worker
+    maps the track values to the same symbols) """
+    model = None
+    while True:
+        message = channel.receive()
+        if message[0] == "stop":
+            break
+        elif message[0] == "model":
+            model = message[1]
+            # the coordinator keeps track of the best iteration
+            model.maxProb = False
+            if trackTableList is None:
+                trackTableList = loadShard(model)
+            logger.debug("EM worker loaded shard of %d tables" %
+                         len(trackTableList))
+        elif message[0] == "estep":
+            snapshot, iteration, params = message[1:]
+            model._restore_snapshot(snapshot)
+            model.current_iteration = iteration
+            model.params = params
+            stats = model._initialize_sufficient_statistics()
+            logProbs = []
+            for trackTable in trackTableList:
+                logProbs.append(model._do_sequence_estep(stats, trackTable))
+            # only send what was added (ie not any fudge the statistics
+            # were initialized with) so the coordinator can just sum them
+            initStats = model._initialize_sufficient_statistics()
+            for key in stats:
+                stats[key] -= initStats[key]
+            channel.send((stats, logProbs))
+        else:
+            raise RuntimeError("EM worker received unknown message %s" %
+                               str(message[0]))
+
+def runFileEmWorker(path, shard, trackTableList = None, loadShard = None,
+                    timeout = 3600.):
+    """ Run a worker that communicates through files in the given
+    (shared) directory.  This can be run on any machine that can see path,
+    independently of the coordinator.  It gives up if the coordinator
+    doesn't send anything for timeout seconds """
+    runEmWorker(getFileChannels(path, shard, timeout)[1], trackTableList,
+                loadShard)
+
+###########################################################################
+
+class EmWorkerPool(object):
+    """ Coordinator side of the distributed E-step.  Set a model's emPool
+    to one of these and its fit() will use the workers instead of
+    the observations that it was passed """
+    def __init__(self, channels, processes = [], tableOrder = None):
+        """ tableOrder, if given, is the list of the original index of each
+        table in each shard, and is used to return the log probabilities in
+        the original order of the tables """
+        self.channels = channels
+        self.processes = processes
+        self.tableOrder = tableOrder
+        self.model = None
+        self.snapshot = None
+
+    def estep(self, model):
+        """ Send the parameters out, then add up the statistics that come
+        back.  Returns the statistics along with the log probability of
+        every track table (in the original order if known, otherwise in
+        shard order).  The order matters to the forward log prob bookkeeping
+        (see MultitrackHmm._track_forward_log_prob()).  Raises a
+        RuntimeError (after stopping any local workers) if a worker dies
+        or times out """
+        try:
+            if self.model is not model:
+                for channel in self.channels:
+                    channel.send(("model", model))
+                self.model = model
+            self.snapshot = model._save_snapshot(self.snapshot)
+            for channel in self.channels:
+                channel.send(("estep", self.snapshot, model.current_iteration,
+                              model.params))
+            stats = model._initialize_sufficient_statistics()
+            logProbs = []
+            for channel in self.channels:
+                shardStats, shardLogProbs = channel.receive()
+                for key in stats:
+                    stats[key] += shardStats[key]
+                logProbs += shardLogProbs
+        except (RuntimeError, IOError, EOFError) as e:
+            self.terminate()
+            raise RuntimeError("Distributed E-step failed: %s" % str(e))
+        if self.tableOrder is not None:
+            order = sum(self.tableOrder, [])
+            assert len(order) == len(logProbs)
+            orderedLogProbs = [None] * len(logProbs)
+            for i, lp in zip(order, logProbs):
+                orderedLogProbs[i] = lp
+            logProbs = orderedLogProbs
+        return stats, logProbs
+
+    def close(self):
+        """ Stop the workers """
+        for channel in self.channels:
+            channel.send(("stop",))
+        for process in self.processes:
+            process.join()
+        self.channels = []
+        self.processes = []
+
+    def terminate(self):
+        """ Kill the local workers (without waiting for them to finish) """
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self.channels = []
+        self.processes = []
+
+def shardBySize(sizes, numShards):
+    """ Split items with the given sizes into (at most) numShards lists of
+    roughly equal total size.  Items are dealt out largest first to the
+    shard with the least so far.  Returns a list of the indexes of
+    the items in each shard (in their original order) """
+    shards = [[] for i in xrange(min(numShards, len(sizes)))]
+    totals = np.zeros(len(shards), dtype=np.int64)
+    order = sorted(range(len(sizes)), key = lambda x : sizes[x], reverse=True)
+    for i in order:
+        shard = np.argmin(totals)
+        shards[shard].append(i)
+        totals[shard] += sizes[i]
+    return [sorted(x) for x in shards]
+
+def shardTrackTables(trackTableList, numShards):
+    """ Split a list of track tables into (at most) numShards lists of
+    roughly equal total length (see shardBySize()) """
+    return shardBySize([len(x) for x in trackTableList], numShards)
+
+def shardIntervals(intervals, numShards):
+    """ Split a list of (chrom, start, end) intervals into numShards lists
+    of roughly equal total length, the same way as shardTrackTables(), so
+    that workers loading their own data get balanced shards.  Shards past
+    the number of intervals are empty """
+    shards = shardBySize([x[2] - x[1] for x in intervals], numShards)
+    return shards + [[]] * (numShards - len(shards))
+
+def startLocalEmWorkerPool(trackTableList, numWorkers, rendezvousPath = None):
+    """ Start numWorkers worker processes on this machine, each with its
+    own shard of the track tables.  They communicate through pipes, or
+    through files in rendezvousPath if it is given """
+    tableOrder = shardTrackTables(trackTableList, numWorkers)
+    channels = []
+    processes = []
+    for i, shardIdx in enumerate(tableOrder):
+        shard = [trackTableList[x] for x in shardIdx]
+        workerConnection = None
+        if rendezvousPath is None:
+            coordConnection, workerConnection = multiprocessing.Pipe()
+            channels.append(PipeChannel(coordConnection))
+            target, args = runEmWorker, (PipeChannel(workerConnection), shard)
+        else:
+            channels.append(getFileChannels(rendezvousPath, i)[0])
+            target, args = runFileEmWorker, (rendezvousPath, i, shard)
+        process = multiprocessing.Process(target=target, args=args)
+        process.daemon = True
+        process.start()
+        processes.append(process)
+        # the coordinator notices when the worker dies (through its process
+        # or, for a pipe, by it being closed once only the worker has it)
+        channels[-1].process = process
+        if workerConnection is not None:
+            workerConnection.close()
+    logger.info("Started %d local EM worker processes" % len(processes))
+    return EmWorkerPool(channels, processes, tableOrder)
+
+def connectFileEmWorkerPool(rendezvousPath, numWorkers, timeout = 3600.):
+    """ Coordinator side of numWorkers workers started elsewhere with
+    runFileEmWorker() on the same rendezvousPath.  A worker that takes
+    longer than timeout seconds to answer is considered lost """
+    return EmWorkerPool([getFileChannels(rendezvousPath, i, timeout)[0]
+                         for i in xrange(numWorkers)])
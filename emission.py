@@ -18,15 +18,28 @@ from scipy import stats
 from operator import mul
 from ._emission import canFast, fastAllLogProbs, fastAccumulateStats, fastUpdateCounts
 from .track import TrackTable, BinaryMap
-from .common import EPSILON, myLog, logger
+from .common import EPSILON, myLog, myLogArray, logger
 from .basehmm import normalize, NEGINF
 
+# tracks with at most this many symbols (including 0) are fused into
+# joint lookup tables of at most JOINT_TABLE_SIZE entries (see getTrackGroups())
+JOINT_TABLE_MAX_SYMBOLS = 6
+JOINT_TABLE_SIZE = 256
+
 """ Generlization of the sckit-learn multinomial to k dimensions.  Ie that the
 observations are k-dimensional vectors -- one element for each track.
 The probability of an observation in this model is the product of probabilities
 for each track because we make the simplifying assumption that the tracks are
 independent """
 class IndependentMultinomialEmissionModel(object):
+    # number of threads used by the Cython log prob and accumulation
+    # kernels (class level so it's defined for older pickled models too)
+    numThreads = 1
+    # (logProbs, groups, joint log prob tables) cached by
+    # getJointLogProbs().  Cleared whenever the parameters change, and
+    # never pickled
+    jointLogProbs = None
+
     def __init__(self, numStates, numSymbolsPerTrack, params = None,
                  zeroAsMissingData = True, fudge = 0.0, normalizeFac = 0.0,
                  randomize=False, effectiveSegmentLength = None,
@@ -79,12 +92,36 @@ class IndependentMultinomialEmissionModel(object):
 
         self.initParams(params=params, randomize=randomize)
             
+    def __getstate__(self):
+        """ Leave the cached joint tables out of pickles and (deep)copies """
+        state = self.__dict__.copy()
+        state.pop("jointLogProbs", None)
+        return state
+
     def getLogProbs(self):
         return self.logProbs
 
+    def clearJointLogProbs(self):
+        """ Forget the cached joint tables.  Must be called after changing
+        logProbs in place (the methods of this class that do so already
+        call it) """
+        self.jointLogProbs = None
+
     def getNumStates(self):
         return self.numStates
 
+    def getParamArrays(self):
+        """ Dictionary of the arrays holding all trained parameters, keyed
+        on attribute name (used to snapshot the model during training)"""
+        return {"logProbs" : self.logProbs}
+
+    def setParamArrays(self, arrays):
+        """ Set the parameters from a dictionary like getParamArrays() """
+        for name, array in arrays.items():
+            assert getattr(self, name).shape == array.shape
+            setattr(self, name, array)
+        self.clearJointLogProbs()
+
     def getNumTracks(self):
         return self.numTracks
 
@@ -97,6 +134,17 @@ class IndependentMultinomialEmissionModel(object):
             offset = 1
         for i in xrange(offset, self.numSymbolsPerTrack[track] + offset):
             yield i
+
+    def getSymbolMask(self):
+        """ boolean [TRACK, SYMBOL] array (same symbol dimension as logProbs)
+        that is True for the symbols yielded by getTrackSymbols() """
+        offset = 0
+        if self.zeroAsMissingData is True:
+            offset = 1
+        mask = np.zeros((self.numTracks, self.logProbs.shape[2]), dtype=np.bool)
+        for track in xrange(self.numTracks):
+            mask[track, offset:self.numSymbolsPerTrack[track] + offset] = True
+        return mask
         
     def getSymbols(self):
         """ iterate over all possible vectors of symbosl """
@@ -176,18 +224,35 @@ class IndependentMultinomialEmissionModel(object):
             logProb += self.logProbs[track][state][int(obsSymbol)]
         return logProb * self.normalizeFac
 
-    def allLogProbs(self, obs):
+    def allLogProbs(self, obs, outProbs = None):
         """ obs is an array of observation vectors.  return an array of log
         probabilities.  this output array contains the probabilitiy for
-        each state for each observation"""
+        each state for each observation.  It will be written into outProbs
+        if specified (must have shape len(obs) X numStates)"""
         logger.debug("Computing multinomial log prob for %d %d-track "
                       "observations" % (obs.shape[0], self.getNumTracks()))
-        obsLogProbs = np.zeros((obs.shape[0], self.numStates), dtype=np.float)
+        if outProbs is None:
+            outProbs = np.empty((obs.shape[0], self.numStates),
+                                dtype=np.float)
+        assert outProbs.shape == (obs.shape[0], self.numStates)
+        obsLogProbs = outProbs
         segRatios = self.getSegmentRatios(obs)
-        if canFast(obs):
+        if isinstance(obs, TrackTable) and len(obs) > 0:
+            # evaluate each distinct column once then scatter back to the
+            # positions using the (cached) inverse index
+            logger.debug("Cython log prob enabled over distinct columns")
+            columns, inverse = obs.getUniqueColumns()
+            columnLogProbs = np.zeros((len(columns), self.numStates),
+                                      dtype=np.float)
+            self.__fastAllLogProbs(columns, columnLogProbs, None, obs)
+            np.take(columnLogProbs, inverse, axis=0, out=obsLogProbs)
+            if segRatios is not None:
+                obsLogProbs *= segRatios[:,np.newaxis]
+        elif canFast(obs):
             logger.debug("Cython log prob enabled")
-            fastAllLogProbs(obs, self.logProbs, obsLogProbs, self.normalizeFac,
-                            segRatios)
+            if isinstance(obs, TrackTable):
+                obs = obs.getNumPyArray()
+            self.__fastAllLogProbs(obs, obsLogProbs, segRatios)
         else:
             for i in xrange(len(obs)):
                 for state in xrange(self.numStates):
@@ -196,6 +261,118 @@ class IndependentMultinomialEmissionModel(object):
                         obsLogProbs[i, state] *= segRatios[i]
         logger.debug("Done computing log prob")
         return obsLogProbs
+
+    def __fastAllLogProbs(self, obs, outProbs, segRatios, table = None):
+        """ Run the Cython log prob kernel.  When some tracks can be fused
+        into joint tables (see getTrackGroups()), the kernel is run on
+        the packed observations and tables instead, so it does one lookup
+        per group rather than one per track.  If obs are the distinct
+        columns of a track table, table is given so that their packing
+        can be cached along with them """
+        groups = self.getTrackGroups()
+        if len(groups) == self.numTracks:
+            fastAllLogProbs(obs, self.logProbs, outProbs, self.normalizeFac,
+                            segRatios, self.numThreads)
+        else:
+            jointLogProbs = self.getJointLogProbs(groups)
+            if table is None:
+                jointObs = self.packJointObs(obs, groups)
+            else:
+                # the packing only depends on the groups and on how many
+                # values each track has
+                key = (tuple(map(tuple, groups)),
+                       tuple([self.__getNumTrackValues(x)
+                              for x in xrange(self.numTracks)]))
+                jointObs = table.getPackedColumns(
+                    key, lambda x : self.packJointObs(x, groups))
+            fastAllLogProbs(jointObs, jointLogProbs, outProbs,
+                            self.normalizeFac, segRatios, self.numThreads)
+
+    def getTrackGroups(self):
+        """ Partition the tracks into groups, where the tracks of each
+        group have few enough symbols that the product of their symbol
+        counts is at most JOINT_TABLE_SIZE.  Tracks with more than
+        JOINT_TABLE_MAX_SYMBOLS symbols are left in groups of their own.
+        Returns a list of lists of track numbers"""
+        groups = []
+        group, groupSize = [], 1
+        for track in xrange(self.numTracks):
+            numSymbols = self.__getNumTrackValues(track)
+            if numSymbols > JOINT_TABLE_MAX_SYMBOLS:
+                groups.append([track])
+            else:
+                if groupSize * numSymbols > JOINT_TABLE_SIZE:
+                    groups.append(group)
+                    group, groupSize = [], 1
+                group.append(track)
+                groupSize *= numSymbols
+        if len(group) > 0:
+            groups.append(group)
+        return groups
+
+    def __getNumTrackValues(self, track):
+        """ Number of distinct values that can appear in a track's column
+        of the observations (ie all its symbols plus 0) """
+        return max(1, min(self.numSymbolsPerTrack[track] + 1,
+                          self.logProbs.shape[2]))
+
+    def getJointTables(self, obs, groups):
+        """ Pack the observations of each group of tracks into a single code,
+        and get the table of log probabilities of each code for each
+        state.  Returns (packed obs array, log prob table) with the same
+        layout as (obs, self.logProbs)"""
+        return self.packJointObs(obs, groups), self.getJointLogProbs(groups)
+
+    def __getJointTableSizes(self, groups):
+        """ Number of codes of each group of tracks """
+        return [reduce(mul, [self.__getNumTrackValues(x) for x in group], 1)
+                for group in groups]
+
+    def packJointObs(self, obs, groups):
+        """ Pack the observations of each group of tracks into a single code
+        (the index of their column in getJointLogProbs()) """
+        tableSizes = self.__getJointTableSizes(groups)
+        width = max(tableSizes)
+        dtype = np.int32
+        if width <= np.iinfo(np.uint8).max + 1:
+            dtype = np.uint8
+        elif width <= np.iinfo(np.uint16).max + 1:
+            dtype = np.uint16
+        jointObs = np.zeros((len(obs), len(groups)), dtype=dtype)
+        for i, group in enumerate(groups):
+            if len(group) == 1:
+                jointObs[:, i] = obs[:, group[0]]
+                continue
+            code = np.zeros(len(obs), dtype=np.int32)
+            stride = 1
+            for track in group:
+                code += obs[:, track] * stride
+                stride *= self.__getNumTrackValues(track)
+            jointObs[:, i] = code
+        return jointObs
+
+    def getJointLogProbs(self, groups):
+        """ Table of the log probabilities of each code of packJointObs() for
+        each state, for each group.  It is cached until the parameters
+        change (see clearJointLogProbs()), so it is only recomputed after
+        an M-step rather than for every sequence """
+        cached = self.jointLogProbs
+        if cached is not None and cached[0] is self.logProbs and \
+           cached[1] == groups:
+            return cached[2]
+        tableSizes = self.__getJointTableSizes(groups)
+        jointLogProbs = np.zeros((len(groups), self.numStates,
+                                  max(tableSizes)), dtype=np.float)
+        for i, group in enumerate(groups):
+            codes = np.arange(tableSizes[i])
+            stride = 1
+            for track in group:
+                numValues = self.__getNumTrackValues(track)
+                jointLogProbs[i, :, :tableSizes[i]] += self.logProbs[
+                    track][:, (codes / stride) % numValues]
+                stride *= numValues
+        self.jointLogProbs = (self.logProbs, groups, jointLogProbs)
+        return jointLogProbs
     
     def sample(self, state):
         return None
@@ -227,7 +404,8 @@ class IndependentMultinomialEmissionModel(object):
         segRatios = self.getSegmentRatios(obs)
         if canFast(obs):
             logger.debug("Cython emission.accumulateStats enabled")
-            fastAccumulateStats(obs, obsStats, posteriors, segRatios)
+            fastAccumulateStats(obs, obsStats, posteriors, segRatios,
+                                self.numThreads)
         else:
             for i in xrange(len(obs)):
                 for track in xrange(self.numTracks):
@@ -241,54 +419,64 @@ class IndependentMultinomialEmissionModel(object):
         return obsStats
         
     def maximize(self, obsStats, trackList = None):
-        for track in xrange(self.numTracks):
-            for state in xrange(self.numStates):
-                totalSymbol = 0.0
-                for symbol in self.getTrackSymbols(track):
-                    totalSymbol += obsStats[track, state, symbol]
-                lastMat = copy.deepcopy(self.logProbs[track][state])
-                trackSum = 0
-                for symbol in self.getTrackSymbols(track):
-                    denom = max(self.fudge, totalSymbol)
-                    if denom != 0.:
-                        symbolProb = obsStats[track, state, symbol] / denom
-                    else:
-                        symbolProb = 0.
-                    # no longer want to have absolute zero emissions
-                    # as it can lead to unrecognizable strings (we elect to
-                    # allow for epsilon in emissions but keep the 0s in
-                    # transitions) so we override logZero
-                    trackSum += symbolProb
-                    self.logProbs[track][state][symbol] = myLog(symbolProb,
-                                                                logZeroVal=-1e6)
-                if trackSum < EPSILON:
-                    # orphaned state/track has no emission. just leave as was
-                    self.logProbs[track][state] = lastMat
+        """ normalize the statistics over each track's symbols, for all
+        tracks and states at once """
+        numSymbols = self.logProbs.shape[2]
+        mask = self.getSymbolMask()[:, np.newaxis, :]
+        symbolStats = np.where(mask, obsStats[:, :, :numSymbols], 0.)
+        totalSymbol = np.sum(symbolStats, axis=2)
+        denom = np.maximum(self.fudge, totalSymbol)[:, :, np.newaxis]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            symbolProbs = np.where(denom != 0., symbolStats / denom, 0.)
+        trackSum = np.sum(symbolProbs, axis=2)
+        # no longer want to have absolute zero emissions
+        # as it can lead to unrecognizable strings (we elect to
+        # allow for epsilon in emissions but keep the 0s in
+        # transitions) so we override logZero
+        newLogProbs = myLogArray(symbolProbs, logZeroVal=-1e6)
+        # orphaned state/track has no emission. just leave as was
+        update = np.logical_and(mask, (trackSum >= EPSILON)[:, :, np.newaxis])
+        self.logProbs[update] = newLogProbs[update]
+        self.clearJointLogProbs()
+        self.validate()
+
+    def setProbs(self, probs, trackList = None):
+        """ set the emission distributions from a [TRACK, STATE, SYMBOL]
+        array of (unnormalized, non-negative) probabilities.  only the
+        symbols in getSymbolMask() are used, and each track's distribution
+        is renormalized.  used to apply extrapolated parameters when
+        accelerating EM (see MultitrackHmm.fitSquarem()) """
+        numSymbols = self.logProbs.shape[2]
+        mask = self.getSymbolMask()[:, np.newaxis, :]
+        symbolProbs = np.where(mask, probs[:, :, :numSymbols], 0.)
+        totalSymbol = np.sum(symbolProbs, axis=2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            symbolProbs = symbolProbs / totalSymbol[:, :, np.newaxis]
+        newLogProbs = myLogArray(symbolProbs, logZeroVal=-1e6)
+        update = np.logical_and(mask, (totalSymbol > 0.)[:, :, np.newaxis])
+        self.logProbs[update] = newLogProbs[update]
+        self.clearJointLogProbs()
         self.validate()
 
     def validate(self):
-        """ make sure everything sums to 1 """
-        numSymbols = reduce(lambda x,y : max(x,1) * max(y,1),
-                            self.numSymbolsPerTrack, 1)
-        if numSymbols >= 1000:
-            logger.debug("Warning-Unable to validate emission model because"
-                            " there are too many (%d) symbols" % numSymbols)
-            return
+        """ make sure everything sums to 1.  since the tracks are independent,
+        the distribution over all symbol vectors (see getSymbols()) sums to
+        one for each state exactly when each track's distribution does, so
+        we only need to check the per-track sums """
+        assert isinstance(self.logProbs, np.ndarray)
+        assert len(self.logProbs.shape) == 3
+        assert self.logProbs.shape[0] == self.numTracks
+        assert self.logProbs.shape[1] == self.numStates
         if self.normalizeFac != 1.0:
             # sum-to-one doesn't work for normalizeFac.  Should eventually
             # just incorporate into check below, however.
             return
-        allSymbols = [x for x in self.getSymbols()]
-        assert len(allSymbols) == numSymbols
-        assert isinstance(self.logProbs, np.ndarray)
-        assert len(self.logProbs.shape) == 3
-        for state in xrange(self.numStates):
-            total = 0.
-            for val in allSymbols:
-                assert len(val) == self.numTracks
-                total += np.exp(self.singleLogProb(state, val))
-            if len(allSymbols) > 0:
-                assert_array_almost_equal(total, 1.)                    
+        # tracks with no symbols don't emit anything
+        emitting = np.array(self.numSymbolsPerTrack) > 0
+        mask = self.getSymbolMask()[emitting, np.newaxis, :]
+        totals = np.sum(np.where(mask, np.exp(self.logProbs[emitting]), 0.),
+                        axis=2)
+        assert_array_almost_equal(totals, np.ones(totals.shape))
             
     def supervisedTrain(self, trackData, bedIntervals):
         """ count the various emissions for each state.  Note that the
@@ -484,6 +672,9 @@ class IndependentMultinomialAndGaussianEmissionModel(
         IndependentMultinomialEmissionModel):
     """ Generalize the IndependentMultinomialEmissionModel class to support a
     Gaussian distribution for a subset of tracks """
+    # default for models pickled before the cache was added
+    mapBackVectors = None
+
     def __init__(self, numStates, numSymbolsPerTrack, trackList, params = None,
                  zeroAsMissingData = True, fudge = 0.0, normalizeFac = 0.0,
                  randomize=False, effectiveSegmentLength = None,
@@ -496,6 +687,8 @@ class IndependentMultinomialAndGaussianEmissionModel(
         # gaussian parameters
         # [TRACK, STATE, MU, SIGMA]
         self.gaussParams = None
+        # track number -> (catMap, symbols, values) (see getMapBackVector)
+        self.mapBackVectors = None
         
         self.makeGaussian(trackList)
 
@@ -513,78 +706,95 @@ class IndependentMultinomialAndGaussianEmissionModel(
         assert self.gaussParams.shape[0] == self.logProbs.shape[0]
         assert self.gaussParams.shape[1] == self.logProbs.shape[1]
 
+        allStates = np.arange(self.numStates)
         for track in trackList:
             if track.getDist() == "gaussian":
                 logger.debug("Applying gaussian to track %s" % track.getName())
-                for state in xrange(self.numStates):
-                    # estimate the parameters for gaussian track
-                    mu, sigma = self.computeMuSigma(track, state)
-                    self.gaussParams[track.getNumber(), state, 0] = mu
-                    self.gaussParams[track.getNumber(), state, 1] = sigma
-
-                    # reapply parameters to probability distribution to
-                    # make it gaussian
-                    self.applyGaussian(track, state)
-                
+                # estimate the parameters for gaussian track (all states
+                # at once)
+                mu, sigma = self.computeMuSigma(track, allStates)
+                self.gaussParams[track.getNumber(), :, 0] = mu
+                self.gaussParams[track.getNumber(), :, 1] = sigma
+
+                # reapply parameters to probability distribution to
+                # make it gaussian
+                self.applyGaussian(track, allStates)
+        self.clearJointLogProbs()
+
+    def getMapBackVector(self, track):
+        """ get the symbols of a track along with the (float) values they
+        map back to, as two arrays.  cached since looking up the
+        category map for every symbol is slow """
+        trackNo = track.getNumber()
+        catMap = track.getValueMap()
+        if self.mapBackVectors is None:
+            self.mapBackVectors = dict()
+        if trackNo in self.mapBackVectors and \
+           self.mapBackVectors[trackNo][0] is catMap:
+            return self.mapBackVectors[trackNo][1:]
+        symbols = np.array([x for x in self.getTrackSymbols(trackNo)],
+                           dtype=np.int)
+        values = np.array([float(catMap.getMapBack(x)) for x in symbols],
+                          dtype=np.float)
+        self.mapBackVectors[trackNo] = (catMap, symbols, values)
+        return symbols, values
 
     def computeMuSigma(self, track, state):
         """ estimate parameters for gaussian distribution from the
-        multinomial distribution paramers for a given track"""
-        catMap = track.getValueMap()
+        multinomial distribution paramers for a given track.  state
+        can be a single state or an array of states (in which case
+        arrays of mus and sigmas are returned)"""
         trackNo = track.getNumber()
-
+        symbols, values = self.getMapBackVector(track)
+        probs = np.exp(self.logProbs[trackNo][np.ix_(np.atleast_1d(state),
+                                                     symbols)])
         # calculate mean
-        mu = 0.
-        for symbol in self.getTrackSymbols(trackNo):
-            actualValue = float(catMap.getMapBack(symbol))
-            mu += actualValue * np.exp(self.logProbs[trackNo][state][symbol])
-                    
+        mu = np.dot(probs, values)
         # calculate standard deviation
-        sigma = 0.
-        for symbol in self.getTrackSymbols(trackNo):
-            actualValue = float(catMap.getMapBack(symbol))
-            prob = np.exp(self.logProbs[trackNo][state][symbol])
-            sigma += np.square(actualValue - mu) * prob
-        sigma = np.sqrt(sigma)
-
-        return mu, max(sigma, EPSILON)
+        sigma = np.sqrt(np.sum(np.square(values - mu[:, np.newaxis]) * probs,
+                               axis=1))
+        sigma = np.maximum(sigma, EPSILON)
+        if np.isscalar(state):
+            return mu[0], sigma[0]
+        return mu, sigma
 
     def applyGaussian(self, track, state, logProbs = None):
         """ feed gaussian parameters back into log probability matrix to
         turn the emission model into a guassian. (ie this is the only time
         the gaussian probabilities are computed. afterword, it behaves
         identically to the pure multinomial since all probabilitis come from
-        this matrix without being recomputed)"""
-        catMap = track.getValueMap()
+        this matrix without being recomputed).  state can be a single
+        state or an array of states"""
         trackNo = track.getNumber()
         if logProbs is None:
             logProbs = self.logProbs
+        states = np.atleast_1d(state)
+        symbols, values = self.getMapBackVector(track)
         uniformProb = 1. / float(self.numSymbolsPerTrack[trackNo])
         uniformProb *= self.uniformMixProb
-        for symbol in self.getTrackSymbols(trackNo):
-            actualValue = float(catMap.getMapBack(symbol))
-            prob = stats.norm.pdf(actualValue,
-                                  loc=self.gaussParams[trackNo, state, 0],
-                                  scale=self.gaussParams[trackNo, state, 1])
-
-            # correct for zero values (probabilites too far from mean)
-            # by mixing in a uniform distribution
-            prob = uniformProb + (1. - self.uniformMixProb) * prob
-            assert prob > EPSILON
-                
-            logProbs[trackNo][state][symbol] = myLog(prob)
+        probs = stats.norm.pdf(
+            values, loc=self.gaussParams[trackNo, states, 0][:, np.newaxis],
+            scale=self.gaussParams[trackNo, states, 1][:, np.newaxis])
+
+        # correct for zero values (probabilites too far from mean)
+        # by mixing in a uniform distribution
+        probs = uniformProb + (1. - self.uniformMixProb) * probs
+        assert np.all(probs > EPSILON)
 
         # normalize
-        probs = np.exp(logProbs[trackNo][state])
-        tot = 0.
-        for symbol in self.getTrackSymbols(trackNo):
-            tot += probs[symbol]
-        assert tot > 0.
-        for symbol in self.getTrackSymbols(trackNo):
-            logProbs[trackNo][state][symbol] = myLog(probs[symbol] / tot)
+        tot = np.sum(probs, axis=1)
+        assert np.all(tot > 0.)
+        logProbs[trackNo][np.ix_(states, symbols)] = myLogArray(
+            probs / tot[:, np.newaxis])
  
     def getGaussianParams(self, trackNo, state):
         return self.gaussParams[trackNo ,state]
+
+    def getParamArrays(self):
+        arrays = super(IndependentMultinomialAndGaussianEmissionModel,
+                       self).getParamArrays()
+        arrays["gaussParams"] = self.gaussParams
+        return arrays
     
     ### Overloaded functions -- just tack on a makeGaussian at end###
     def maximize(self, obsStats, trackList):
@@ -592,6 +802,11 @@ class IndependentMultinomialAndGaussianEmissionModel(
             obsStats)
         self.makeGaussian(trackList)
 
+    def setProbs(self, probs, trackList):
+        super(IndependentMultinomialAndGaussianEmissionModel, self).setProbs(
+            probs)
+        self.makeGaussian(trackList)
+
     def applyUserEmissionLine(self, track, state, toks, logProbs, mask):
         """ Expecting line of form TRACK STATE MEAN STDEV, and updates the
         logprobs , mask structures accordingly """
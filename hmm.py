@@ -50,18 +50,65 @@ from collections import Iterable
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 from .emission import IndependentMultinomialAndGaussianEmissionModel
+from ._emission import canFast
 from .track import TrackList, TrackTable, Track
-from .common import EPSILON, myLog, logger
+from .common import EPSILON, LOGZERO, myLog, logger
 from .basehmm import BaseHMM, check_random_state, NEGINF, ZEROLOGPROB, logsumexp
 from .basehmm import normalize
 from . import _hmm
 
+# Use the sparse (CSR edge list) versions of the dynamic programming kernels
+# when at most this fraction of the transition matrix is nonzero
+SPARSE_TRANS_DENSITY = 0.5
+
+# With run-length compression (compressRuns), only runs of identical columns
+# at least this many times the number of states are worth raising the
+# transfer matrix to a power for.  Shorter runs are stepped through normally
+RUN_COMPRESSION_FACTOR = 4
+# default online EM settings (see fitOnline())
+ONLINE_STEP_DECAY = 0.5
+ONLINE_CHUNK_SIZE = 100000
+ONLINE_HELD_OUT = 0.1
+# the held out chunks are picked with this seed rather than the model's
+# random state, so that replicates are all scored on the same ones
+ONLINE_HELD_OUT_SEED = 0
+# SQUAREM extrapolation (see fitSquarem()) never takes a step longer than
+# this (in units of the last EM update), and never lowers a probability that
+# plain EM left above zero below SQUAREM_MIN_PROB.  The actual limit starts
+# at SQUAREM_INIT_STEP and is adapted by SQUAREM_STEP_FACTOR
+SQUAREM_MAX_STEP = 256.
+SQUAREM_INIT_STEP = 64.
+SQUAREM_STEP_FACTOR = 4.
+SQUAREM_MIN_PROB = 1e-10
+
 """
 This class is based on the MultinomialHMM from sckikit-learn, but we make
 the emission model a parameter. The custom emission model we support at this
 point is a multi-*dimensional* multinomial. 
 """
 class MultitrackHmm(BaseHMM):
+    # default for models pickled before the option was added
+    compressRuns = False
+    # online EM options (see fitOnline())
+    onlineBatchSize = None
+    onlineStepDecay = ONLINE_STEP_DECAY
+    onlineChunkSize = ONLINE_CHUNK_SIZE
+    onlineHeldOut = ONLINE_HELD_OUT
+    # SQUAREM accelerated EM (see fitSquarem())
+    accelerate = False
+    # DPWorkspace, created on demand and never pickled
+    workspace = None
+    # ParamSnapshot of the best iteration for maxProb (only while training)
+    bestSnapshot = None
+    # distributedEm.EmWorkerPool that runs the E-step (only while training)
+    emPool = None
+    # (stats, log prob) of the last E-step of fit() if it was done at the
+    # final parameters, and of an E-step to use instead of the first one of
+    # the next fit() (which then carries on the iteration count).  These
+    # let training resume without redoing an E-step (neither is pickled)
+    lastEstep = None
+    resumeEstep = None
+
     def __init__(self, emissionModel=None,
                  startprob=None,
                  transmat=None, startprob_prior=None, transmat_prior=None,
@@ -78,7 +125,13 @@ class MultitrackHmm(BaseHMM):
                  forceUserStart=None,
                  transMatEpsilons=False,
                  maxProb=False,
-                 maxProbCut=None):
+                 maxProbCut=None,
+                 compressRuns=False,
+                 onlineBatchSize=None,
+                 onlineStepDecay=ONLINE_STEP_DECAY,
+                 onlineChunkSize=ONLINE_CHUNK_SIZE,
+                 onlineHeldOut=ONLINE_HELD_OUT,
+                 accelerate=False):
         if emissionModel is not None:
             n_components = emissionModel.getNumStates()
         else:
@@ -146,31 +199,93 @@ class MultitrackHmm(BaseHMM):
         # returning the last one
         self.maxProb = maxProb
         self.best_forward_log_prob = None
-        self.bestCopy = None
+        self.bestSnapshot = None
         self.maxProbCut = maxProbCut
         # keep track of free parameterse wrt user settings for bic computation
         self.numZeroInitEdges = 0
         self.numZeroInitStarts = 0
+        # exact run-length compressed decoding (see _get_runs())
+        self.compressRuns = compressRuns
+        # online (stepwise) EM instead of Baum-Welch when batch size set
+        # (see fitOnline())
+        self.onlineBatchSize = onlineBatchSize
+        self.onlineStepDecay = onlineStepDecay
+        self.onlineChunkSize = onlineChunkSize
+        self.onlineHeldOut = onlineHeldOut
+        # extrapolate the EM updates with SQUAREM (see fitSquarem())
+        self.accelerate = accelerate
+        
+    def __getstate__(self):
+        """ Leave the workspace buffers out of pickles and (deep)copies """
+        state = self.__dict__.copy()
+        state.pop("workspace", None)
+        state.pop("bestSnapshot", None)
+        state.pop("emPool", None)
+        state.pop("lastEstep", None)
+        state.pop("resumeEstep", None)
+        return state
+
+    def _get_workspace(self):
+        """ Get the preallocated buffers used by the dynamic programming """
+        if self.workspace is None:
+            self.workspace = DPWorkspace()
+        return self.workspace
         
     def train(self, trackData):
         """ Use EM to estimate best parameters from scratch (unsupervised)"""
-        self.bestCopy = None
+        self.bestSnapshot = None
         self.trackList = trackData.getTrackList()
-        self.fit(trackData.getTrackTableList())
+        if self.onlineBatchSize is not None and self.onlineBatchSize > 0:
+            self.resumeEstep = None
+            self.fitOnline(trackData.getTrackTableList())
+            self.lastEstep = None
+        elif self.accelerate is True:
+            self.resumeEstep = None
+            self.fitSquarem(trackData.getTrackTableList())
+            self.lastEstep = None
+        else:
+            self.fit(trackData.getTrackTableList())
         if self.maxProb is True:
-            assert self.bestCopy is not None
+            self.lastEstep = None
+            assert self.bestSnapshot is not None
             logger.info("HMM parameters learned from maxProb iteration %d"
                         " with logprob=%f" % (
-                 self.bestCopy.last_forward_log_prob_it-1,
-                 self.bestCopy.last_forward_log_prob))
-            self.emissionModel = self.bestCopy.emissionModel
-            self.transmat_ = self.bestCopy.transmat_
-            self._log_transmat = self.bestCopy._log_transmat
-            self.startprob_ = self.bestCopy.startprob_
-            self.last_forward_log_prob = self.bestCopy.last_forward_log_prob
-            self.last_forward_log_prob_it = self.bestCopy.last_forward_log_prob_it
+                 self.bestSnapshot.values["last_forward_log_prob_it"]-1,
+                 self.bestSnapshot.values["last_forward_log_prob"]))
+            self._restore_snapshot(self.bestSnapshot)
+            self.bestSnapshot = None
         self.validate()
 
+    def _save_snapshot(self, snapshot = None):
+        """ Copy the trainable parameters (start and transition log probs
+        and the emission parameters), along with the likelihood bookkeeping,
+        into a ParamSnapshot.  Passing in the previous snapshot reuses its
+        arrays so that this doesn't allocate anything."""
+        if snapshot is None:
+            snapshot = ParamSnapshot()
+        arrays = {"_log_startprob" : self._log_startprob,
+                  "_log_transmat" : self._log_transmat}
+        for name, array in self.emissionModel.getParamArrays().items():
+            arrays["emissionModel." + name] = array
+        snapshot.save(arrays,
+                      last_forward_log_prob = self.last_forward_log_prob,
+                      last_forward_log_prob_it = self.last_forward_log_prob_it,
+                      current_iteration = self.current_iteration)
+        return snapshot
+
+    def _restore_snapshot(self, snapshot):
+        """ Set the parameters back to those saved by _save_snapshot() """
+        emArrays = dict()
+        for name, array in snapshot.arrays.items():
+            if name.startswith("emissionModel."):
+                emArrays[name[len("emissionModel."):]] = np.copy(array)
+            else:
+                setattr(self, name, np.copy(array))
+        self.emissionModel.setParamArrays(emArrays)
+        self.last_forward_log_prob = snapshot.values["last_forward_log_prob"]
+        self.last_forward_log_prob_it = snapshot.values[
+            "last_forward_log_prob_it"]
+
     def supervisedTrain(self, trackData, bedIntervals):
         """ Train directly from set of known states (4th column in the
         bedIntervals provided.  We assume that the most likely parameters
@@ -336,13 +451,14 @@ class MultitrackHmm(BaseHMM):
         return self.last_forward_log_prob
 
     def validate(self):
-        assert len(self.startprob_) == self.emissionModel.getNumStates()
-        assert not isinstance(self.startprob_[0], Iterable)
-        assert len(self.transmat_) == self.emissionModel.getNumStates()
-        assert len(self.transmat_[0]) == self.emissionModel.getNumStates()
-        assert_array_almost_equal(np.sum(self.startprob_), 1.)
-        for i in xrange(self.emissionModel.getNumStates()):
-            assert_array_almost_equal(np.sum(self.transmat_[i]), 1.)
+        N = self.emissionModel.getNumStates()
+        startprob = self.startprob_
+        transmat = self.transmat_
+        assert len(startprob) == N
+        assert not isinstance(startprob[0], Iterable)
+        assert transmat.shape == (N, N)
+        assert_array_almost_equal(np.sum(startprob), 1.)
+        assert_array_almost_equal(np.sum(transmat, axis=1), np.ones(N))
         self.emissionModel.validate()
         
     def applyUserEmissions(self, userEmLines):
@@ -524,6 +640,14 @@ class MultitrackHmm(BaseHMM):
     def _compute_log_likelihood(self, obs):
         return self.emissionModel.allLogProbs(obs)
 
+    def _workspace_log_likelihood(self, obs):
+        """ Same as _compute_log_likelihood() but written into a workspace
+        buffer, which is overwritten by the next call.  Only for callers
+        that are done with the result before then (see DPWorkspace) """
+        return self.emissionModel.allLogProbs(
+            obs, self._get_workspace().get("framelogprob",
+                                           (len(obs), self.n_components)))
+
     def _generate_sample_from_state(self, state, random_state=None):
         return self.emissionModel.sample(state)
         
@@ -556,14 +680,24 @@ class MultitrackHmm(BaseHMM):
             # when the sample is of length 1, it contains no transitions
             # so there is no reason to update our trans. matrix estimate
             if n_observations > 1:
-                logsum_lneta = np.zeros((n_components, n_components))
+                logsum_lneta = self._get_workspace().get(
+                    "logsum_lneta", (n_components, n_components))
+                logsum_lneta.fill(0.)
 
                 lnP = logsumexp(fwdlattice[-1])
-                _hmm._log_sum_lneta(n_observations, n_components, fwdlattice,
-                                     self._log_transmat, bwdlattice,
-                                     framelogprob, lnP,
-                                     self.emissionModel.getSegmentRatios(obs),
-                                     logsum_lneta)
+                sparseTrans = self._get_sparse_transitions()
+                if sparseTrans is not None:
+                    _hmm._log_sum_lneta_sparse(
+                        n_observations, n_components, fwdlattice,
+                        self._log_transmat, bwdlattice, framelogprob, lnP,
+                        self.emissionModel.getSegmentRatios(obs),
+                        sparseTrans[2], sparseTrans[3], logsum_lneta)
+                else:
+                    _hmm._log_sum_lneta(n_observations, n_components,
+                                        fwdlattice, self._log_transmat,
+                                        bwdlattice, framelogprob, lnP,
+                                        self.emissionModel.getSegmentRatios(obs),
+                                        logsum_lneta)
 
                 stats["trans"] += np.exp(logsum_lneta)
 
@@ -573,6 +707,71 @@ class MultitrackHmm(BaseHMM):
 
         logger.debug("ending MultitrackHMM E-step")
 
+    def _do_estep(self, obs):
+        """ Hand the E-step off to the worker pool if there is one.  The
+        workers only return the log probabilities, so the forward log prob
+        bookkeeping that _do_forward_pass() would have done is done here
+        (in the same order) instead """
+        if self.resumeEstep is not None:
+            stats, lp = self.resumeEstep
+            self.resumeEstep = None
+            self.last_forward_log_prob = lp
+            self.last_forward_log_prob_it = self.current_iteration
+        elif self.emPool is None:
+            stats, lp = super(MultitrackHmm, self)._do_estep(obs)
+        else:
+            stats, logProbs = self.emPool.estep(self)
+            for lp in logProbs:
+                self._track_forward_log_prob(lp)
+            lp = sum(logProbs)
+        self.lastEstep = (stats, lp)
+        return stats, lp
+
+    def _do_sequence_estep(self, stats, seq):
+        """ Override the generic E-step to run the forward pass followed by
+        the fused Cython kernel, which computes the backward pass,
+        posteriors and all sufficient statistics in a single sweep
+        (so neither the backward lattice nor the posterior matrix is ever
+        created).  Falls back to the original for observations that
+        the Cython code can't handle, and when the emission model has more
+        than one thread: the fused sweep runs on one thread, whereas the
+        original accumulates the emission statistics in parallel (see
+        emission.fastAccumulateStats()).  Either way, the lattices are
+        workspace buffers."""
+        framelogprob = self._workspace_log_likelihood(seq)
+        lpr, fwdlattice = self._workspace_forward_pass(framelogprob, seq)
+        if not canFast(seq) or self.emissionModel.numThreads > 1:
+            bwdlattice = self._workspace_backward_pass(framelogprob, seq)
+            gamma = fwdlattice + bwdlattice
+            posteriors = np.exp(gamma.T - logsumexp(gamma, axis=1)).T
+            self._accumulate_sufficient_statistics(
+                stats, seq, framelogprob, posteriors, fwdlattice,
+                bwdlattice, self.params)
+            return lpr
+        n_observations, n_components = framelogprob.shape
+        logger.debug("%d: beginning fused MultitrackHMM E-step on %d x %d "
+                     "matrix" % (self.current_iteration, n_observations,
+                                 n_components))
+        obsArray = seq
+        if isinstance(seq, TrackTable):
+            obsArray = seq.getNumPyArray()
+        # the fused kernel only works on edge lists, so get them regardless
+        # of density
+        succPtr, succIdx = self._get_sparse_transitions(maxDensity=1.0)[2:]
+        stats['nobs'] += 1
+        # when the sample is of length 1, it contains no transitions
+        # so there is no reason to update our trans. matrix estimate
+        _hmm._fused_estep(n_observations, n_components, fwdlattice,
+                          self._log_transmat, framelogprob, obsArray,
+                          self.emissionModel.getSegmentRatios(seq), lpr,
+                          succPtr, succIdx,
+                          int('s' in self.params),
+                          int('t' in self.params and n_observations > 1),
+                          int('e' in self.params),
+                          stats['start'], stats['trans'], stats['obs'])
+        logger.debug("ending fused MultitrackHMM E-step")
+        return lpr
+
     def _do_mstep(self, stats, params):
         logger.debug("%d: beginning MultitrackHMM M-step" %
                       self.current_iteration)
@@ -604,8 +803,11 @@ class MultitrackHmm(BaseHMM):
         logger.debug("%d: ending MultitrackHMM M-step" %
                       self.current_iteration)
         self.current_iteration += 1
+        self._apply_force_user_params()
+        self.validate()
 
-        # apply the force user params if specified
+    def _apply_force_user_params(self):
+        """ apply the force user params if specified """
         if self.forceUserTrans is not None:
             self.applyUserTrans(self.forceUserTrans)
         if self.forceUserEmissions is not None:
@@ -613,12 +815,274 @@ class MultitrackHmm(BaseHMM):
         if self.forceUserStart is not None:
             self.applyUserStarts(self.forceUserStart)
 
-        self.validate()
-
     def fit(self, obs, **kwargs):
-        self.current_iteration = 1
+        """ Baum-Welch.  If resumeEstep is set, it is used as the first
+        E-step, and the iterations are counted on from current_iteration """
+        if self.resumeEstep is None:
+            self.current_iteration = 1
+        self.lastEstep = None
         return BaseHMM.fit(self, obs, **kwargs)
 
+    def fitOnline(self, obs):
+        """ Stepwise (online) EM.  Instead of doing an M-step after each
+        full pass over the data, the E-step is done on random minibatches
+        of onlineBatchSize tables (or chunks of at most onlineChunkSize
+        columns of unsegmented tables) and its statistics, scaled up to the
+        size of the whole data, are blended into running statistics with
+        step size (k+2)^-onlineStepDecay.  An M-step is done after every
+        minibatch.  n_iter is the number of passes over the data, and
+        convergence (thresh) and maxProb are based on the log probability
+        of a held out fraction (onlineHeldOut) of the chunks, computed after
+        each pass (or the whole data if nothing is held out).  This is
+        also the log probability the model is left with, so the held out
+        chunks don't depend on the random state (see
+        _split_online_units()), for replicates to be comparable """
+        assert self.emPool is None
+        self._init(obs, self.init_params)
+        self.current_iteration = 1
+        units = self._get_online_units(obs)
+        train, heldOut = self._split_online_units(units)
+        numHeldOut = len(units) - len(train)
+        totalLength = float(sum([len(x) for x in train]))
+        logger.info("Online EM on %d chunks with %d held out" % (
+            len(train), numHeldOut))
+
+        # the forward pass shouldn't do the maxProb bookkeeping on the
+        # minibatches.  we do it on the held out probabilities instead
+        maxProb = self.maxProb
+        self.maxProb = False
+        initStats = self._initialize_sufficient_statistics()
+        runningStats = None
+        step = 0
+        logprob = []
+        for i in xrange(self.n_iter):
+            order = self.random_state.permutation(len(train))
+            for batchStart in xrange(0, len(order), self.onlineBatchSize):
+                batch = [train[j] for j in
+                         order[batchStart:batchStart + self.onlineBatchSize]]
+                stats, lp = self._do_estep(batch)
+                scale = totalLength / float(sum([len(x) for x in batch]))
+                eta = np.power(step + 2., -self.onlineStepDecay)
+                if runningStats is None:
+                    eta = 1.
+                    runningStats = dict()
+                for key in stats:
+                    batchStats = scale * (stats[key] - initStats[key])
+                    if key in runningStats:
+                        runningStats[key] = (1. - eta) * runningStats[key] + \
+                                            eta * batchStats
+                    else:
+                        runningStats[key] = batchStats
+                self._do_mstep(dict([(key, initStats[key] + runningStats[key])
+                                     for key in runningStats]), self.params)
+                step += 1
+
+            # evaluate on held out data
+            lp = 0.
+            for unit in heldOut:
+                lp += self._workspace_forward_pass(
+                    self._workspace_log_likelihood(unit), unit)[0]
+            logprob.append(lp)
+            self.last_forward_log_prob = lp
+            self.last_forward_log_prob_it = i + 1
+            logMsgString = "Online EM pass %d (%d M-steps): held out " \
+                           "LogProb %f" % (i, step, lp)
+            if i > 0:
+                logMsgString += " (delta %f)" % (logprob[-1] - logprob[-2])
+            logger.info(logMsgString)
+            if maxProb is True and (self.best_forward_log_prob is None or
+                                    i == 0 or
+                                    lp > self.best_forward_log_prob):
+                self.best_forward_log_prob = lp
+                self.bestSnapshot = self._save_snapshot(self.bestSnapshot)
+            if (maxProb is True and self.maxProbCut is not None and i + 1 -
+                self.bestSnapshot.values["last_forward_log_prob_it"] >
+                self.maxProbCut):
+                logger.info("Stopping due to --maxProbCut %d" % self.maxProbCut)
+                break
+            if i > 0 and abs(logprob[-1] - logprob[-2]) < self.thresh:
+                logger.debug("Coverged.  Logprobhistory: %s" % str(logprob))
+                break
+        self.maxProb = maxProb
+        return self
+
+    def fitSquarem(self, obs):
+        """ EM accelerated with SQUAREM (Varadhan and Roland 2008).  After
+        two regular EM updates p0 -> p1 -> p2 of the free probabilities
+        (start, transition and emission distributions in params), jump to
+        p0 - 2a(p1 - p0) + a^2(p2 - 2p1 + p0), with step length
+        a = -|p1 - p0| / |p2 - 2p1 + p0| clamped to [-maxStep, -1]
+        (a = -1 is just p2).  The result is clipped back onto the simplex and
+        the force user parameters are reapplied.  The E-step at the
+        extrapolated parameters gives their log probability: if it is worse
+        than that of p1 then the jump is thrown out and we carry on from
+        p2, which plain EM guarantees to be at least as good as p1, and
+        maxStep is cut by SQUAREM_STEP_FACTOR.  Otherwise it starts the next
+        cycle (and maxStep is raised if the jump was limited by it).  n_iter
+        is the maximum number of E-steps, as for fit()"""
+        self._init(obs, self.init_params)
+        self.current_iteration = 1
+        # the forward pass shouldn't do the maxProb bookkeeping, since
+        # the parameters don't change through M-steps alone.  it's done
+        # on the E-step log probabilities below instead
+        maxProb = self.maxProb
+        self.maxProb = False
+        logprob = []
+        # probabilities at the start of the current cycle, after one and
+        # after two EM updates
+        cycle = []
+        # log probability of p1, and snapshot of p2, while testing a jump
+        cycleLogProb = None
+        fallback = None
+        maxStep = SQUAREM_INIT_STEP
+        alpha = None
+        numJumps = 0
+        numRejects = 0
+        for i in xrange(self.n_iter):
+            stats, lp = self._do_estep(obs)
+            self.last_forward_log_prob = lp
+            self.last_forward_log_prob_it = i + 1
+            logMsgString = "SQUAREM Iteration %d: LogProb %f" % (i, lp)
+            if len(logprob) > 0:
+                logMsgString += " (delta %f)" % (lp - logprob[-1])
+            logger.info(logMsgString)
+            if fallback is not None and lp < cycleLogProb:
+                # jump made things worse: back to the EM update
+                logger.debug("SQUAREM step rejected")
+                numRejects += 1
+                # shorten the steps (but never to 1, where they could no
+                # longer grow back)
+                maxStep = max(2., -alpha / SQUAREM_STEP_FACTOR)
+                self._restore_snapshot(fallback)
+                self.current_iteration += 1
+                fallback = None
+                cycle = []
+                continue
+            if fallback is not None and alpha == -maxStep:
+                maxStep = min(SQUAREM_MAX_STEP, maxStep * SQUAREM_STEP_FACTOR)
+            fallback = None
+            logprob.append(lp)
+            if maxProb is True and (self.best_forward_log_prob is None or
+                                    len(logprob) == 1 or
+                                    lp > self.best_forward_log_prob):
+                self.best_forward_log_prob = lp
+                self.bestSnapshot = self._save_snapshot(self.bestSnapshot)
+            if (maxProb is True and self.maxProbCut is not None and i + 1 -
+                self.bestSnapshot.values["last_forward_log_prob_it"] >
+                self.maxProbCut):
+                logger.info("Stopping due to --maxProbCut %d" % self.maxProbCut)
+                break
+            if len(logprob) > 1 and abs(logprob[-1] - logprob[-2]) < \
+               self.thresh:
+                logger.debug("Coverged.  Logprobhistory: %s" % str(logprob))
+                break
+            if i == self.n_iter - 1:
+                break
+
+            if len(cycle) == 0:
+                cycle.append(self._get_prob_params())
+            self._do_mstep(stats, self.params)
+            cycle.append(self._get_prob_params())
+            if len(cycle) < 3:
+                continue
+
+            # extrapolate
+            cycleLogProb = lp
+            p0, p1, p2 = cycle
+            cycle = []
+            r = [x1 - x0 for x0, x1 in zip(p0, p1)]
+            v = [x2 - 2. * x1 + x0 for x0, x1, x2 in zip(p0, p1, p2)]
+            rNorm = np.sqrt(sum([np.sum(np.square(x)) for x in r]))
+            vNorm = np.sqrt(sum([np.sum(np.square(x)) for x in v]))
+            if vNorm == 0.:
+                continue
+            alpha = min(-1., max(-maxStep, -rNorm / vNorm))
+            if alpha == -1.:
+                continue
+            logger.debug("SQUAREM step length %f" % alpha)
+            fallback = self._save_snapshot(fallback)
+            self._set_prob_params(
+                [x0 - 2. * alpha * xr + alpha * alpha * xv
+                 for x0, xr, xv in zip(p0, r, v)], p2)
+            self.current_iteration += 1
+            numJumps += 1
+        logger.info("SQUAREM took %d steps (%d rejected) in %d iterations" % (
+            numJumps, numRejects, i + 1))
+        self.maxProb = maxProb
+        return self
+
+    def _get_prob_params(self):
+        """ Copy of the distributions that are being trained (according to
+        params) as a list of probability arrays (see fitSquarem()) """
+        probs = []
+        if 's' in self.params:
+            probs.append(np.copy(self.startprob_))
+        if 't' in self.params:
+            probs.append(np.copy(self.transmat_))
+        if 'e' in self.params:
+            probs.append(np.exp(self.emissionModel.getLogProbs()))
+        return probs
+
+    def _set_prob_params(self, probs, support):
+        """ Set the distributions from a list like _get_prob_params().  The
+        probabilities are projected back onto the simplex: zeros in
+        support (ie edges that EM leaves at 0) stay 0 and everything else
+        is kept above SQUAREM_MIN_PROB before normalizing.  The force user
+        parameters are then applied over top """
+        probs = [np.where(y > 0., np.maximum(x, SQUAREM_MIN_PROB), 0.)
+                 for x, y in zip(probs, support)]
+        probs.reverse()
+        if 's' in self.params:
+            self.startprob_ = normalize(probs.pop())
+        if 't' in self.params:
+            transmat = probs.pop()
+            rowSums = np.sum(transmat, axis=1)
+            # orphaned states keep their rows
+            transmat[rowSums == 0.] = self.transmat_[rowSums == 0.]
+            rowSums[rowSums == 0.] = 1.
+            self.transmat_ = transmat / rowSums[:, np.newaxis]
+        if 'e' in self.params:
+            self.emissionModel.setProbs(probs.pop(), self.trackList)
+        assert len(probs) == 0
+        self._apply_force_user_params()
+        self.validate()
+
+    def _get_online_units(self, obs):
+        """ Split the observations into the units that get sampled by
+        online EM: the track tables, with unsegmented tables longer than
+        onlineChunkSize cut into chunks.  The chunks are track tables
+        that share the data of the originals (see getSubTable()), so that
+        the emission model can still use their distinct columns """
+        units = []
+        for table in obs:
+            if self.onlineChunkSize is None or \
+               len(table) <= self.onlineChunkSize or \
+               not isinstance(table, TrackTable) or \
+               table.getSegmentOffsets() is not None:
+                units.append(table)
+            else:
+                for start in xrange(0, len(table), self.onlineChunkSize):
+                    units.append(table.getSubTable(
+                        start, min(start + self.onlineChunkSize, len(table))))
+        return units
+
+    def _split_online_units(self, units):
+        """ Split the units of online EM into (training, held out) lists.
+        onlineHeldOut of them (at least one, if there are two or more) are
+        held out, picked with ONLINE_HELD_OUT_SEED so that they're the
+        same for every replicate.  If none are, the held out list is the
+        training list """
+        order = np.random.RandomState(ONLINE_HELD_OUT_SEED).permutation(
+            len(units))
+        numHeldOut = int(self.onlineHeldOut * len(units))
+        if self.onlineHeldOut > 0 and len(units) > 1:
+            numHeldOut = min(max(numHeldOut, 1), len(units) - 1)
+        heldOut = [units[i] for i in sorted(order[:numHeldOut])]
+        train = [units[i] for i in sorted(order[numHeldOut:])]
+        if len(heldOut) == 0:
+            heldOut = train
+        return train, heldOut
+
     # Getting annoyed with epsilons being added by scikit learn
     # so redo tranmat property to allow zeros (should probably do
     # for start probs as well at some point)
@@ -664,39 +1128,276 @@ class MultitrackHmm(BaseHMM):
         self._log_startprob = myLog(np.asarray(startprob).copy())
 
     startprob_ = property(_get_startprob, _set_startprob)
+
+    def _get_sparse_transitions(self, maxDensity=SPARSE_TRANS_DENSITY):
+        """ Return CSR-style lists of the nonzero transitions as a tuple
+        of int32 arrays (predPtr, predIdx, succPtr, succIdx), where the
+        predecessors of state j are predIdx[predPtr[j]:predPtr[j+1]] and the
+        successors of state i are succIdx[succPtr[i]:succPtr[i+1]].  None
+        is returned if more than maxDensity of the matrix is nonzero (ie it
+        is too dense for the sparse kernels to be worthwhile).  Building
+        the lists is O(M^2) so we don't bother caching them."""
+        edges = self._log_transmat > LOGZERO
+        if np.sum(edges) > maxDensity * edges.size:
+            return None
+        predPtr = np.zeros(self.n_components + 1, dtype=np.int32)
+        predPtr[1:] = np.cumsum(np.sum(edges, axis=0))
+        predIdx = np.nonzero(edges.T)[1].astype(np.int32)
+        succPtr = np.zeros(self.n_components + 1, dtype=np.int32)
+        succPtr[1:] = np.cumsum(np.sum(edges, axis=1))
+        succIdx = np.nonzero(edges)[1].astype(np.int32)
+        return predPtr, predIdx, succPtr, succIdx
     
+    def _decode_viterbi(self, obs):
+        """ Overrides the BaseHMM version so that (unsegmented) TrackTables
+        are not converted into numpy arrays row by row, which would lose
+        their cached distinct columns and runs """
+        if not isinstance(obs, TrackTable) or\
+          self.emissionModel.getSegmentRatios(obs) is not None:
+            return super(MultitrackHmm, self)._decode_viterbi(obs)
+        framelogprob = self._workspace_log_likelihood(obs)
+        return self._do_viterbi_pass(framelogprob, obs = obs)
+
+    def score_samples(self, obs):
+        """ Overrides the BaseHMM version to use exact run-length compressed
+        inference when enabled (see _get_runs()) """
+        runs = self._get_runs(obs)
+        if runs is None:
+            return super(MultitrackHmm, self).score_samples(obs)
+        framelogprob = self._workspace_log_likelihood(obs)
+        logprob, posteriors = self._do_compressed_posteriors(framelogprob,
+                                                             runs)
+        posteriors += np.finfo(np.float32).eps
+        posteriors /= np.sum(posteriors, axis=1).reshape((-1, 1))
+        return logprob, posteriors
+
+    def _get_runs(self, obs):
+        """ For exact run-length compressed inference, the table is cut
+        into blocks that are either a long run (see RUN_COMPRESSION_FACTOR)
+        of identical columns, or a stretch of positions between them.  A
+        tuple of arrays (starts, lengths, columns) is returned, where
+        columns is the index of the distinct column (in
+        TrackTable.getUniqueColumns()) for each long run, and -1 for each
+        stretch.  None is returned if compressRuns isn't set or the
+        observations are not an (unsegmented) TrackTable."""
+        if self.compressRuns is False or not isinstance(obs, TrackTable) or\
+          len(obs) == 0 or\
+          self.emissionModel.getSegmentRatios(obs) is not None:
+            return None
+        inverse = obs.getUniqueColumns()[1]
+        runStarts = np.append([0], np.nonzero(inverse[1:] !=
+                                              inverse[:-1])[0] + 1)
+        runLengths = np.diff(np.append(runStarts, len(inverse)))
+        isLong = runLengths >= RUN_COMPRESSION_FACTOR * self.n_components
+        # merge consecutive short runs into stretches
+        blockFlags = np.copy(isLong)
+        blockFlags[0] = True
+        blockFlags[1:] |= isLong[:-1]
+        starts = runStarts[blockFlags]
+        lengths = np.diff(np.append(starts, len(inverse)))
+        columns = np.where(isLong[blockFlags], inverse[starts], -1)
+        logger.debug("Run-length compression: %d positions in %d blocks "
+                     "(%d long runs)" % (len(inverse), len(starts),
+                                         np.sum(columns >= 0)))
+        return starts, lengths, columns
+
+    def _run_factors(self, steps):
+        """ Decompose a run of steps into powers of two (returned as list of
+        exponents) """
+        return [k for k in xrange(int(steps).bit_length()) if steps >> k & 1]
+
+    def _do_compressed_forward_pass(self, framelogprob, runs, powers):
+        """ Forward algorithm over the blocks returned by _get_runs().
+        Returns the log probability and the forward vector at the last
+        position of each block (rather than the full lattice)."""
+        starts, lengths, columns = runs
+        alphas = np.empty((len(starts), self.n_components))
+        alpha = self._log_startprob + framelogprob[0]
+        buf = np.empty(self.n_components)
+        for b in xrange(len(starts)):
+            first = starts[b] if b > 0 else 1
+            last = starts[b] + lengths[b]
+            if columns[b] < 0:
+                _hmm._forward_steps(alpha, self._log_transmat,
+                                    framelogprob[first:last])
+            else:
+                for k in self._run_factors(last - first):
+                    _hmm._log_vecmat(alpha, powers.get(
+                        columns[b], framelogprob[starts[b]], k), buf)
+                    alpha, buf = buf, alpha
+            alphas[b] = alpha
+        return logsumexp(alpha), alphas
+
+    def _do_compressed_backward_pass(self, framelogprob, runs, powers):
+        """ Backward algorithm over the blocks returned by _get_runs().
+        Returns the backward vector at the last position of each block."""
+        starts, lengths, columns = runs
+        betas = np.empty((len(starts), self.n_components))
+        beta = np.log(np.ones(self.n_components) / self.n_components)
+        buf = np.empty(self.n_components)
+        betas[-1] = beta
+        for b in xrange(len(starts) - 1, 0, -1):
+            first = starts[b]
+            last = starts[b] + lengths[b]
+            if columns[b] < 0:
+                _hmm._backward_steps(beta, self._log_transmat,
+                                     framelogprob[first:last])
+            else:
+                for k in self._run_factors(last - first):
+                    _hmm._log_matvec(powers.get(
+                        columns[b], framelogprob[starts[b]], k), beta, buf)
+                    beta, buf = buf, beta
+            betas[b - 1] = beta
+        return betas
+
+    def _do_compressed_posteriors(self, framelogprob, runs):
+        """ Posterior distribution using the compressed forward and backward
+        passes, which give the exact forward and backward vectors at each
+        block boundary.  The posteriors within each block are then
+        expanded back to every position (which costs as much as the
+        uncompressed forward-backward, but never stores the full
+        lattices)."""
+        starts, lengths, columns = runs
+        powers = TransferPowers(self._log_transmat, maxPlus=False)
+        logprob, alphas = self._do_compressed_forward_pass(framelogprob, runs,
+                                                           powers)
+        betas = self._do_compressed_backward_pass(framelogprob, runs, powers)
+        posteriors = np.empty(framelogprob.shape)
+        posteriors[0] = self._log_startprob + framelogprob[0]
+        for b in xrange(len(starts)):
+            first = starts[b]
+            last = starts[b] + lengths[b]
+            _hmm._stretch_posteriors(alphas[b - 1] if b > 0 else None,
+                                     betas[b], self._log_transmat,
+                                     framelogprob[first:last],
+                                     posteriors[first:last])
+        return logprob, posteriors
+
+    def _do_compressed_viterbi_pass(self, framelogprob, runs):
+        """ Viterbi over the blocks returned by _get_runs(), using max-plus
+        powers of the transfer matrix for long runs.  The path through
+        each power is expanded back to individual positions using the
+        midpoints stored when squaring (see TransferPowers)"""
+        starts, lengths, columns = runs
+        n_observations = framelogprob.shape[0]
+        powers = TransferPowers(self._log_transmat, maxPlus=True)
+        delta = self._log_startprob + framelogprob[0]
+        buf = np.empty(self.n_components)
+        # for each step: (last position, column, exponent, traceback)
+        steps = []
+        for b in xrange(len(starts)):
+            first = starts[b] if b > 0 else 1
+            last = starts[b] + lengths[b]
+            if columns[b] < 0:
+                if last > first:
+                    trace_back = np.empty((last - first, self.n_components),
+                                          dtype=np.int16)
+                    _hmm._viterbi_steps(delta, self._log_transmat,
+                                        framelogprob[first:last], trace_back)
+                    steps.append((last - 1, -1, None, trace_back))
+            else:
+                pos = first - 1
+                for k in self._run_factors(last - first):
+                    arg = np.empty(self.n_components, dtype=np.int32)
+                    _hmm._max_vecmat(delta, powers.get(
+                        columns[b], framelogprob[starts[b]], k), buf, arg)
+                    delta, buf = buf, delta
+                    pos += 1 << k
+                    steps.append((pos, columns[b], k, arg))
+
+        state_sequence = np.empty(n_observations, dtype=np.int)
+        state = int(np.argmax(delta))
+        logprob = delta[state]
+        for last, column, k, trace_back in reversed(steps):
+            if column < 0:
+                for t in xrange(len(trace_back) - 1, -1, -1):
+                    state_sequence[last - len(trace_back) + 1 + t] = state
+                    state = trace_back[t, state]
+            else:
+                prevState = int(trace_back[state])
+                _hmm._expand_path(powers.getMids(column), k, prevState, state,
+                                  state_sequence, last - (1 << k) + 1)
+                state = prevState
+        state_sequence[0] = state
+        return logprob, state_sequence
+
     def _do_viterbi_pass(self, framelogprob, obs = None):
         """ Viterbi dynamic programming.  Overrides the original version
         which is still in basehmm.py, to use the faster Cython code """
+        runs = self._get_runs(obs)
+        if runs is not None:
+            logprob, state_sequence = self._do_compressed_viterbi_pass(
+                framelogprob, runs)
+            return logprob, state_sequence
         n_observations, n_components = framelogprob.shape
-        state_sequence, logprob = _hmm._viterbi(
-            n_observations, n_components, self._log_startprob,
-            self._log_transmat, self.emissionModel.getSegmentRatios(obs),
-            framelogprob)
+        workspace = self._get_workspace()
+        lattice = workspace.get("lattice", (n_observations, n_components))
+        trace_back = workspace.get("trace_back", (n_observations,
+                                                  n_components), np.int16)
+        sparseTrans = self._get_sparse_transitions()
+        if sparseTrans is not None:
+            state_sequence, logprob = _hmm._viterbi_sparse(
+                n_observations, n_components, self._log_startprob,
+                self._log_transmat, self.emissionModel.getSegmentRatios(obs),
+                framelogprob, sparseTrans[0], sparseTrans[1], lattice,
+                trace_back)
+        else:
+            state_sequence, logprob = _hmm._viterbi(
+                n_observations, n_components, self._log_startprob,
+                self._log_transmat, self.emissionModel.getSegmentRatios(obs),
+                framelogprob, lattice, trace_back)
         return logprob, state_sequence
 
     def _do_forward_pass(self, framelogprob, obs = None):
         """ Forward dynamic programming.  Overrides the original version
         which is still in basehmm.py, to use the faster Cython code """
+        return self._forward_pass(framelogprob, obs,
+                                  np.empty(framelogprob.shape))
+
+    def _workspace_forward_pass(self, framelogprob, obs = None):
+        """ Same as _do_forward_pass() but the returned lattice is a
+        workspace buffer, which is overwritten by the next call """
+        return self._forward_pass(framelogprob, obs,
+                                  self._get_workspace().get(
+                                      "fwdlattice", framelogprob.shape))
+
+    def _forward_pass(self, framelogprob, obs, fwdlattice):
+        """ Run the forward pass into the given lattice """
         n_observations, n_components = framelogprob.shape
         logger.debug("beginning Forward pass on %d x %d matrix" % (
             n_observations, n_components))
-        fwdlattice = np.zeros((n_observations, n_components))
-        _hmm._forward(n_observations, n_components, self._log_startprob,
-                       self._log_transmat, framelogprob, 
-                        self.emissionModel.getSegmentRatios(obs), fwdlattice)
+        sparseTrans = self._get_sparse_transitions()
+        if sparseTrans is not None:
+            _hmm._forward_sparse(n_observations, n_components,
+                                 self._log_startprob, self._log_transmat,
+                                 framelogprob,
+                                 self.emissionModel.getSegmentRatios(obs),
+                                 sparseTrans[0], sparseTrans[1], fwdlattice)
+        else:
+            _hmm._forward(n_observations, n_components, self._log_startprob,
+                           self._log_transmat, framelogprob, 
+                            self.emissionModel.getSegmentRatios(obs),
+                            fwdlattice)
         lp = logsumexp(fwdlattice[-1])
         logger.debug("Forward log prob %f" % lp)
+        self._track_forward_log_prob(lp)
+        return lp, fwdlattice
+
+    def _track_forward_log_prob(self, lp):
+        """ Add the log prob of a forward pass to the total for the current
+        iteration, and keep track of the best iteration for maxProb.  Must
+        be called once per observation sequence, in order."""
         if self.last_forward_log_prob_it != self.current_iteration:
             if self.maxProb is True and (self.current_iteration == 1 or
                     self.last_forward_log_prob > self.best_forward_log_prob):
                 self.best_forward_log_prob = self.last_forward_log_prob
-                self.bestCopy = copy.deepcopy(self)
+                self.bestSnapshot = self._save_snapshot(self.bestSnapshot)
             self.last_forward_log_prob = lp
             self.last_forward_log_prob_it = self.current_iteration
-            if (self.maxProb is True and self.bestCopy is not None and
+            if (self.maxProb is True and self.bestSnapshot is not None and
               self.maxProbCut is not None and self.current_iteration -
-              self.bestCopy.current_iteration > self.maxProbCut):
+              self.bestSnapshot.values["current_iteration"] >
+              self.maxProbCut):
                 # hack to converge:
                 logger.info("Stopping due to --maxProbCut %d" % self.maxProbCut)
                 self.n_iter = self.current_iteration
@@ -708,22 +1409,138 @@ class MultitrackHmm(BaseHMM):
             if self.maxProb is True and self.current_iteration > 1 and\
                     self.last_forward_log_prob > self.best_forward_log_prob:
                 self.best_forward_log_prob = self.last_forward_log_prob
-                self.bestCopy = copy.deepcopy(self)
-
-        return lp, fwdlattice
+                self.bestSnapshot = self._save_snapshot(self.bestSnapshot)
 
     def _do_backward_pass(self, framelogprob, obs = None):
         """ Backward dynamic programming.  Overrides the original version
         which is still in basehmm.py, to use the faster Cython code """
+        return self._backward_pass(framelogprob, obs,
+                                   np.empty(framelogprob.shape))
+
+    def _workspace_backward_pass(self, framelogprob, obs = None):
+        """ Same as _do_backward_pass() but the returned lattice is a
+        workspace buffer, which is overwritten by the next call """
+        return self._backward_pass(framelogprob, obs,
+                                   self._get_workspace().get(
+                                       "bwdlattice", framelogprob.shape))
+
+    def _backward_pass(self, framelogprob, obs, bwdlattice):
+        """ Run the backward pass into the given lattice """
         n_observations, n_components = framelogprob.shape
         logger.debug("beginning Backward pass on %d x %d matrix" % (
             n_observations, n_components))
-        bwdlattice = np.zeros((n_observations, n_components))
-        _hmm._backward(n_observations, n_components, self._log_startprob,
-                        self._log_transmat, framelogprob,
-                        self.emissionModel.getSegmentRatios(obs),
-                        bwdlattice)
+        sparseTrans = self._get_sparse_transitions()
+        if sparseTrans is not None:
+            _hmm._backward_sparse(n_observations, n_components,
+                                  self._log_startprob, self._log_transmat,
+                                  framelogprob,
+                                  self.emissionModel.getSegmentRatios(obs),
+                                  sparseTrans[2], sparseTrans[3], bwdlattice)
+        else:
+            _hmm._backward(n_observations, n_components, self._log_startprob,
+                            self._log_transmat, framelogprob,
+                            self.emissionModel.getSegmentRatios(obs),
+                            bwdlattice)
         lp = logsumexp(bwdlattice[0])
         logger.debug("Backward log prob + start %f" % (lp +
                      logsumexp(self._log_startprob)))
         return bwdlattice
+
+
+class DPWorkspace(object):
+    """ Pool of preallocated arrays for the dynamic programming, so that
+    every EM iteration and decoding call doesn't allocate (and free) new
+    N x M matrices for each track table.  Buffers are identified by name
+    and handed out as views of the requested shape; the underlying arrays
+    only ever grow, so they end up sized to the largest table seen and
+    peak memory is just the sum of those.  A buffer's contents are only
+    valid until the next request for the same name, so buffers never
+    leave the model: the basehmm overrides (_compute_log_likelihood(),
+    _do_forward_pass() etc.) return new arrays, and only the internal
+    _workspace_*() versions hand out buffers."""
+    def __init__(self):
+        self.pool = dict()
+
+    def get(self, name, shape, dtype=np.float):
+        """ Get an (uninitialized) array of the given shape and type """
+        size = int(np.prod(shape))
+        buf = self.pool.get(name)
+        if buf is None or buf.size < size or buf.dtype != dtype:
+            logger.debug("Allocating %s workspace buffer for shape %s" % (
+                name, str(shape)))
+            buf = np.empty(max(size, 1), dtype=dtype)
+            self.pool[name] = buf
+        return buf[:size].reshape(shape)
+
+    def getNumBytes(self):
+        """ Total memory held by the workspace """
+        return sum([buf.nbytes for buf in self.pool.values()])
+
+    def clear(self):
+        """ Release all buffers """
+        self.pool = dict()
+
+class ParamSnapshot(object):
+    """ Copy of a model's parameter arrays (and a few scalars) as they were
+    at some point in training.  Saving again reuses the same arrays, so
+    keeping track of the best iteration costs a copy of the parameters
+    rather than a copy of the entire model."""
+    def __init__(self):
+        self.arrays = dict()
+        self.values = dict()
+
+    def save(self, arrays, **values):
+        """ Copy the given dictionary of arrays and keyword values """
+        for name, array in arrays.items():
+            buf = self.arrays.get(name)
+            if (buf is None or buf.shape != array.shape or
+                buf.dtype != array.dtype):
+                self.arrays[name] = np.array(array)
+            else:
+                np.copyto(buf, array)
+        self.values.update(values)
+
+class TransferPowers(object):
+    """ Cache of the powers A^(2^k) of the transfer matrix of each distinct
+    observation column, A[i,j] = log_transmat[i,j] + framelogprob[j], in
+    either the log sum-product (forward / backward) or max-plus (Viterbi)
+    semiring.  Applying A^L is exactly equivalent to L dynamic programming
+    steps over a run of L copies of the column, and any L can be done with
+    log2(L) of the cached powers.  In max-plus mode, the argmax midpoint of
+    each squaring is kept so that the best path through a power can be
+    expanded back to individual positions (_hmm._expand_path)."""
+    def __init__(self, logTrans, maxPlus):
+        self.logTrans = logTrans
+        self.maxPlus = maxPlus
+        self.powers = dict()
+        self.mids = dict()
+        self.midArrays = dict()
+
+    def get(self, column, emission, k):
+        """ Get A^(2^k) for a given column index, where emission is the
+        column's log probability for each state """
+        if column not in self.powers:
+            self.powers[column] = [self.logTrans + emission]
+            self.mids[column] = [np.zeros(self.logTrans.shape, np.int32)]
+        powers = self.powers[column]
+        while len(powers) <= k:
+            square = np.empty(self.logTrans.shape)
+            if self.maxPlus is True:
+                mid = np.empty(self.logTrans.shape, dtype=np.int32)
+                _hmm._max_matmul(powers[-1], powers[-1], square, mid)
+                self.mids[column].append(mid)
+                self.midArrays.pop(column, None)
+            else:
+                _hmm._log_matmul(powers[-1], powers[-1], square)
+            powers.append(square)
+        return powers[k]
+
+    def getMids(self, column):
+        """ Get the (K x M x M) array of midpoints for a column where
+        [k,i,j] is the state halfway along the best path from i to j in
+        A^(2^k) """
+        assert self.maxPlus is True
+        if column not in self.midArrays:
+            self.midArrays[column] = np.array(self.mids[column],
+                                              dtype=np.int32)
+        return self.midArrays[column]
@@ -1,3 +1,4 @@
+import sys
 from distutils.core import setup
 from Cython.Build import cythonize
 from distutils.core import Extension
@@ -6,6 +7,12 @@ from teHmm.common import checkRequirements
 
 checkRequirements()
 
+# OpenMP for the prange loops (the default OSX compiler doesn't support it,
+# in which case they just run on one thread)
+ompArgs = ['-fopenmp']
+if sys.platform == 'darwin':
+    ompArgs = []
+
 setup(
   name = 'teHmm',
   ext_modules = cythonize([
@@ -14,13 +21,14 @@ setup(
         Extension("_hmm", ["_hmm.pyx"],
                 include_dirs=[numpy.get_include()]),
         Extension("_emission", ["_emission.pyx"],
-                include_dirs=[numpy.get_include()]),
+                include_dirs=[numpy.get_include()],
+                extra_compile_args=ompArgs,
+                extra_link_args=ompArgs),
         Extension("_track", ["_track.pyx"],
                 include_dirs=[numpy.get_include()]),                
         Extension("_cfg", ["_cfg.pyx"],
                 include_dirs=[numpy.get_include()],
-                #extra_compile_args=['-fopenmp'],
-                #extra_link_args=['-fopenmp']
-                 )
+                extra_compile_args=ompArgs,
+                extra_link_args=ompArgs)
         ])
 )
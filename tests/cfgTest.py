@@ -10,6 +10,7 @@ import unittest
 import sys
 import os
 import math
+import itertools
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 from teHmm.track import *
@@ -17,6 +18,7 @@ from teHmm.trackIO import readBedIntervals
 from teHmm.hmm import MultitrackHmm
 from teHmm.cfg import MultitrackCfg
 from teHmm.emission import IndependentMultinomialEmissionModel, PairEmissionModel
+from teHmm.basehmm import NEGINF, logsumexp
 
 from teHmm.tests.common import getTestDirPath
 from teHmm.tests.common import TestBase
@@ -122,6 +124,275 @@ class TestCase(TestBase):
                                         defAlignmentSymbol=0)
         assert_array_equal(cfgStates, [2,0,0,2])
                                
+    def testBandedCyk(self):
+        prng = np.random.RandomState(3)
+        emissionModel = IndependentMultinomialEmissionModel(
+            4, [3], zeroAsMissingData=False, randomize=True,
+            random_state=prng)
+        pairModel = PairEmissionModel(emissionModel, [0.9] *
+                                      emissionModel.getNumStates())
+        obs = prng.randint(0, 3, (40, 1)).astype(np.uint8)
+        alignment = prng.randint(0, 3, (40, 1)).astype(np.uint16)
+
+        # with no pair states, chaining beyond the band loses nothing
+        hmm = MultitrackHmm(emissionModel)
+        hmmProb, hmmStates = hmm.decode(obs)
+        cfg = MultitrackCfg(emissionModel, pairModel, maxSpan=5)
+        cfgProb, cfgStates = cfg.decode(obs)
+        self.assertAlmostEqual(hmmProb, cfgProb)
+        assert cfg.dp.shape == (5, 40, 4)
+
+        cfg = MultitrackCfg(emissionModel, pairModel, nestStates=[1, 3])
+        fullProb, fullStates = cfg.decode(obs, alignmentTrack=alignment)
+        lastProb = None
+        for maxSpan in [100, 40, 39, 10, 2, 1]:
+            cfg.maxSpan = maxSpan
+            prob, states = cfg.decode(obs, alignmentTrack=alignment)
+            assert len(states) == len(obs)
+            assert -1 not in states
+            if maxSpan >= len(obs):
+                self.assertEqual(prob, fullProb)
+                assert_array_equal(states, fullStates)
+            else:
+                assert prob <= fullProb
+                assert prob <= lastProb + 1e-10
+            lastProb = prob
+
+    def testPackedTraceback(self):
+        emissionModel = IndependentMultinomialEmissionModel(
+            3, [2], zeroAsMissingData=False, randomize=True,
+            random_state=np.random.RandomState(1))
+        pairModel = PairEmissionModel(emissionModel, [0.9] *
+                                      emissionModel.getNumStates())
+        cfg = MultitrackCfg(emissionModel, pairModel, nestStates = [1])
+        obs = np.array([[1],[0],[0],[1],[1],[0]], dtype=np.uint8)
+        cfgProb, cfgStates = cfg.decode(obs)
+        assert cfg.tb.dtype == np.int32
+        assert cfg.tb.shape == (len(obs), len(obs), 3)
+        # every cell that was reached has a production
+        assert np.all((cfg.tb[1:] >= 0) == (cfg.dp[1:] > NEGINF))
+        assert np.all(cfg.tb[1:] < len(obs) * cfg.tbStride)
+        # only use 64 bits when the offsets need them
+        assert cfg.getTracebackDtype(np.iinfo(np.int32).max /
+                                     cfg.tbStride + 1) == np.int64
+        cfg.maxSpan = 4
+        assert cfg.getTracebackDtype(np.iinfo(np.int32).max) == np.int32
+
+    def testTiledCyk(self):
+        # the tiling and the number of threads must not change the answer
+        emissionModel = IndependentMultinomialEmissionModel(
+            4, [3], zeroAsMissingData=False, randomize=True,
+            random_state=np.random.RandomState(3))
+        pairModel = PairEmissionModel(emissionModel, [0.9] *
+                                      emissionModel.getNumStates())
+        cfg = MultitrackCfg(emissionModel, pairModel, nestStates = [1, 2])
+        obs = np.random.RandomState(3).randint(0, 3, (57, 1)).astype(np.uint8)
+        prob, states = cfg.decode(obs)
+        for maxSpan in [None, 20]:
+            cfg.maxSpan = maxSpan
+            cfg.cykTileSize = 64
+            spanProb, spanStates = cfg.decode(obs)
+            for tileSize in [1, 4, 7, 16]:
+                for numThreads in [1, 3]:
+                    cfg.cykTileSize = tileSize
+                    tileProb, tileStates = cfg.decode(obs,
+                                                      numThreads=numThreads)
+                    assert tileProb == spanProb
+                    assert_array_equal(tileStates, spanStates)
+        assert spanProb <= prob
+
+    def testWindowDecode(self):
+        emissionModel = IndependentMultinomialEmissionModel(
+            4, [3], zeroAsMissingData=False, randomize=True,
+            random_state=np.random.RandomState(7))
+        pairModel = PairEmissionModel(emissionModel, [0.9] *
+                                      emissionModel.getNumStates())
+        cfg = MultitrackCfg(emissionModel, pairModel, nestStates = [1, 2])
+        obs = np.random.RandomState(7).randint(0, 3, (50, 1)).astype(np.uint8)
+        prob, states = cfg.decode(obs)
+        middleSplits = 0
+        for windowSize, overlap in [(10, 0), (12, 5), (20, 10), (49, 20)]:
+            cfg.windowSize = windowSize
+            cfg.windowOverlap = overlap
+            windows = cfg.getWindows(len(obs))
+            # cores are consecutive and windows are all full length
+            assert windows[0][2] == 0 and windows[-1][3] == len(obs)
+            for k, (start, end, coreStart, coreEnd) in enumerate(windows):
+                assert end - start == windowSize
+                assert start <= coreStart < coreEnd <= end
+                if k > 0:
+                    assert coreStart == windows[k-1][3]
+                    assert windows[k-1][1] - start >= overlap
+            # each core gets the states of its own window's parse, and
+            # (given some overlap to choose from) no pair of that parse
+            # is cut in two by the edges of the core
+            windowProb, windowStates = cfg.windowDecode(obs)
+            cores = cfg.windowCores
+            assert cores[0][0] == 0 and cores[-1][1] == len(obs)
+            for k, ((start, end, midStart, midEnd), (coreStart, coreEnd)) \
+                in enumerate(zip(windows, cores)):
+                assert start <= coreStart < coreEnd <= end
+                if k > 0:
+                    assert coreStart == cores[k-1][1]
+                wProb, wStates = cfg.decode(obs[start:end])
+                assert_array_equal(windowStates[coreStart:coreEnd],
+                                   wStates[coreStart - start:
+                                           coreEnd - start])
+                for i, j in cfg.tracePairs:
+                    i, j = i + start, j + start
+                    inCore = [coreStart <= x < coreEnd for x in (i, j)]
+                    assert overlap == 0 or inCore[0] == inCore[1]
+                    # (cutting at the middle of the overlaps would not do)
+                    middleSplits += ((midStart <= i < midEnd) !=
+                                     (midStart <= j < midEnd))
+            # and running the windows in processes doesn't change anything
+            procProb, procStates = cfg.windowDecode(obs, numProc=3)
+            assert_array_almost_equal(procProb, windowProb)
+            assert_array_equal(procStates, windowStates)
+        assert middleSplits > 0
+        # a window covering everything is the same as no windows
+        cfg.windowSize = len(obs)
+        windowProb, windowStates = cfg.windowDecode(obs)
+        assert windowProb == prob
+        assert_array_equal(windowStates, states)
+
+    def testSparseCyk(self):
+        emissionModel = IndependentMultinomialEmissionModel(
+            4, [3], zeroAsMissingData=False, randomize=True,
+            random_state=np.random.RandomState(5))
+        pairModel = PairEmissionModel(emissionModel, [0.9] *
+                                      emissionModel.getNumStates())
+        cfg = MultitrackCfg(emissionModel, pairModel, nestStates = [1, 2])
+        obs = np.random.RandomState(5).randint(0, 3, (60, 1)).astype(np.uint8)
+        # without anchors, it's the same as chaining single columns
+        cfg.maxSpan = 1
+        chainProb, chainStates = cfg.decode(obs)
+        cfg.maxSpan = None
+        cfg.sparse = True
+        sparseProb, sparseStates = cfg.decode(obs)
+        assert sparseProb == chainProb
+        assert_array_equal(sparseStates, chainStates)
+        # anchors are only between different copies of an alignment
+        alignment = np.zeros((60, 1), dtype=np.uint16)
+        alignment[5:10] = 1
+        alignment[40:45] = 1
+        alignment[20:22] = 2
+        alignment[30:32] = 2
+        anchorI, anchorJ = cfg.getAnchors(alignment)
+        assert len(anchorI) == 5 * 5 + 2 * 2
+        assert np.all(alignment[anchorI] == alignment[anchorJ])
+        assert np.all(anchorJ - anchorI > 2)
+        cfg.maxSpan = 30
+        assert len(cfg.getAnchors(alignment)[0]) == 2 * 2
+        # same as checking every pair of columns
+        prng = np.random.RandomState(5)
+        for maxSpan in [None, 1, 7, 40]:
+            cfg.maxSpan = maxSpan
+            for trial in xrange(5):
+                randAlignment = np.repeat(prng.randint(0, 4, 20),
+                                          prng.randint(1, 5, 20))
+                randAlignment = randAlignment[:, np.newaxis]
+                runs = np.cumsum(np.concatenate(([0], np.diff(
+                    randAlignment[:, 0]) != 0)))
+                pairs = [(i, j) for i in xrange(len(randAlignment))
+                         for j in xrange(i + 1, len(randAlignment))
+                         if randAlignment[i, 0] == randAlignment[j, 0] and
+                         randAlignment[i, 0] != 0 and runs[i] != runs[j] and
+                         (maxSpan is None or j - i < maxSpan)]
+                anchorI, anchorJ = cfg.getAnchors(randAlignment)
+                assert zip(anchorI, anchorJ) == pairs
+        cfg.maxSpan = None
+        anchorProb, anchorStates = cfg.decode(obs, alignment)
+        assert np.all(anchorStates >= 0)
+        assert anchorProb >= sparseProb
+        # nest states only show up in pairs of anchored columns
+        nested = np.nonzero((anchorStates == 1) | (anchorStates == 2))[0]
+        assert len(nested) > 0
+        assert np.all(alignment[nested, 0] > 0)
+        for symbol in [1, 2]:
+            symbolNested = nested[alignment[nested, 0] == symbol]
+            assert len(symbolNested) % 2 == 0
+        # the full CYK allows more parses
+        cfg.sparse = False
+        fullProb, fullStates = cfg.decode(obs, alignment)
+        assert fullProb >= anchorProb
+
+    def testInsideOutside(self):
+        emissionModel = IndependentMultinomialEmissionModel(
+            4, [3], zeroAsMissingData=False, randomize=True,
+            random_state=np.random.RandomState(5))
+        pairModel = PairEmissionModel(emissionModel, [0.9] *
+                                      emissionModel.getNumStates())
+        cfg = MultitrackCfg(emissionModel, pairModel, nestStates = [1, 2])
+        N = 9
+        obs = np.random.RandomState(5).randint(0, 3, (N, 1)).astype(np.uint8)
+        alignment = np.zeros((N, 1), dtype=np.uint16)
+        alignment[1] = 1
+        alignment[6] = 1
+
+        # sum over all derivations by brute force
+        emLogProbs = emissionModel.allLogProbs(obs)
+        logPriors = pairModel.logPriors
+        memo = dict()
+        def inside(i, j, X):
+            if (i, j, X) not in memo:
+                terms = []
+                if i == j and X not in cfg.nestStates:
+                    terms.append(emLogProbs[i, X])
+                for Y, Z in itertools.product(xrange(4), xrange(4)):
+                    for k in xrange(i, j):
+                        terms.append(cfg.logProbs1[X, Y, Z] +
+                                     inside(i, k, Y) + inside(k + 1, j, Z))
+                if j > i and X in cfg.nestStates:
+                    match = int(alignment[i, 0] != 0 and
+                                alignment[i, 0] == alignment[j, 0])
+                    pairScore = emLogProbs[i, X] + emLogProbs[j, X] + \
+                                logPriors[X, match]
+                    if j == i + 1:
+                        terms.append(pairScore)
+                    for Y in xrange(4):
+                        if j > i + 1:
+                            terms.append(pairScore + cfg.logProbs2[X, Y] +
+                                         inside(i + 1, j - 1, Y))
+                terms = [x for x in terms if x > NEGINF]
+                memo[(i, j, X)] = NEGINF
+                if len(terms) > 0:
+                    memo[(i, j, X)] = logsumexp(np.array(terms))
+            return memo[(i, j, X)]
+        bruteProb = logsumexp(np.array([cfg.startProbs[X] + inside(0, N - 1, X)
+                                        for X in xrange(4)]))
+
+        logProb, posteriors = cfg.insideOutside(obs, alignment)
+        assert np.isclose(logProb, bruteProb)
+        assert posteriors.shape == (N, 4)
+        assert_array_almost_equal(posteriors.sum(axis=1), np.ones(N))
+        vitProb, vitStates = cfg.decode(obs, alignment)
+        assert logProb >= vitProb
+        # the inside tables are kept apart from the CYK scores, which are
+        # dropped (not overwritten) so they can't be traced back
+        vitDp = np.copy(cfg.dp)
+        cfg.insideOutside(obs, alignment)
+        assert cfg.dp is None and cfg.tb is None
+        assert cfg.insideDp.shape == vitDp.shape
+        for d in xrange(N):
+            cells = cfg.insideDp[d, :N - d]
+            assert np.all(cells >= 0.) and np.all(cells <= 1.)
+        assert cfg.decode(obs, alignment)[0] == vitProb
+        assert_array_equal(cfg.dp, vitDp)
+
+        # same with the banded tables (including the chain beyond them)
+        for maxSpan in [2, 3, 5]:
+            cfg.maxSpan = maxSpan
+            bandProb, bandPosteriors = cfg.insideOutside(obs, alignment,
+                                                         numThreads=2)
+            assert bandProb <= logProb
+            assert bandProb >= cfg.decode(obs, alignment)[0]
+            assert_array_almost_equal(bandPosteriors.sum(axis=1),
+                                      np.ones(N))
+        cfg.maxSpan = None
+        cfg.sparse = True
+        self.assertRaises(RuntimeError, cfg.insideOutside, obs)
+
     def testHmmSupervisedLearn(self):
         """ Pretty much copied from the HMM unit test.  We try to recapitualte
         all results with a CFG with no nest states, which should be same as
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+#Copyright (C) 2014 by Glenn Hickey
+#
+#Released under the MIT license, see LICENSE.txt
+import sys
+import os
+import argparse
+import numpy as np
+import time
+
+from teHmm.cfg import MultitrackCfg
+from teHmm.emission import IndependentMultinomialEmissionModel
+from teHmm.emission import PairEmissionModel
+
+""" This is a script to benchmark the multithreaded CYK (see fastCykTable() in
+_cfg.pyx) on random data.  The same sequence is decoded with each number of
+threads given, and the speedup relative to the first is printed.  The results
+must be identical regardless of the number of threads.
+"""
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Benchmark CFG CYK scaling with the number of threads.")
+
+    parser.add_argument("--N", help="Number of observations.",
+                        type=int, default=1000)
+    parser.add_argument("--S", help="Number of states.",
+                        type=int, default=6)
+    parser.add_argument("--nest", help="Number of nested (pair-emitting) "
+                        "states.", type=int, default=2)
+    parser.add_argument("--maxSpan", help="Maximum span of a nested "
+                        "subsequence (see teHmmEval.py --maxSpan).  0 means "
+                        "no limit.", type=int, default=0)
+    parser.add_argument("--threads", help="Comma-separated list of thread "
+                        "counts to run.", default="1,2,4,8,16,32")
+    parser.add_argument("--tile", help="Tile size (columns) of the CYK "
+                        "table.  0 means use the default.", type=int,
+                        default=0)
+    parser.add_argument("--seed", help="Random seed.", type=int, default=0)
+
+    args = parser.parse_args()
+    threadList = [int(x) for x in args.threads.split(",")]
+    assert len(threadList) > 0 and min(threadList) > 0
+    assert args.nest < args.S
+
+    prng = np.random.RandomState(args.seed)
+    emissionModel = IndependentMultinomialEmissionModel(
+        args.S, [4], zeroAsMissingData=False, randomize=True,
+        random_state=prng)
+    pairModel = PairEmissionModel(emissionModel, [0.9] * args.S)
+    cfg = MultitrackCfg(emissionModel, pairModel,
+                        nestStates = range(1, args.nest + 1),
+                        maxSpan = args.maxSpan)
+    if args.tile > 0:
+        cfg.cykTileSize = args.tile
+    obs = prng.randint(0, 4, (args.N, 1)).astype(np.uint8)
+
+    baseTime = None
+    baseProb, baseStates = None, None
+    for numThreads in threadList:
+        startTime = time.time()
+        prob, states = cfg.decode(obs, numThreads=numThreads)
+        deltaTime = time.time() - startTime
+        if baseTime is None:
+            baseTime = deltaTime
+            baseProb, baseStates = prob, states
+        print "Elapsed time for %d x %d CYK (span %d tile %d) with %d "\
+            "threads: %f (speedup %.2fx)" % (args.N, args.S, args.maxSpan,
+                                             cfg.cykTileSize, numThreads,
+                                             deltaTime, baseTime / deltaTime)
+        if prob != baseProb or np.any(states != baseStates):
+            raise RuntimeError("%d threads gave a different parse" %
+                               numThreads)
+
+if __name__ == "__main__":
+    sys.exit(main())
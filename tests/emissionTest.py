@@ -10,10 +10,13 @@ import numpy as np
 import math
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 import itertools
+import cPickle
+from scipy import stats
 
 from teHmm.emission import IndependentMultinomialEmissionModel
 from teHmm.emission import IndependentMultinomialAndGaussianEmissionModel
-from teHmm.track import TrackData
+from teHmm.basehmm import normalize
+from teHmm.track import TrackData, IntegerTrackTable, Track
 from teHmm.tests.common import getTestDirPath
 from teHmm.tests.common import TestBase
 from teHmm.tests.bedTrackTest import getTracksInfoPath
@@ -203,6 +206,177 @@ class TestCase(TestBase):
             assert_array_almost_equal(em.gaussParams[trackNo][1],
                                       [means[1], stdev[1]])
 
+    def testUniqueColumns(self):
+        em = self.createSimpleModel2()
+        table = IntegerTrackTable(2, "scaffold_1", 100, 160)
+        table.writeRow(0, [1] * 20 + [2] * 20 + [1] * 20)
+        table.writeRow(1, [3] * 30 + [1] * 10 + [3] * 20)
+        columns, inverse = table.getUniqueColumns()
+        assert len(columns) == 3
+        assert_array_equal(columns[inverse], table.getNumPyArray())
+        assert table.getUniqueColumns() is table.getUniqueColumns()
+        assert_array_equal(em.allLogProbs(table),
+                           em.allLogProbs(table.getNumPyArray()))
+        # cache must be reset when data changes
+        table.initRow(1, 2)
+        assert len(table.getUniqueColumns()[0]) == 2
+        assert_array_equal(em.allLogProbs(table),
+                           em.allLogProbs(table.getNumPyArray()))
+        # tables pickled before the caches existed don't have them
+        del table.__dict__["uniqueColumns"]
+        del table.__dict__["packedColumns"]
+        oldTable = cPickle.loads(cPickle.dumps(table))
+        assert len(oldTable.getUniqueColumns()[0]) == 2
+        assert_array_equal(em.allLogProbs(oldTable),
+                           em.allLogProbs(table.getNumPyArray()))
+
+    def testMaximize(self):
+        em = IndependentMultinomialEmissionModel(numStates = 3,
+                                                 numSymbolsPerTrack=[2, 4])
+        obsStats = em.initStats()
+        obsStats[0, 0, 1:3] = [3., 1.]
+        obsStats[1, 0, 1:5] = [1., 0., 2., 1.]
+        obsStats[0, 1, 1:3] = [0., 5.]
+        # state 2 is orphaned in track 1
+        obsStats[0, 2, 1:3] = [1., 1.]
+        orphanProbs = np.copy(em.getLogProbs()[1, 2])
+        em.maximize(obsStats)
+        logProbs = em.getLogProbs()
+        assert_array_almost_equal(np.exp(logProbs[0, 0, 1:3]), [0.75, 0.25])
+        assert_array_almost_equal(np.exp(logProbs[1, 0, 1:5]),
+                                  [0.25, 0., 0.5, 0.25])
+        assert logProbs[1, 0, 2] == -1e6
+        assert_array_almost_equal(np.exp(logProbs[0, 1, 1:3]), [0., 1.])
+        assert_array_equal(logProbs[1, 2], orphanProbs)
+        # missing data symbol left alone
+        assert logProbs[0, 0, 0] == 0.
+
+    def testGaussianVectors(self):
+        track = Track(number=0)
+        track.dist = "gaussian"
+        track.defaultVal = "0"
+        track._init()
+        catMap = track.getValueMap()
+        for val in ["1", "2", "4", "8"]:
+            catMap.getMap(val, update=True)
+        numSymbols = len(catMap) - 1
+        em = IndependentMultinomialAndGaussianEmissionModel(
+            3, [numSymbols], [track], randomize=True,
+            random_state=np.random.RandomState(1))
+        symbols, values = em.getMapBackVector(track)
+        assert em.getMapBackVector(track)[1] is values
+        assert_array_equal(values,
+                           [float(catMap.getMapBack(x)) for x in symbols])
+        # compare with computing each state and symbol one at a time
+        prng = np.random.RandomState(2)
+        for state in xrange(3):
+            em.getLogProbs()[0, state, symbols] = np.log(
+                normalize(prng.uniform(0.1, 1., len(symbols))))
+        before = np.copy(em.getLogProbs())
+        em.makeGaussian([track])
+        for state in xrange(3):
+            probs = np.exp(before[0, state])
+            mu = sum([float(catMap.getMapBack(x)) * probs[x]
+                      for x in symbols])
+            sigma = np.sqrt(sum([np.square(float(catMap.getMapBack(x)) - mu)
+                                 * probs[x] for x in symbols]))
+            assert_array_almost_equal(em.getGaussianParams(0, state),
+                                      [mu, sigma])
+            assert_array_almost_equal(em.computeMuSigma(track, state),
+                                      np.ravel(em.computeMuSigma(track, [state])))
+            gaussProbs = np.array([
+                em.uniformMixProb / len(symbols) +
+                (1. - em.uniformMixProb) * stats.norm.pdf(
+                    float(catMap.getMapBack(x)), loc=mu, scale=sigma)
+                for x in symbols])
+            assert_array_almost_equal(np.exp(em.getLogProbs()[0, state,
+                                                              symbols]),
+                                      gaussProbs / np.sum(gaussProbs))
+        em.validate()
+
+    def testValidate(self):
+        # way too many symbol combinations to enumerate
+        em = IndependentMultinomialEmissionModel(
+            numStates=4, numSymbolsPerTrack=[50] * 20, randomize=True)
+        em.validate()
+        em.getLogProbs()[7, 2, 3] += 0.1
+        self.assertRaises(AssertionError, em.validate)
+        # but missing data symbol isn't part of the distribution
+        em = IndependentMultinomialEmissionModel(
+            numStates=4, numSymbolsPerTrack=[2, 3])
+        em.getLogProbs()[1, 2, 0] = -1.
+        em.validate()
+
+    def testThreads(self):
+        prng = np.random.RandomState(4)
+        em = IndependentMultinomialEmissionModel(
+            numStates=5, numSymbolsPerTrack=[3, 6, 2], randomize=True,
+            random_state=prng)
+        for dtype in [np.uint8, np.uint16, np.int32]:
+            obs = np.zeros((1001, 3), dtype=dtype)
+            for track, numSymbols in enumerate([3, 6, 2]):
+                obs[:, track] = prng.randint(0, numSymbols + 1, len(obs))
+            posteriors = prng.uniform(0., 1., (len(obs), 5))
+            em.numThreads = 1
+            logProbs = em.allLogProbs(obs)
+            obsStats = em.accumulateStats(obs, em.initStats(), posteriors)
+            for numThreads in [2, 3, 7]:
+                em.numThreads = numThreads
+                assert_array_equal(em.allLogProbs(obs), logProbs)
+                assert_array_almost_equal(
+                    em.accumulateStats(obs, em.initStats(), posteriors),
+                    obsStats)
+
+    def testJointTables(self):
+        prng = np.random.RandomState(8)
+        numSymbolsPerTrack = [1, 1, 2, 10, 1, 4, 1, 1, 1, 1, 3, 0]
+        em = IndependentMultinomialEmissionModel(
+            numStates=4, numSymbolsPerTrack=numSymbolsPerTrack,
+            randomize=True, random_state=prng)
+        groups = em.getTrackGroups()
+        assert [3] in groups
+        assert len(groups) < len(numSymbolsPerTrack)
+        assert sorted(sum(groups, [])) == range(len(numSymbolsPerTrack))
+        obs = np.zeros((300, len(numSymbolsPerTrack)), dtype=np.uint8)
+        for track, numSymbols in enumerate(numSymbolsPerTrack):
+            obs[:, track] = prng.randint(0, numSymbols + 1, len(obs))
+        jointObs, jointLogProbs = em.getJointTables(obs, groups)
+        assert jointObs.shape == (len(obs), len(groups))
+        logProbs = em.allLogProbs(obs)
+        for i in xrange(len(obs)):
+            for state in xrange(4):
+                self.assertAlmostEqual(logProbs[i, state],
+                                       em.singleLogProb(state, obs[i]))
+                self.assertAlmostEqual(
+                    logProbs[i, state],
+                    sum([jointLogProbs[g, state, jointObs[i, g]]
+                         for g in xrange(len(groups))]))
+
+        # the tables are only rebuilt when the parameters change, and the
+        # packed columns of a table are only computed once
+        assert em.getJointLogProbs(groups) is jointLogProbs
+        table = IntegerTrackTable(len(numSymbolsPerTrack), "chr1", 0,
+                                  len(obs), dtype=np.uint8)
+        for track in xrange(len(numSymbolsPerTrack)):
+            table.writeRow(track, obs[:, track])
+        assert_array_almost_equal(em.allLogProbs(table), logProbs)
+        packed = table.packedColumns[1]
+        em.allLogProbs(table)
+        assert table.packedColumns[1] is packed
+        posteriors = prng.uniform(0., 1., (len(obs), 4))
+        em.maximize(em.accumulateStats(obs, em.initStats(), posteriors))
+        assert em.getJointLogProbs(groups) is not jointLogProbs
+        logProbs = em.allLogProbs(table)
+        assert table.packedColumns[1] is packed
+        assert_array_almost_equal(logProbs, em.allLogProbs(obs))
+        for i in xrange(len(obs)):
+            for state in xrange(4):
+                self.assertAlmostEqual(logProbs[i, state],
+                                       em.singleLogProb(state, obs[i]))
+        em.setParamArrays({"logProbs" : np.copy(em.getLogProbs())})
+        assert em.jointLogProbs is None
+        em.getJointLogProbs(groups)
+        assert "jointLogProbs" not in em.__getstate__()
 
 def main():
     sys.argv = sys.argv[:1]
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+#Copyright (C) 2013 by Glenn Hickey
+#
+#Released under the MIT license, see LICENSE.txt
+import unittest
+import sys
+import os
+import argparse
+
+import teHmm.bin.teHmmEval as teHmmEval
+from teHmm.bin.teHmmEval import parallelDispatch, intersectIntervals
+from teHmm.tests.common import TestBase
+
+
+def fakeEvaluate(args, model, mergedIntervals, segIntervals, vitOutFile,
+                 posteriorsFile, emissionsFile):
+    """ Stand-in for teHmmEval.evaluate() that doesn't need to load any
+    tracks: writes the intervals it was given (tagged with the model) """
+    for interval in mergedIntervals:
+        vitOutFile.write("%s\t%d\t%d\t%s\n" % (interval[0], interval[1],
+                                               interval[2], model))
+    if posteriorsFile is not None:
+        posteriorsFile.write("%s\t%d\n" % (mergedIntervals[0][0],
+                                           len(segIntervals)))
+    return sum(x[2] - x[1] for x in mergedIntervals), len(mergedIntervals)
+
+class TestCase(TestBase):
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+
+    def tearDown(self):
+        super(TestCase, self).tearDown()
+
+    def testIntersectIntervals(self):
+        intervals = [("chr1", 10, 30, "a"), ("chr1", 40, 70, "b"),
+                     ("chr1", 100, 300, "c"), ("chr2", 5, 20, "d")]
+        regions = [("chr2", 0, 100), ("chr1", 0, 50), ("chr1", 30, 40),
+                   ("chr1", 50, 400), ("chr1", 69, 101), ("chr3", 0, 10)]
+        output = intersectIntervals(intervals, regions)
+        assert output == [[("chr2", 5, 20, "d")],
+                          [("chr1", 10, 30, "a"), ("chr1", 40, 50, "b")],
+                          [],
+                          [("chr1", 50, 70, "b"), ("chr1", 100, 300, "c")],
+                          [("chr1", 69, 70, "b"), ("chr1", 100, 101, "c")],
+                          []]
+
+    def testParallelDispatch(self):
+        # the chunks are started largest first, but their outputs must be
+        # merged in the order of the chroms, whatever the number of
+        # processes
+        mergedIntervals = [("chr1", 10, 30, "a"), ("chr1", 40, 70, "b"),
+                           ("chr1", 100, 300, "c"), ("chr2", 5, 20, "d")]
+        segIntervals = [("chr1", 10, 20), ("chr1", 20, 30),
+                        ("chr1", 40, 70), ("chr1", 100, 300),
+                        ("chr2", 5, 20)]
+        chromIntervals = [("chr2", 0, 100), ("chr1", 0, 50),
+                          ("chr1", 50, 400), ("chr3", 0, 10)]
+        expectedBed = ["chr2\t5\t20\tm\n",
+                       "chr1\t10\t30\tm\n", "chr1\t40\t50\tm\n",
+                       "chr1\t50\t70\tm\n", "chr1\t100\t300\tm\n"]
+        expectedPd = ["chr2\t1\n", "chr1\t3\n", "chr1\t2\n"]
+        evaluate = teHmmEval.evaluate
+        teHmmEval.evaluate = fakeEvaluate
+        try:
+            for proc in [1, 2, 3]:
+                args = argparse.Namespace(
+                    bed=self.getTempFilePath(), pd=self.getTempFilePath(),
+                    ed=None, bic=None, proc=proc, window=0, numThreads=1,
+                    chroms="chroms.bed", bedRegions="regions.bed")
+                parallelDispatch(args, "m", mergedIntervals, segIntervals,
+                                 chromIntervals)
+                assert open(args.bed).readlines() == expectedBed
+                assert open(args.pd).readlines() == expectedPd
+        finally:
+            teHmmEval.evaluate = evaluate
+
+def main():
+    sys.argv = sys.argv[:1]
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -10,14 +10,22 @@ import unittest
 import sys
 import os
 import math
+import copy
+import argparse
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 
-from teHmm.basehmm import MultinomialHMM
+from teHmm.basehmm import MultinomialHMM, BaseHMM, logsumexp
 
 from teHmm.track import *
 from teHmm.trackIO import readBedIntervals
-from teHmm.hmm import MultitrackHmm
+from teHmm.hmm import MultitrackHmm, ONLINE_CHUNK_SIZE, ONLINE_STEP_DECAY
 from teHmm.emission import IndependentMultinomialEmissionModel
+from teHmm.common import myLog
+from teHmm import _hmm
+from teHmm.distributedEm import startLocalEmWorkerPool, shardTrackTables
+from teHmm.distributedEm import shardIntervals, connectFileEmWorkerPool
+from teHmm.bin.teHmmTrain import trainReplicatesHalving
+from teHmm.bin.teHmmTrain import main as teHmmTrainMain
 
 from teHmm.tests.common import getTestDirPath
 from teHmm.tests.common import TestBase
@@ -339,6 +347,492 @@ class TestCase(TestBase):
             for i in xrange(truthInt[1], truthInt[2]):
                 assert states[i] == truthInt[3]
 
+    def testSparseTransitions(self):
+        # compare dense and sparse dynamic programming kernels on random
+        # data with a mostly-zero transition matrix
+        prng = np.random.RandomState(42)
+        N = 200
+        M = 12
+        transmat = np.eye(M) * 0.9
+        for i in xrange(M):
+            transmat[i, (i + 1) % M] = 0.07
+            transmat[i, (i + 5) % M] = 0.03
+        emissionModel = IndependentMultinomialEmissionModel(
+            M, [3], zeroAsMissingData=False)
+        hmm = MultitrackHmm(emissionModel)
+        hmm.transmat_ = transmat
+        sparseTrans = hmm._get_sparse_transitions()
+        assert sparseTrans is not None
+        predPtr, predIdx, succPtr, succIdx = sparseTrans
+        assert predPtr[-1] == 3 * M and succPtr[-1] == 3 * M
+        logStart = myLog(np.ones(M) / M)
+        logTrans = hmm._log_transmat
+        frame = np.log(prng.uniform(0.01, 1., (N, M)))
+        for segRatios in [None, prng.randint(1, 4, N).astype(np.float)]:
+            fwd = np.zeros((N, M))
+            fwdS = np.zeros((N, M))
+            _hmm._forward(N, M, logStart, logTrans, frame, segRatios, fwd)
+            _hmm._forward_sparse(N, M, logStart, logTrans, frame, segRatios,
+                                 predPtr, predIdx, fwdS)
+            assert_array_almost_equal(fwd, fwdS)
+            bwd = np.zeros((N, M))
+            bwdS = np.zeros((N, M))
+            _hmm._backward(N, M, logStart, logTrans, frame, segRatios, bwd)
+            _hmm._backward_sparse(N, M, logStart, logTrans, frame, segRatios,
+                                  succPtr, succIdx, bwdS)
+            assert_array_almost_equal(bwd, bwdS)
+            lp = np.log(np.sum(np.exp(fwd[-1])))
+            lneta = np.zeros((M, M))
+            lnetaS = np.zeros((M, M))
+            _hmm._log_sum_lneta(N, M, fwd, logTrans, bwd, frame, lp,
+                                segRatios, lneta)
+            _hmm._log_sum_lneta_sparse(N, M, fwd, logTrans, bwd, frame, lp,
+                                       segRatios, succPtr, succIdx, lnetaS)
+            assert_array_almost_equal(np.exp(lneta), np.exp(lnetaS))
+            states, vlp = _hmm._viterbi(N, M, logStart, logTrans, segRatios,
+                                        frame)
+            statesS, vlpS = _hmm._viterbi_sparse(N, M, logStart, logTrans,
+                                                 segRatios, frame,
+                                                 predPtr, predIdx)
+            assert_array_equal(states, statesS)
+            assert_array_almost_equal(vlp, vlpS)
+
+        # fully connected matrix stays on the dense kernels
+        hmm = MultitrackHmm(emissionModel)
+        assert hmm._get_sparse_transitions() is None
+
+    def testFusedEStep(self):
+        # compare the fused E-step kernel with the original
+        # backward + posteriors + accumulate version
+        prng = np.random.RandomState(7)
+        N = 150
+        M = 5
+        emissionModel = IndependentMultinomialEmissionModel(
+            M, [3, 2, 4], zeroAsMissingData=False, randomize=True,
+            random_state=prng)
+        hmm = MultitrackHmm(emissionModel)
+        transmat = prng.uniform(0.1, 1., (M, M))
+        transmat[0, 1:3] = 0.
+        hmm.transmat_ = transmat / np.sum(transmat, axis=1)[:,np.newaxis]
+        hmm.current_iteration = 1
+        obs = np.zeros((N, 3), dtype=np.uint8)
+        for track, numSymbols in enumerate([3, 2, 4]):
+            obs[:, track] = prng.randint(0, numSymbols, N)
+
+        for segRatios in [None, prng.randint(1, 4, N).astype(np.float)]:
+            framelogprob = hmm._compute_log_likelihood(obs)
+            if segRatios is not None:
+                framelogprob *= segRatios[:,np.newaxis]
+            lpr, fwd = hmm._do_forward_pass(framelogprob, obs)
+            bwd = np.zeros((N, M))
+            _hmm._backward(N, M, hmm._log_startprob, hmm._log_transmat,
+                           framelogprob, segRatios, bwd)
+            gamma = fwd + bwd
+            posteriors = np.exp(gamma.T - logsumexp(gamma, axis=1)).T
+            lneta = np.zeros((M, M))
+            _hmm._log_sum_lneta(N, M, fwd, hmm._log_transmat, bwd,
+                                framelogprob, lpr, segRatios, lneta)
+            obsStats = emissionModel.initStats()
+            weights = posteriors
+            if segRatios is not None:
+                weights = posteriors * segRatios[:,np.newaxis]
+            for i in xrange(N):
+                for track in xrange(3):
+                    obsStats[track, :, obs[i, track]] += weights[i]
+
+            stats = hmm._initialize_sufficient_statistics()
+            succPtr, succIdx = hmm._get_sparse_transitions(1.0)[2:]
+            _hmm._fused_estep(N, M, fwd, hmm._log_transmat, framelogprob,
+                              obs, segRatios, lpr, succPtr, succIdx, 1, 1, 1,
+                              stats['start'], stats['trans'], stats['obs'])
+            assert_array_almost_equal(stats['start'], posteriors[0])
+            assert_array_almost_equal(stats['trans'], np.exp(lneta))
+            assert_array_almost_equal(stats['obs'], obsStats)
+
+        # and through the whole E-step
+        stats = hmm._initialize_sufficient_statistics()
+        stats2 = hmm._initialize_sufficient_statistics()
+        lp = hmm._do_sequence_estep(stats, obs)
+        lp2 = BaseHMM._do_sequence_estep(hmm, stats2, obs)
+        self.assertAlmostEqual(lp, lp2)
+        for key in ['start', 'trans', 'obs']:
+            assert_array_almost_equal(stats[key], stats2[key])
+
+    def testCompressRuns(self):
+        # run-length compressed inference must give the same answers as
+        # the regular dynamic programming
+        prng = np.random.RandomState(11)
+        M = 4
+        emissionModel = IndependentMultinomialEmissionModel(
+            M, [3, 2], randomize=True, random_state=prng)
+        hmm = MultitrackHmm(emissionModel)
+        transmat = prng.uniform(0.1, 1., (M, M)) + np.eye(M) * 5.
+        hmm.transmat_ = transmat / np.sum(transmat, axis=1)[:,np.newaxis]
+        # long runs mixed in with short ones (and one at the start)
+        lengths = [100, 3, 1, 2, 57, 1, 1, 300, 16, 2, 1, 40]
+        values = [prng.randint(1, 3, 2) for x in lengths]
+        table = IntegerTrackTable(2, "chr1", 0, sum(lengths))
+        for track in xrange(2):
+            row = []
+            for length, value in zip(lengths, values):
+                row += [value[track]] * length
+            table.writeRow(track, row)
+        obs = table.getNumPyArray()
+
+        logprob, states = hmm.decode(obs)
+        refLogprob, posteriors = hmm.score_samples(obs)
+        hmm.compressRuns = True
+        assert hmm._get_runs(obs) is None
+        starts, blockLengths, columns = hmm._get_runs(table)
+        assert len(starts) < len(table)
+        assert np.sum(columns >= 0) >= 4
+        cLogprob, cStates = hmm.decode(table)
+        self.assertAlmostEqual(logprob, cLogprob)
+        assert_array_equal(states, cStates)
+        cRefLogprob, cPosteriors = hmm.score_samples(table)
+        self.assertAlmostEqual(refLogprob, cRefLogprob)
+        assert_array_almost_equal(posteriors, cPosteriors)
+
+    def testWorkspace(self):
+        # reusing the workspace buffers across tables of different sizes
+        # must not change any answers
+        prng = np.random.RandomState(5)
+        M = 3
+        emissionModel = IndependentMultinomialEmissionModel(
+            M, [3, 2], randomize=True, random_state=prng)
+        hmm = MultitrackHmm(emissionModel)
+        tables = []
+        for length in [200, 35, 120]:
+            table = IntegerTrackTable(2, "chr1", 0, length)
+            for track in xrange(2):
+                table.writeRow(track, prng.randint(1, 3, length))
+            tables.append(table)
+        results = []
+        for table in tables + tables:
+            logprob, states = hmm.decode(table)
+            scoreLogprob, posteriors = hmm.score_samples(table)
+            results.append((logprob, states, scoreLogprob, posteriors))
+        # buffers were sized for the largest table and then kept
+        assert hmm.workspace.get("fwdlattice", (200, M)).base is \
+          hmm.workspace.get("fwdlattice", (35, M)).base
+        for i, table in enumerate(tables):
+            fresh = copy.deepcopy(hmm)
+            assert fresh.workspace is None
+            logprob, states = fresh.decode(table)
+            scoreLogprob, posteriors = fresh.score_samples(table)
+            for result in [results[i], results[i + len(tables)]]:
+                self.assertAlmostEqual(logprob, result[0])
+                assert_array_equal(states, result[1])
+                self.assertAlmostEqual(scoreLogprob, result[2])
+                assert_array_almost_equal(posteriors, result[3])
+        # the basehmm overrides hand out their own arrays, not buffers
+        framelogprob = hmm._compute_log_likelihood(tables[0])
+        lp, fwdlattice = hmm._do_forward_pass(framelogprob, tables[0])
+        bwdlattice = hmm._do_backward_pass(framelogprob, tables[0])
+        expected = [np.copy(framelogprob), np.copy(fwdlattice),
+                    np.copy(bwdlattice)]
+        hmm.decode(tables[2])
+        hmm.fit([tables[1], tables[2]])
+        for array, expectedArray in zip(
+            [framelogprob, fwdlattice, bwdlattice], expected):
+            for buf in hmm.workspace.pool.values():
+                assert not np.may_share_memory(array, buf)
+            assert_array_equal(array, expectedArray)
+        assert not np.may_share_memory(
+            framelogprob, hmm._compute_log_likelihood(tables[0]))
+
+    def testMaxProbSnapshot(self):
+        # the snapshot must hold the parameters as they were when saved,
+        # independent of any further training
+        prng = np.random.RandomState(3)
+        M = 3
+        emissionModel = IndependentMultinomialEmissionModel(
+            M, [3, 2], randomize=True, random_state=prng)
+        hmm = MultitrackHmm(emissionModel, maxProb=True, n_iter=4,
+                            fixStart=False)
+        tables = []
+        for length in [80, 50]:
+            table = IntegerTrackTable(2, "chr1", 0, length)
+            for track in xrange(2):
+                table.writeRow(track, prng.randint(1, 3, length))
+            tables.append(table)
+        snapshot = hmm._save_snapshot()
+        logStart = np.copy(hmm._log_startprob)
+        logTrans = np.copy(hmm._log_transmat)
+        logProbs = np.copy(emissionModel.getLogProbs())
+        arrays = dict(snapshot.arrays)
+        hmm.fit(tables)
+        assert not np.allclose(logProbs, emissionModel.getLogProbs())
+        assert hmm.bestSnapshot is not None
+        assert_array_equal(snapshot.arrays["_log_startprob"], logStart)
+        assert_array_equal(snapshot.arrays["_log_transmat"], logTrans)
+        assert_array_equal(snapshot.arrays["emissionModel.logProbs"], logProbs)
+        # saving again reuses the same arrays
+        hmm._save_snapshot(snapshot)
+        for name, array in arrays.items():
+            assert snapshot.arrays[name] is array
+        hmm._restore_snapshot(hmm.bestSnapshot)
+        best = (np.copy(hmm._log_transmat), np.copy(hmm._log_startprob),
+                np.copy(emissionModel.getLogProbs()))
+        hmm._restore_snapshot(snapshot)
+        assert_array_equal(hmm._log_transmat, snapshot.arrays["_log_transmat"])
+        assert_array_equal(emissionModel.getLogProbs(),
+                           snapshot.arrays["emissionModel.logProbs"])
+        assert not np.allclose(best[2], logProbs)
+        assert "bestSnapshot" not in hmm.__getstate__()
+
+    def testDistributedEm(self):
+        # training with E-step workers must give the same model as training
+        # in one process
+        prng = np.random.RandomState(9)
+        M = 3
+        emissionModel = IndependentMultinomialEmissionModel(
+            M, [3, 2], randomize=True, random_state=prng, fudge=0.1)
+        hmm = MultitrackHmm(emissionModel, n_iter=5, fixStart=False,
+                            maxProb=True)
+        tables = []
+        for length in [120, 30, 75, 200, 10]:
+            table = IntegerTrackTable(2, "chr1", 0, length)
+            for track in xrange(2):
+                table.writeRow(track, prng.randint(1, 3, length))
+            tables.append(table)
+        shards = shardTrackTables(tables, 3)
+        assert len(shards) == 3
+        assert sorted(sum(shards, [])) == range(len(tables))
+        serialHmm = copy.deepcopy(hmm)
+        serialHmm.fit(tables)
+
+        rendezvousPath = getTestDirPath("emRendezvous")
+        if not os.path.isdir(rendezvousPath):
+            os.makedirs(rendezvousPath)
+        for path in [None, rendezvousPath]:
+            poolHmm = copy.deepcopy(hmm)
+            poolHmm.emPool = startLocalEmWorkerPool(tables, 3, path)
+            poolHmm.fit(tables)
+            poolHmm.emPool.close()
+            poolHmm.emPool = None
+            assert_array_almost_equal(poolHmm.transmat_, serialHmm.transmat_)
+            assert_array_almost_equal(poolHmm.startprob_,
+                                      serialHmm.startprob_)
+            assert_array_almost_equal(
+                poolHmm.emissionModel.getLogProbs(),
+                serialHmm.emissionModel.getLogProbs())
+            self.assertAlmostEqual(poolHmm.last_forward_log_prob,
+                                   serialHmm.last_forward_log_prob)
+            self.assertAlmostEqual(poolHmm.best_forward_log_prob,
+                                   serialHmm.best_forward_log_prob)
+        assert len(os.listdir(rendezvousPath)) == 0
+        os.rmdir(rendezvousPath)
+
+    def testThreadedEstep(self):
+        # the E-step statistics (and so the training) must not depend on
+        # the number of threads the emission model is given
+        prng = np.random.RandomState(11)
+        emissionModel = IndependentMultinomialEmissionModel(
+            3, [3, 2], randomize=True, random_state=prng)
+        hmm = MultitrackHmm(emissionModel, n_iter=4)
+        tables = []
+        for length in [150, 1, 40]:
+            table = IntegerTrackTable(2, "chr1", 0, length)
+            for track in xrange(2):
+                table.writeRow(track, prng.randint(1, 3, length))
+            tables.append(table)
+        hmm._init(tables, hmm.init_params)
+        hmm.current_iteration = 1
+        stats, lp = hmm._do_estep(tables)
+        threadHmm = copy.deepcopy(hmm)
+        threadHmm.emissionModel.numThreads = 3
+        threadStats, threadLp = threadHmm._do_estep(tables)
+        self.assertAlmostEqual(lp, threadLp)
+        assert sorted(stats.keys()) == sorted(threadStats.keys())
+        for key in stats:
+            assert_array_almost_equal(stats[key], threadStats[key])
+        hmm.init_params = ""
+        threadHmm.init_params = ""
+        hmm.fit(tables)
+        threadHmm.fit(tables)
+        assert_array_almost_equal(hmm.transmat_, threadHmm.transmat_)
+        assert_array_almost_equal(hmm.emissionModel.getLogProbs(),
+                                  threadHmm.emissionModel.getLogProbs())
+
+    def testDistributedEmFailure(self):
+        # a dead or silent worker must stop the training with an error
+        # instead of leaving the coordinator waiting forever
+        prng = np.random.RandomState(9)
+        emissionModel = IndependentMultinomialEmissionModel(
+            2, [3], randomize=True, random_state=prng)
+        hmm = MultitrackHmm(emissionModel, n_iter=3)
+        tables = []
+        for length in [50, 20]:
+            table = IntegerTrackTable(1, "chr1", 0, length)
+            table.writeRow(0, prng.randint(1, 3, length))
+            tables.append(table)
+        rendezvousPath = getTestDirPath("emRendezvous")
+        if not os.path.isdir(rendezvousPath):
+            os.makedirs(rendezvousPath)
+        for path in [None, rendezvousPath]:
+            poolHmm = copy.deepcopy(hmm)
+            poolHmm.emPool = startLocalEmWorkerPool(tables, 2, path)
+            poolHmm.emPool.processes[1].terminate()
+            self.assertRaises(RuntimeError, poolHmm.fit, tables)
+            assert len(poolHmm.emPool.processes) == 0
+        poolHmm = copy.deepcopy(hmm)
+        poolHmm.emPool = connectFileEmWorkerPool(rendezvousPath, 1, 0.2)
+        self.assertRaises(RuntimeError, poolHmm.fit, tables)
+        for name in os.listdir(rendezvousPath):
+            os.remove(os.path.join(rendezvousPath, name))
+        os.rmdir(rendezvousPath)
+
+        # remote workers split the intervals like the local ones do
+        intervals = [("chr1", 0, 10), ("chr1", 20, 120), ("chr2", 0, 60),
+                     ("chr2", 70, 100), ("chr3", 0, 40)]
+        assert shardIntervals(intervals, 2) == [[1, 3], [0, 2, 4]]
+        assert shardIntervals(intervals, 7)[5:] == [[], []]
+
+    def testReplicatesHalving(self):
+        # every round of successive halving does as many M-steps as it's
+        # given, so the survivor gets --iter of them in total
+        intervals = readBedIntervals(getTestDirPath("truth.bed"), ncol=4)
+        trackData = TrackData()
+        trackData.loadTrackData(getTracksInfoPath(3), [
+            (intervals[0][0], intervals[0][1], intervals[-1][2])])
+        args = argparse.Namespace(
+            numStates=3, iter=7, halving=2, numThreads=2, reps=3,
+            emThresh=-1., supervised=False, flatEm=False, emFac=0,
+            segLen=None, emRandRange=(0.2, 0.8), cfg=False, fixTrans=False,
+            fixEm=False, fixStart=False, forceTransProbs=None,
+            forceEmProbs=None, transMatEpsilons=False, maxProb=False,
+            maxProbCut=None, onlineBatch=0, onlineDecay=ONLINE_STEP_DECAY,
+            onlineChunk=ONLINE_CHUNK_SIZE, onlineHeldOut=0.,
+            accelerate=False, initTransProbs=None, initEmProbs=None,
+            initStartProbs=None)
+        models = trainReplicatesHalving([1, 2, 3], trackData, None, args)
+        # 2 M-steps for all, then 4 more for the best two, then the last 1
+        iterations = sorted([x.current_iteration for x in models])
+        assert iterations == [3, 7, 8]
+        survivor = [x for x in models if x.current_iteration == 8][0]
+        # and the log prob it was picked on is that of its parameters
+        stats, lp = copy.deepcopy(survivor)._do_estep(
+            trackData.getTrackTableList())
+        self.assertAlmostEqual(lp, survivor.getLastLogProb())
+
+    def testHalvingOptions(self):
+        # the halving rounds only know how to continue Baum-Welch, so
+        # the other training modes must be rejected up front
+        argv = sys.argv
+        try:
+            for option in [["--onlineBatch", "4"], ["--accelerate"]]:
+                sys.argv = ["teHmmTrain.py", "tracks.xml", "train.bed",
+                            "out.mod", "--reps", "4", "--halving", "2"] + \
+                            option
+                self.assertRaises(RuntimeError, teHmmTrainMain)
+        finally:
+            sys.argv = argv
+
+    def testOnlineEm(self):
+        # stepwise EM on small minibatches should get close to batch EM
+        # after a few passes
+        prng = np.random.RandomState(2)
+        trueTrans = np.array([[0.98, 0.02], [0.05, 0.95]])
+        trueEm = [np.array([[0.8, 0.1, 0.1], [0.1, 0.2, 0.7]]),
+                  np.array([[0.9, 0.1], [0.3, 0.7]])]
+        tables = []
+        for t in xrange(20):
+            states = np.zeros(1000, dtype=np.int)
+            for i in xrange(1, len(states)):
+                states[i] = prng.rand() >= trueTrans[states[i-1], 0]
+            table = IntegerTrackTable(2, "chr1", 0, len(states))
+            for track, em in enumerate(trueEm):
+                table.writeRow(track, [1 + np.searchsorted(
+                    np.cumsum(em[s]), prng.rand()) for s in states])
+            tables.append(table)
+        emissionModel = IndependentMultinomialEmissionModel(
+            2, [3, 2], randomize=True, random_state=np.random.RandomState(5))
+        hmm = MultitrackHmm(emissionModel, n_iter=20, fixStart=False,
+                            thresh=1e-3, random_state=np.random.RandomState(1))
+        def totalLogProb(model):
+            return sum([model.score(table) for table in tables])
+        initLogProb = totalLogProb(hmm)
+
+        # long unsegmented tables get cut into tables that share their data
+        hmm.onlineChunkSize = 300
+        units = hmm._get_online_units(tables)
+        assert len(units) == 4 * len(tables)
+        assert sum([len(x) for x in units]) == 1000 * len(tables)
+        assert all([isinstance(x, IntegerTrackTable) for x in units])
+        assert np.may_share_memory(units[1].getNumPyArray(),
+                                   tables[0].getNumPyArray())
+        assert_array_equal(units[1].getNumPyArray(),
+                           tables[0].getNumPyArray()[300:600])
+        assert units[1].getStart() == 300 and units[1].getEnd() == 600
+        assert len(units[3]) == 100
+        # every replicate holds out the same chunks
+        otherHmm = copy.deepcopy(hmm)
+        otherHmm.random_state = np.random.RandomState(7)
+        train, heldOut = hmm._split_online_units(units)
+        assert len(heldOut) == 8 and len(train) + len(heldOut) == len(units)
+        assert [id(x) for x in otherHmm._split_online_units(units)[1]] == \
+               [id(x) for x in heldOut]
+        hmm.onlineChunkSize = ONLINE_CHUNK_SIZE
+
+        batchHmm = copy.deepcopy(hmm)
+        batchHmm.fit(tables)
+        batchLogProb = totalLogProb(batchHmm)
+
+        onlineHmm = copy.deepcopy(hmm)
+        onlineHmm.onlineBatchSize = 1
+        onlineHmm.n_iter = 4
+        onlineHmm.fitOnline(tables)
+        assert onlineHmm.last_forward_log_prob_it <= 4
+        onlineLogProb = totalLogProb(onlineHmm)
+        assert onlineLogProb > initLogProb
+        assert abs(onlineLogProb - batchLogProb) < 0.01 * abs(batchLogProb)
+        onlineHmm.validate()
+
+    def testSquarem(self):
+        # accelerated EM should do at least as well as regular EM with the
+        # same number of E-steps, and not touch fixed parameters
+        prng = np.random.RandomState(2)
+        trueTrans = np.array([[0.98, 0.01, 0.01], [0.02, 0.95, 0.03],
+                              [0.05, 0.05, 0.9]])
+        trueEm = [np.array([[0.6, 0.2, 0.2], [0.3, 0.4, 0.3],
+                            [0.2, 0.2, 0.6]]),
+                  np.array([[0.6, 0.4], [0.45, 0.55], [0.3, 0.7]])]
+        tables = []
+        for t in xrange(5):
+            states = np.zeros(1000, dtype=np.int)
+            for i in xrange(1, len(states)):
+                states[i] = np.searchsorted(np.cumsum(trueTrans[states[i-1]]),
+                                            prng.rand())
+            table = IntegerTrackTable(2, "chr1", 0, len(states))
+            for track, em in enumerate(trueEm):
+                table.writeRow(track, [1 + np.searchsorted(
+                    np.cumsum(em[s]), prng.rand()) for s in states])
+            tables.append(table)
+        emissionModel = IndependentMultinomialEmissionModel(
+            3, [3, 2], randomize=True, random_state=np.random.RandomState(5))
+        hmm = MultitrackHmm(emissionModel, n_iter=30, fixStart=False,
+                            thresh=1e-5, random_state=np.random.RandomState(1))
+
+        batchHmm = copy.deepcopy(hmm)
+        batchHmm.fit(tables)
+        squaremHmm = copy.deepcopy(hmm)
+        squaremHmm.fitSquarem(tables)
+        assert squaremHmm.last_forward_log_prob >= \
+            batchHmm.last_forward_log_prob
+        squaremHmm.validate()
+
+        for fixTrans in [True, False]:
+            fixedHmm = copy.deepcopy(hmm)
+            fixedHmm.fixTrans = fixTrans
+            fixedHmm.fixEmission = not fixTrans
+            fixedHmm.fitSquarem(tables)
+            if fixTrans is True:
+                assert_array_equal(fixedHmm.transmat_, hmm.transmat_)
+            else:
+                assert_array_equal(fixedHmm.emissionModel.getLogProbs(),
+                                   hmm.emissionModel.getLogProbs())
+
 def main():
     sys.argv = sys.argv[:1]
     unittest.main()
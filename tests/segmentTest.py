@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+#Copyright (C) 2014 by Glenn Hickey
+#
+#Released under the MIT license, see LICENSE.txt
+import unittest
+import sys
+import os
+import argparse
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from teHmm.track import CategoryMap
+from teHmm.bin.segmentTracks import getPeltCuts, getGaussianValues
+from teHmm.bin.segmentTracks import getCutPoints
+from teHmm.track import IntegerTrackTable
+
+from teHmm.tests.common import TestBase
+
+class TestCase(TestBase):
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+    
+    def tearDown(self):
+        super(TestCase, self).tearDown()
+
+    def testCutPoints(self):
+        """ Compare the segmentation with a (slow) reference that tests one
+        column at a time, for every combination of options """
+        prng = np.random.RandomState(1)
+        for trial in xrange(300):
+            T = prng.randint(1, 6)
+            N = prng.randint(1, 300)
+            trackTable = IntegerTrackTable(T, "chr1", 100, 100 + N)
+            for j in xrange(T):
+                trackTable.data[:, j] = np.cumsum(
+                    prng.rand(N) < prng.rand() * 0.3) % 3
+            args = argparse.Namespace()
+            args.pelt = None
+            args.comp = ["first", "prev"][prng.randint(2)]
+            args.thresh = prng.randint(0, 3)
+            args.maxLen = [0, 0, 1, 3, 7, 20][prng.randint(6)]
+            args.fixLen = [0, 0, 0, 5][prng.randint(4)]
+            args.cutList = (prng.rand(T) < 0.3).astype(np.int)
+            args.ignoreList = ((prng.rand(T) < 0.3) &
+                               (args.cutList == 0)).astype(np.int)
+            args.stats = "stats"
+            stats = dict()
+            cuts = getCutPoints(trackTable, args, stats)
+            refStats = dict()
+            refCuts = getReferenceCutPoints(trackTable.data, args, refStats)
+            assert_array_equal(cuts, refCuts)
+            self.assertEqual(sorted(stats.keys()), sorted(refStats.keys()))
+            for trackNo in stats:
+                self.assertEqual(stats[trackNo][0], refStats[trackNo][0])
+                self.assertAlmostEqual(stats[trackNo][1], refStats[trackNo][1])
+
+    def testPelt(self):
+        """ Compare --pelt with a brute force search over all
+        segmentations """
+        prng = np.random.RandomState(3)
+        # gaussian track whose codes are out of order with its values, and
+        # with missing data (code 0)
+        valMap = CategoryMap(reserved = 1)
+        for val in [5.0, 1.0, 3.0, 0.0, 4.0]:
+            valMap.update(val)
+        assert valMap.getMap(5.0) == 1 and valMap.getMap(0.0) == 4
+        for trial in xrange(60):
+            N = prng.randint(1, 40)
+            T = 3
+            data = np.zeros((N, T), dtype=np.uint8)
+            for j in xrange(T):
+                data[:, j] = np.cumsum(prng.rand(N) < 0.2) % 3 + 1
+                noise = prng.rand(N) < 0.1
+                data[noise, j] = prng.randint(1, 4, np.sum(noise))
+            data[:, 2] = prng.randint(0, 6, N)
+            args = argparse.Namespace()
+            args.pelt = prng.rand() * 5.
+            args.cutList = np.array([int(prng.rand() < 0.3), 0, 0])
+            args.ignoreList = np.zeros((T,), dtype=np.int)
+            mbTables = {2 : valMap.getMapBackTable(np.uint8)}
+            values = getGaussianValues(data, [2], mbTables)
+            assert np.all(np.isnan(values[data[:, 2] == 0, 0]))
+            assert_array_equal(values[data[:, 2] == 2, 0], 1.0)
+
+            def cost(start, end):
+                c = 0.
+                if args.cutList[0] == 0:
+                    c += end - start - np.max(np.bincount(data[start:end, 0]))
+                c += end - start - np.max(np.bincount(data[start:end, 1]))
+                x = values[start:end, 0]
+                x = x[~np.isnan(x)]
+                if len(x) > 0:
+                    c += np.sum((x - np.mean(x)) ** 2)
+                return c + args.pelt
+
+            forced = [i for i in xrange(1, N) if args.cutList[0] == 1 and
+                      data[i, 0] != data[i - 1, 0]]
+            best = [0.] + [np.inf] * N
+            for end in xrange(1, N + 1):
+                for start in xrange(end):
+                    if not any(start < x < end for x in forced):
+                        best[end] = min(best[end], best[start] +
+                                        cost(start, end))
+
+            cuts = getPeltCuts(data, args, mbTables)
+            bounds = [0] + list(cuts) + [N]
+            assert set(forced) <= set(cuts)
+            total = sum(cost(bounds[k], bounds[k + 1])
+                        for k in xrange(len(bounds) - 1))
+            self.assertAlmostEqual(total, best[N])
+
+def getReferenceCutPoints(data, args, stats):
+    """ Segment the table by testing one column at a time (as
+    segmentTracks.py originally did) """
+    cuts = []
+    first = 0
+    curLen = 0
+    for i in xrange(1, len(data)):
+        curLen += 1
+        if args.fixLen > 0:
+            isCut = curLen >= args.fixLen
+        elif args.maxLen > 0 and curLen >= args.maxLen:
+            isCut = True
+        else:
+            changed = (args.ignoreList == 0) & (data[i] != data[first])
+            difCount = np.sum(changed)
+            isCut = np.any(changed & (args.cutList == 1)) or \
+                    difCount > args.thresh
+            if isCut:
+                for j in np.nonzero(changed)[0]:
+                    count, pct = stats.get(j, (0, 0))
+                    stats[j] = (count + 1, pct + 1. / difCount)
+        if isCut:
+            cuts.append(i)
+            first = i
+            curLen = 0
+        if args.comp == "prev":
+            first = i
+    return np.array(cuts, dtype=np.int)
+
+def main():
+    sys.argv = sys.argv[:1]
+    unittest.main()
+        
+if __name__ == '__main__':
+    main()
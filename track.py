@@ -8,6 +8,7 @@
 import os
 import sys
 import logging
+import copy
 import numpy as np
 from scipy.stats import mode
 import xml.etree.ElementTree as ET
@@ -443,6 +444,17 @@ class TrackTable(object):
     def getNumPyArray(self):
         raise RuntimeError("Not implemented")
 
+    def getUniqueColumns(self):
+        """ Return (columns, inverse) where columns contains each distinct
+        column of the table exactly once and inverse is the index of each
+        position's column (ie columns[inverse] == table) """
+        raise RuntimeError("Not implemented")
+
+    def getPackedColumns(self, key, pack):
+        """ Return pack(columns) for the columns of getUniqueColumns().  The
+        result is cached (for the last key) until the data changes """
+        raise RuntimeError("Not implemented")
+
     def getSegmentOffsets(self):
         return self.segOffsets
 
@@ -549,6 +561,13 @@ class IntegerTrackTable(TrackTable):
     the rows are stored in array columns, because we want quicker access to
     data columns for the HMM interface.  Ie, value for each track at a given base
     """
+    # the caches below are reset whenever the data changes.  they're class
+    # attributes so that tables pickled before they existed still work
+    #: cached output of getUniqueColumns()
+    uniqueColumns = None
+    #: (key, packed columns) cached by getPackedColumns()
+    packedColumns = None
+
     def __init__(self, numTracks, chrom, start, end, dtype=INTEGER_ARRAY_TYPE):
         super(IntegerTrackTable, self).__init__(numTracks, chrom, start, end)
         #: (end-start) X (numTracks) integer data array
@@ -565,6 +584,8 @@ class IntegerTrackTable(TrackTable):
         each value using valueMap if it's specified """
         assert row < self.getNumTracks()
         assert len(rowArray) == len(self)
+        self.uniqueColumns = None
+        self.packedColumns = None
         for i in xrange(len(self)):
             if rowArray[i] > self.iinfo.max:
                 logger.warning("Clamping input value %d of track# %d"
@@ -582,6 +603,56 @@ class IntegerTrackTable(TrackTable):
     def getNumPyArray(self):
         return self.data
 
+    def getUniqueColumns(self):
+        """ Return (columns, inverse) where columns contains each distinct
+        column of the table exactly once and inverse is the index of each
+        position's column (ie columns[inverse] == table).  Genomic tables
+        tend to have far fewer distinct columns than positions, so this lets
+        the emission model evaluate each one only once.  The result is
+        cached since the data doesn't change between EM iterations """
+        if self.uniqueColumns is None:
+            data = np.ascontiguousarray(self.data)
+            if data.shape[0] == 0 or data.shape[1] == 0:
+                self.uniqueColumns = (data[:1],
+                                      np.zeros(data.shape[0], np.int))
+            else:
+                # view each column as one opaque value so np.unique can
+                # hash/sort them without needing numpy's axis option
+                packed = data.view(np.dtype((np.void, data.dtype.itemsize *
+                                             data.shape[1])))[:,0]
+                u, index, inverse = np.unique(packed, return_index=True,
+                                              return_inverse=True)
+                self.uniqueColumns = (data[index], inverse)
+            logger.debug("%d distinct columns found in table with shape %s" %
+                         (len(self.uniqueColumns[0]), str(self.shape)))
+        return self.uniqueColumns
+
+    def getPackedColumns(self, key, pack):
+        """ Return pack(columns) for the columns of getUniqueColumns().  The
+        emission model uses this to pack the distinct columns for its joint
+        tables once rather than every iteration.  The result is cached (for
+        the last key) until the data changes """
+        if self.packedColumns is None or self.packedColumns[0] != key:
+            self.packedColumns = (key, pack(self.getUniqueColumns()[0]))
+        return self.packedColumns[1]
+
+    def getSubTable(self, start, end):
+        """ Get a table for the columns [start, end) (in table coordinates)
+        of this (unsegmented) table.  Its data is a view of this table's,
+        so nothing is copied """
+        assert self.segOffsets is None
+        assert 0 <= start < end <= len(self)
+        table = copy.copy(self)
+        table.data = self.data[start:end]
+        table.start = self.start + start
+        table.end = self.start + end
+        table.origEnd = table.end
+        table.shape = table.data.shape
+        table.maskArray = None
+        table.uniqueColumns = None
+        table.packedColumns = None
+        return table
+
     def getRow(self, row):
         assert row < self.data.shape[1]
         rowArray = self.data[:,row]
@@ -590,12 +661,16 @@ class IntegerTrackTable(TrackTable):
 
     def initRow(self, row, val):
         self.data[:,row] = val
+        self.uniqueColumns = None
+        self.packedColumns = None
 
     def compressSegments(self):
         """ cut up data so that only one value per segment """
         assert self.segOffsets is not None and len(self.segOffsets) > 0
         oldShape = self.data.shape
         self.data = self.data[self.segOffsets]
+        self.uniqueColumns = None
+        self.packedColumns = None
         newShape = self.data.shape
         assert newShape[0] == len(self.segOffsets)
         assert_array_equal(oldShape[1:], newShape[1:])
@@ -604,6 +679,8 @@ class IntegerTrackTable(TrackTable):
         """ set position pos to mode of range from [start, end) for all
         tracks except gaussian distributions, where we use mean isntead of
         mode """
+        self.uniqueColumns = None
+        self.packedColumns = None
         for track in trackList:
             trackNo = track.getNumber()
             if track.getDist() == "gaussian":
@@ -636,6 +713,8 @@ class IntegerTrackTable(TrackTable):
             # want to mask out. 
             oldShape = self.shape
             self.data = self.data[self.maskArray]
+            self.uniqueColumns = None
+            self.packedColumns = None
             self.shape = self.data.shape
             assert self.shape[0] <= oldShape[0]
             assert self.shape[1] == oldShape[1]
@@ -138,24 +138,39 @@ def readBedData(bedPath, chrom, start, end, **kwargs):
 
         tempFileIntIn = getLocalTempPath("Temp_intin", ".bed")
         tempFileIntOut = getLocalTempPath("Temp_intout", ".bed")
-        runShellCommand("echo \"%s\" > %s && intersectBed -a %s "
-                        "-b %s | sortBed > %s && rm -f %s" % (
-                            str(interval), tempFileIntIn, bedPath,
-                            tempFileIntIn, tempFileIntOut, tempFileIntIn))
+        try:
+            runShellCommand("echo \"%s\" > %s && intersectBed -a %s "
+                            "-b %s | sortBed > %s && rm -f %s" % (
+                                str(interval), tempFileIntIn, bedPath,
+                                tempFileIntIn, tempFileIntOut,
+                                tempFileIntIn))
+        except:
+            # don't leave the temp files behind in the current directory
+            runShellCommand("rm -f %s %s" % (tempFileIntIn, tempFileIntOut))
+            raise
         intersectionPath = tempFileIntOut
     else:
         intersectionPath = bedPath       
         if sort is True:
             logger.debug("sortBed(%s)" % bedPath)
             tempFileSortOut = getLocalTempPath("Temp_sortout", ".bed")
-            runShellCommand("sortBed -i %s > %s" % (bedPath, tempFileSortOut))
+            try:
+                runShellCommand("sortBed -i %s > %s" % (bedPath,
+                                                        tempFileSortOut))
+            except:
+                runShellCommand("rm -f %s" % tempFileSortOut)
+                raise
             intersectionPath = tempFileSortOut
             
     if ignoreBed12 is False:
         logger.debug("bed6(%s)" % bedPath)
         tempFileBed6Out = getLocalTempPath("Temp_b6out", ".bed")
-        runShellCommand("bed12ToBed6 -i %s > %s" % (intersectionPath,
-                                                    tempFileBed6Out))
+        try:
+            runShellCommand("bed12ToBed6 -i %s > %s" % (intersectionPath,
+                                                        tempFileBed6Out))
+        except:
+            runShellCommand("rm -f %s" % tempFileBed6Out)
+            raise
         if intersectionPath != bedPath:
             runShellCommand("rm -f %s" % intersectionPath)
         intersectionPath = tempFileBed6Out